@@ -38,11 +38,25 @@ __author__ = 'anton'
 #		"kill pid"
 #	If it does not work use:
 #		"kill -9 pid"
-#	If the error does not go away, try changing the port number '9093' both in the client and server code
+#	If the error does not go away, start the server on another port with --port
+#
+# OPTIONS
+#   --port 9094     Serve on another port than 9093
+#   --stream-port   Port for plots planned on another computer with host_planner.py. Default 9095.
+#   --stub          Simulate the motors, to run the server without a brick
+#   --root DIR      Keep uploads, jobs and logs in DIR, so more servers can run from one checkout
+#   -v              More logging, also on the console. Any other argument does the same.
+#   --log-level Plotter=DEBUG   Log level per subsystem. Give it more than once for more subsystems.
+#                   The web page can change them too: {'log': {'tornado.access': 'INFO'}} on the websocket.
+#                   The log is json, one record per line, in logs/plotter.log.
 
 
 ####################### Imports #########################
 
+# Only what the web server needs is imported here. PIL, ev3dev and the plotter are imported
+# by the motor thread while the web server is already running.
+import time
+startup_time = time.time()
 
 # To run motors on the brickpi, in a separate thread
 import threading
@@ -53,30 +67,123 @@ import tornado.web
 import tornado.websocket
 import tornado.template
 import json,os
-import sys
-from PIL import Image, ImageDraw
+import gzip
+import mimetypes
+import argparse
+import queue
 import logging
-import time
+import logging.handlers
 
 # My own stuff
-from ropeplotter import RopePlotter, Throttler, get_ip_address
 from settings import *
 
-#Ev3dev for drawing and buttons
-import ev3dev.auto as ev
-
 ######################### Globals. ################################
 
-c = 0               # movement command.
-websockets = []     # list of open sockets.
+commands = queue.Queue()    # movement commands, from the web page and the buttons.
+websockets = []             # list of open sockets.
+web_port = 9093
+stream_port = STREAM_PORT
+record_traces = False       # Record every plot job in TRACE_DIR, for replay_trace.py
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))   # Web page and static files. Uploads go in the working dir.
+
+# What's being plotted, for the /status page
+job_progress = {'id': None, 'name': None, 'pct': 0.0}
+
+# How busy are we? CPU use of the process, how late the IOLoop runs and how long websocket round trips take.
+load_stats = {'cpu': 0.0, 'cpu_sum': 0.0, 'samples': 0, 'ioloop_lag': 0.0, 'max_ioloop_lag': 0.0, 'ws_latency': 0.0,
+              'loop_rate': 0.0, 'move_rate': 0.0, 'loop_passes': 0, 'moves': 0}
 
-# instantiate a plotter object
-plotter = RopePlotter(L_ROPE_0, R_ROPE_0, ROPE_ATTACHMENT_WIDTH, Kp=KP, Ki=TI, Kd=TD, cm_to_deg=CM_TO_DEG, chalk=CHALK)
+# Brick buttons map to the same commands as the web page. (on press, on release)
+BUTTON_COMMANDS = {'right': ('left-fwd', 'left-stop'),
+                   'up': ('left-back', 'left-stop'),
+                   'down': ('right-fwd', 'right-stop'),
+                   'left': ('right-back', 'right-stop'),
+                   'enter': ('chalk-loaded', None),
+                   'backspace': ('quit', None)}
+
+# Plot modes: the plotter method that does the plotting and the upload it plots by default.
+PLOT_MODES = {'plot': ('plot_from_file', 'uploads/coords.csv'),
+              'plotcircles': ('optimized_etch', 'uploads/picture.jpg'),
+              'plotwaves': ('plot_circle_waves', 'uploads/picture.jpg')}
+
+# The plotter object is instantiated by the motor thread, so the web server doesn't wait for the hardware.
+plotter = None
 
-logging.basicConfig(filename='plotter.log',
-                    format='%(asctime)s.%(msecs)03d - %(funcName)s: %(message)s',
-                    datefmt="%H:%M:%S")
 plotter_log = logging.getLogger("Plotter")
+log_listener = None     # Writes the log records from the queue to the log file, in a thread of its own
+
+
+################# Logging #####################
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line, so the log is easy to search and parse.
+    """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, "%Y-%m-%d %H:%M:%S") + ".{0:03d}".format(int(record.msecs)),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'function': record.funcName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # The standard QueueHandler formats the message before queueing it. Leave that to the listener,
+    # so the motor thread only has to put the record in the queue.
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(verbose=False):
+    """
+    Log through a queue. The file is written, rotated and formatted by a listener thread, never
+    by the thread that logs.
+    """
+    global log_listener
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if verbose:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d - %(name)s %(funcName)s: %(message)s',
+                                                       datefmt="%H:%M:%S"))
+        handlers.append(console_handler)
+    log_queue = queue.Queue()
+    logging.getLogger().addHandler(LogQueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+    log_listener.start()
+
+
+def set_log_levels(levels):
+    """
+    Set log levels per subsystem, e.g. {'Plotter': 'DEBUG', 'tornado.access': 'WARNING'}.
+
+    :param levels: dict of logger name and level name
+    :return: dict with the levels of all LOG_LEVELS subsystems and the ones just set
+    """
+    for name, level in levels.items():
+        number = logging.getLevelName(str(level).upper())
+        if not isinstance(number, int):
+            raise ValueError("Unknown log level: {0}".format(level))
+        logging.getLogger(name).setLevel(number)
+    return dict([(name, logging.getLevelName(logging.getLogger(name).getEffectiveLevel()))
+                 for name in set(list(LOG_LEVELS) + list(levels))])
+
+
+def parse_log_levels(specs):
+    # From the command line: ['Plotter=DEBUG', 'tornado.access=WARNING']
+    levels = {}
+    for spec in specs:
+        name, _, level = spec.partition('=')
+        if not level:
+            raise argparse.ArgumentTypeError("Use --log-level name=LEVEL, not " + spec)
+        levels[name] = level
+    return levels
 
 
 ################# Set up web server & threads #####################
@@ -84,16 +191,178 @@ plotter_log = logging.getLogger("Plotter")
 
 # Initialize Tornado to use 'GET' and load index.html
 class MainHandler(tornado.web.RequestHandler):
+    # The page only changes with the settings in it. Render it once for them, and gzip it once.
+    page_cache = {}
+
     def get(self):
-        self.render("index.html",
-                    kp=plotter.Kp,
-                    ti=plotter.Ti,
-                    td=plotter.Td,
-                    ll=plotter.l_rope_0,
-                    lr=plotter.r_rope_0,
-                    rs=plotter.r_step,
-                    aw=plotter.att_dist,
-                    cm_to_deg=plotter.cm_to_deg)
+        settings = current_settings()
+        key = tuple(sorted(settings.items()))
+        if key not in self.page_cache:
+            page = self.render_string("index.html", asset_url=asset_url, **settings)
+            self.page_cache.clear()
+            self.page_cache[key] = (page, gzip.compress(page))
+        page, gzipped_page = self.page_cache[key]
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        self.set_header('Vary', 'Accept-Encoding')
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(gzipped_page)
+        else:
+            self.write(page)
+
+
+################# Static files #####################
+
+# Browsers can keep files with a version in their url for this long, without asking again.
+ASSET_MAX_AGE = 365 * 24 * 3600
+GZIP_EXTENSIONS = ('.js', '.css', '.svg', '.ttf', '.eot')
+asset_versions = {}
+
+
+def asset_url(path):
+    """
+    Url of a file in BASE_DIR with a hash of its content, like css/bootstrap.min.css?v=0123456789ab.
+    A new version gets a new url, so the old one can be cached forever.
+    """
+    if path not in asset_versions:
+        asset_versions[path] = tornado.web.StaticFileHandler.get_content_version(os.path.join(BASE_DIR, path))[:12]
+    return "{0}?v={1}".format(path, asset_versions[path])
+
+
+def precompress_assets(directories):
+    """
+    Write a .gz next to every compressible file, so it doesn't have to be compressed for every request.
+    Only when it's missing or older than the file.
+    """
+    for directory in directories:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(GZIP_EXTENSIONS):
+                continue
+            if os.path.exists(path + '.gz') and os.path.getmtime(path + '.gz') >= os.path.getmtime(path):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    data = gzip.compress(f.read(), compresslevel=9)
+                with open(path + '.gz.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.gz.tmp', path + '.gz')
+            except (IOError, OSError) as e:
+                # E.g. a read only install. Then it's served uncompressed.
+                plotter_log.warning("Can't precompress {0}: {1}".format(path, e))
+                return
+
+
+class CachedFileHandler(tornado.web.StaticFileHandler):
+    """
+    Static files with an ETag from their size and modification time. Tornado's ETag is a hash of the content
+    that it never computes again, so a new preview.jpg would get the ETag of the old one. This is cheaper too.
+    """
+
+    def compute_etag(self):
+        stat = os.stat(self.absolute_path)
+        return '"{0:x}-{1:x}"'.format(int(stat.st_mtime * 1000), stat.st_size)
+
+
+class UploadsHandler(CachedFileHandler):
+    # Uploads and previews change. Ask every time, but a 304 is enough when they didn't.
+    def set_extra_headers(self, path):
+        self.set_header('Cache-Control', 'no-cache')
+
+
+class AssetHandler(CachedFileHandler):
+    """
+    Scripts, css, fonts and pictures of the page. Sent gzipped from the .gz file next to them when the browser
+    takes that. With a version in the url, from asset_url(), they're cached for a year.
+    """
+    gzipped = False
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = tornado.web.StaticFileHandler.validate_absolute_path(self, root, absolute_path)
+        if (absolute_path and 'gzip' in self.request.headers.get('Accept-Encoding', '') and
+                os.path.exists(absolute_path + '.gz')):
+            self.gzipped = True
+            return absolute_path + '.gz'
+        return absolute_path
+
+    def get_content_type(self):
+        if self.gzipped:
+            return mimetypes.guess_type(self.absolute_path[:-3])[0] or 'application/octet-stream'
+        return tornado.web.StaticFileHandler.get_content_type(self)
+
+    def get_content_size(self):
+        # Tornado can remember the size of the file it checked, which is not the .gz
+        if self.gzipped:
+            return os.path.getsize(self.absolute_path)
+        return tornado.web.StaticFileHandler.get_content_size(self)
+
+    def get_cache_time(self, path, modified, mime_type):
+        return ASSET_MAX_AGE if 'v' in self.request.arguments else 0
+
+    def set_extra_headers(self, path):
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+        if 'v' in self.request.arguments:
+            self.set_header('Cache-Control', 'public, max-age={0}, immutable'.format(ASSET_MAX_AGE))
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    # Machine readable status for other programs, like the mural coordinator.
+    def get(self):
+        jobs = motor_thread.jobs if motor_thread else None
+        self.write({'ready': plotter is not None,
+                    'settings': current_settings(),
+                    'progress': job_progress,
+                    'queue': jobs.status()['queue'] if jobs else []})
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    # Prometheus text format, for a scraper that charts how the plotter is doing.
+    def get(self):
+        metrics = [('websocket_clients', 'gauge', "Open websocket connections", len(websockets)),
+                   ('cpu_percent', 'gauge', "CPU use of the server process", load_stats['cpu']),
+                   ('ioloop_lag_seconds', 'gauge', "How late the web server ran a scheduled call",
+                    load_stats['ioloop_lag']),
+                   ('job_progress_percent', 'gauge', "Progress of the current plot", job_progress['pct'])]
+        if plotter:
+            stats = plotter.stats
+            metrics += [('control_loop_passes_total', 'counter', "Passes through motor control loops",
+                         stats.loop_passes),
+                        ('control_loop_rate_hz', 'gauge', "Control loop passes per second", load_stats['loop_rate']),
+                        ('moves_total', 'counter', "Moves to a target", stats.moves),
+                        ('moves_per_second', 'gauge', "Moves to a target per second", load_stats['move_rate']),
+                        ('stops_total', 'counter', "Moves that stopped to settle at the target", stats.stops),
+                        ('pen_down_cm_total', 'counter', "Distance driven with the pen down", stats.pen_down_cm),
+                        ('pen_up_cm_total', 'counter', "Distance driven with the pen up", stats.pen_up_cm),
+                        ('plan_queue_depth', 'gauge', "Motor targets planned ahead of the motors", stats.plan_depth),
+                        ('plan_underruns_total', 'counter', "Times the motors waited for the planner",
+                         stats.plan_underruns)]
+            if plotter.chalk:
+                feeder = plotter.chalk_feeder
+                metrics += [('chalk_rate_deg_per_cm', 'gauge', "Chalk extruder degrees per cm drawn", feeder.rate),
+                            ('chalk_left_cm', 'gauge', "Estimated cm of drawing left in the chalk",
+                             feeder.remaining_cm()),
+                            ('chalk_contact_losses_total', 'counter', "Times the chalk lost contact while drawing",
+                             feeder.contact_losses),
+                            ('chalk_ran_out_total', 'counter', "Times the chalk ran out halfway a stroke",
+                             feeder.ran_out)]
+            if plotter.battery.voltage is not None:
+                metrics += [('battery_volts', 'gauge', "Battery voltage", plotter.battery.voltage)]
+        lines = []
+        for name, kind, description, value in metrics:
+            lines += ["# HELP ropeplotter_{0} {1}".format(name, description),
+                      "# TYPE ropeplotter_{0} {1}".format(name, kind),
+                      "ropeplotter_{0} {1}".format(name, value)]
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write("\n".join(lines) + "\n")
+
+
+class CommandHandler(tornado.web.RequestHandler):
+    # Same commands as the websocket, as json in the body of a POST. For programs that don't keep a socket open.
+    def post(self):
+        queue_command(json.loads(self.request.body.decode()))
+        self.write({'queued': True})
 
 
 class UploadHandler(tornado.web.RequestHandler):
@@ -102,7 +371,8 @@ class UploadHandler(tornado.web.RequestHandler):
             fileinfo = self.request.files['file_0'][0]
             fname = fileinfo['filename']
             extension = os.path.splitext(fname)[1]
-            logging.debug(extension, extension.upper())
+            plotter_log.debug("Upload of a {0} file".format(extension))
+            from PIL import Image
             if extension.upper() == '.JPG' or extension.upper() == '.JPEG':
                 plotter_log.debug("started image download")
                 img_file = open("uploads/picture.jpg", 'wb')
@@ -114,6 +384,7 @@ class UploadHandler(tornado.web.RequestHandler):
                 img_file.close()
 
                 plotter_log.debug("file closed")
+                save_thumbnail('uploads/picture.jpg')
                 # im = Image.open(img_file)
                 # logging.debug("image opened")
                 # im = ImageOps.fit(im,(500, 500), Image.ANTIALIAS)
@@ -127,24 +398,31 @@ class UploadHandler(tornado.web.RequestHandler):
                 im = Image.open(img_file)
                 # im = ImageOps.fit(im, (500, 500), Image.ANTIALIAS)
                 im.save("uploads/picture.jpg")
-            elif extension.upper() == '.CSV':
-                output_file = open("uploads/coords.csv", 'wb')
-                output_file.write(fileinfo['body'])
-                output_file.close()
-                coordsfile = open('uploads/coords.csv', 'r')
-                file_body = coordsfile.readlines()
-                pointlist = []
-                for s_coord in file_body:
-                    if ',' in s_coord:
-                        coord = [float(c) * PREVIEW_SIZE for c in s_coord.split(",")]
-                        pointlist += [tuple(coord)]
-                coordsfile.close()
-
-                im_result = Image.new("L", (PREVIEW_SIZE, PREVIEW_SIZE), color=200)
-                draw = ImageDraw.Draw(im_result)
-                draw.line(pointlist, fill=60, width=1)
-                del draw
-                im_result.save('uploads/preview.jpg')
+                save_thumbnail('uploads/picture.jpg')
+            elif extension.upper() in ('.CSV', '.SVG', '.GCODE', '.GC', '.NC', '.NGC'):
+                if extension.upper() == '.CSV':
+                    output_file = open("uploads/coords.csv", 'wb')
+                    output_file.write(fileinfo['body'])
+                    output_file.close()
+                else:
+                    # Vector files become a coords.csv right away, with curves cut up no finer than the
+                    # plotter can draw. After that they're the same as an uploaded csv.
+                    from ropeplotter import RopePlotter
+                    from ropeplotter.vector_import import import_vectors, flattening_tolerance
+                    vector_file = "uploads/vectors" + extension.lower()
+                    with open(vector_file, 'wb') as output_file:
+                        output_file.write(fileinfo['body'])
+                    s = current_settings()
+                    canvas_size = RopePlotter.canvas_geometry(s['ll'], s['lr'], s['aw'])[2]
+                    try:
+                        num_points = import_vectors(vector_file, "uploads/coords.csv",
+                                                    flattening_tolerance(canvas_size, s['cm_to_deg']))
+                    except (ValueError, SyntaxError) as e:
+                        wsSend("Can't read " + fname + ": " + str(e))
+                        self.finish("Can't read file")
+                        return
+                    plotter_log.info("{0} converted to {1} points".format(fname, num_points))
+                save_preview('uploads/coords.csv')
             else:
                 return
 
@@ -154,6 +432,47 @@ class UploadHandler(tornado.web.RequestHandler):
             return
 
 
+def save_thumbnail(picture_file, thumbnail_file='uploads/picture-preview.jpg'):
+    """
+    A small copy of an uploaded picture for the web page, so it doesn't download the whole picture for a preview.
+    """
+    from PIL import Image
+    im = Image.open(picture_file).convert("RGB")
+    im.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    im.save(thumbnail_file)
+
+
+def save_preview(coords_file, preview_file='uploads/preview.jpg'):
+    """
+    Draw a coords.csv small, for the web page.
+    """
+    from PIL import Image, ImageDraw
+    coordsfile = open(coords_file, 'r')
+    file_body = coordsfile.readlines()
+    # An optional third column says whether to draw (1) or travel (0) to a point.
+    # Split the points into strokes, so travel moves don't show up in the preview.
+    strokes = [[]]
+    for s_coord in file_body:
+        if ',' in s_coord:
+            values = s_coord.split(",")
+            coord = (float(values[0]) * PREVIEW_SIZE, float(values[1]) * PREVIEW_SIZE)
+            if len(values) > 2 and not int(float(values[2])):
+                strokes += [[]]
+            strokes[-1] += [coord]
+    coordsfile.close()
+
+    im_result = Image.new("L", (PREVIEW_SIZE, PREVIEW_SIZE), color=200)
+    draw = ImageDraw.Draw(im_result)
+    for pointlist in strokes:
+        if len(pointlist) > 1:
+            draw.line(pointlist, fill=60, width=1)
+        elif pointlist:
+            # A dot, like from stippling
+            draw.point(pointlist, fill=60)
+    del draw
+    im_result.save(preview_file)
+
+
 # Code for handling the data sent from the webpage
 class WSHandler(tornado.websocket.WebSocketHandler):
     def open(self):
@@ -165,9 +484,15 @@ class WSHandler(tornado.websocket.WebSocketHandler):
     def check_origin(self, origin):
         return True
 
-    def on_message(self, message):  # receives the data from the webpage and is stored in the variable message
-        global c
-        c = json.loads(message)
+    def on_message(self, message):  # receives the data from the webpage and queues it for the motor thread
+        command = json.loads(message)
+        if type(command) == dict and 'ping' in command:
+            # Answer right away, so the page can measure how responsive we are.
+            self.write_message(json.dumps({'pong': command['ping']}))
+            if command.get('latency'):
+                load_stats['ws_latency'] = command['latency'] / 1000.0
+            return
+        queue_command(command)
 
     def on_close(self):
         global websockets
@@ -176,7 +501,129 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         plotter_log.info('connection closed...')
 
 
+def queue_command(command):
+    """
+    Single entry point for commands from the web page and the brick buttons.
+    """
+    if type(command) == dict and 'log' in command:
+        # Log levels, like {'log': {'Plotter': 'DEBUG'}}. No need to bother the motor thread.
+        try:
+            wsSend(json.dumps({'log_levels': set_log_levels(command['log'])}))
+        except ValueError as e:
+            wsSend(str(e))
+    elif command == 'chalk-loaded':
+        # The plotter is blocked waiting for this one, so don't queue it behind other commands.
+        if plotter:
+            plotter.chalk_loaded.set()
+    else:
+        commands.put(command)
+
+
+def on_button(name, pressed):
+    command = BUTTON_COMMANDS[name][0 if pressed else 1]
+    if command:
+        queue_command(command)
+
+
+def shutdown():
+    # Runs on the IOLoop. Close all sockets and stop the web server.
+    for ws in websockets:
+        ws.close()
+    web_ioloop.stop()
+
+
+def current_settings():
+    # Same keys as the settings forms on the web page.
+    if plotter is None:
+        # Still starting up
+        return {'kp': KP, 'ti': TI, 'td': TD, 'cm_to_deg': CM_TO_DEG,
+                'll': L_ROPE_0, 'lr': R_ROPE_0, 'aw': ROPE_ATTACHMENT_WIDTH, 'rs': 2.0}
+    return {'kp': plotter.Kp, 'ti': plotter.Ti, 'td': plotter.Td, 'cm_to_deg': plotter.cm_to_deg_setting,
+            'll': plotter.l_rope_0, 'lr': plotter.r_rope_0, 'aw': plotter.att_dist, 'rs': plotter.r_step}
+
+
+def apply_settings(c):
+    if 'kp' in c:
+        #We got pid settings
+        if 'gains' in c:
+            # From a job, with the gains each motor had when it was queued.
+            plotter.set_pid_gains(c['gains'])
+        elif (float(c['kp']), float(c['ti']), float(c['td'])) != (plotter.Kp, plotter.Ti, plotter.Td):
+            # Changed in the form. That sets both motors, also when autotune gave them different gains.
+            plotter.Kp = c['kp']
+            plotter.Ti = c['ti']
+            plotter.Td = c['td']
+        plotter.cm_to_deg = int(c['cm_to_deg'])
+        wsSend("PID parameters set")
+
+    if 'll' in c:
+        #we got rope length settings
+        plotter.l_rope_0 = c['ll']
+        plotter.r_rope_0 = c['lr']
+        plotter.att_dist = c['aw']
+        plotter.r_step = float(c['rs'])
+        wsSend("Plotter settings set")
+
+
+def show_address_on_screen():
+    # Display ip number on screen for easy connection
+    from ropeplotter.hardware import ev3 as ev
+    from PIL import Image, ImageDraw
+    from ropeplotter import get_ip_address
+
+    ip_address = get_ip_address()
+    lcd = ev.Screen()
+    logo = Image.open(os.path.join(BASE_DIR, 'static/logo.jpg'))
+    img = Image.new("1", (128, 178), color=255)
+    img.paste(logo.resize((100, 127)), (14, 0))
+    draw = ImageDraw.Draw(img)
+    draw.text((2, 127), 'Point your browser to:')
+    draw.text((2, 137), '{0}:{1}'.format(ip_address, web_port))
+    draw.text((2, 150), 'press back to exit')
+    del draw
+    lcd.image.paste(img.rotate(-90), box=(0, 0))
+    lcd.update()
+    plotter_log.info("Web server at {0}:{1}".format(ip_address, web_port))
+
+
+def measure_load(cpu_meter, scheduled=None):
+    """
+    Runs on the IOLoop every LOAD_INTERVAL seconds. The IOLoop lag is how much later than scheduled we run.
+    """
+    ioloop = tornado.ioloop.IOLoop.current()
+    if scheduled is not None:
+        lag = ioloop.time() - scheduled
+        load_stats['ioloop_lag'] = lag
+        load_stats['max_ioloop_lag'] = max(lag, load_stats['max_ioloop_lag'])
+    load_stats['cpu'] = cpu_meter.read()
+    load_stats['cpu_sum'] += load_stats['cpu']
+    load_stats['samples'] += 1
+    if plotter:
+        # Rates over the last interval, from the counters of the motor thread
+        stats = plotter.stats
+        load_stats['loop_rate'] = (stats.loop_passes - load_stats['loop_passes']) / LOAD_INTERVAL
+        load_stats['move_rate'] = (stats.moves - load_stats['moves']) / LOAD_INTERVAL
+        load_stats.update(loop_passes=stats.loop_passes, moves=stats.moves)
+    next_time = ioloop.time() + LOAD_INTERVAL
+    ioloop.call_at(next_time, measure_load, cpu_meter, next_time)
+
+
+def reset_load_stats():
+    load_stats.update(cpu_sum=0.0, samples=0, max_ioloop_lag=0.0)
+
+
+def load_report():
+    return "CPU {0:.0f}% on average, IOLoop lag up to {1:.0f}ms, websocket round trip {2:.0f}ms".format(
+        load_stats['cpu_sum'] / max(load_stats['samples'], 1), load_stats['max_ioloop_lag'] * 1000,
+        load_stats['ws_latency'] * 1000)
+
+
 def wsSend(message):
+    # Plots, vectorizing and the buttons send from threads of their own. Tornado only writes from its IOLoop.
+    web_ioloop.add_callback(send_to_websockets, message)
+
+
+def send_to_websockets(message):
     for ws in websockets:
         ws.write_message(message)
 
@@ -184,215 +631,499 @@ def wsSend(message):
 application = tornado.web.Application([
     (r'/ws', WSHandler),
     (r'/', MainHandler),
-    (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": "./static"}),
-    (r"/css/(.*)", tornado.web.StaticFileHandler, {"path": "./css"}),
-    (r"/fonts/(.*)", tornado.web.StaticFileHandler, {"path": "./fonts"}),
-    (r"/uploads/(.*)", tornado.web.StaticFileHandler, {"path": "./uploads"}),
-    (r"/logs/(.*)", tornado.web.StaticFileHandler, {"path": "./logs"}),
+    (r'/status', StatusHandler),
+    (r'/command', CommandHandler),
+    (r'/metrics', MetricsHandler),
+    (r"/static/(.*)", AssetHandler, {"path": os.path.join(BASE_DIR, "static")}),
+    (r"/css/(.*)", AssetHandler, {"path": os.path.join(BASE_DIR, "css")}),
+    (r"/fonts/(.*)", AssetHandler, {"path": os.path.join(BASE_DIR, "fonts")}),
+    (r"/uploads/(.*)", UploadsHandler, {"path": "./uploads"}),
+    (r"/logs/(.*)", UploadsHandler, {"path": "./logs"}),
     (r"/upload", UploadHandler)
-])
+], template_path=BASE_DIR)
 
 
 class MotorThread(threading.Thread):
     """
-    This thread interacts with the plotter via the global 'c' which containts plotter commands.
+    This thread interacts with the plotter via the 'commands' queue which contains plotter commands.
+    Jogging and settings are handled here directly. Plot jobs are handed to a PlotExecutor,
+    which advances them back-to-back in its own thread until it is paused or aborted.
+    When the job queue is started, the next queued job is started as soon as the executor is free.
     """
 
     def __init__(self):
         threading.Thread.__init__(self)
-        self.throttle = Throttler(MOTOR_CMD_RATE)
+        self.executor = None
+        self.jobs = None
+        self.checkpoint = None
+        self.stream = None
+        self.current_job = None     # Job from the queue that's being plotted
+        self.waiting_job = None     # Job that waits for a 'continue' before it starts
+        self.recorder = None        # TraceRecorder of the running job, with --record
+
+    def init_hardware(self):
+        """
+        Heavy imports and motor setup. This runs in the motor thread, while the web server is already serving.
+        """
+        global plotter
+        t_start = time.time()
+        from ropeplotter import RopePlotter, PlotExecutor, ButtonReader, JobQueue, Checkpointer, CpuMeter, FrameServer
+        t_import = time.time()
+
+        # Keep track of CPU use and IOLoop responsiveness
+        web_ioloop.add_callback(measure_load, CpuMeter())
+
+        plotter = RopePlotter(L_ROPE_0, R_ROPE_0, ROPE_ATTACHMENT_WIDTH, Kp=KP, Ki=TI, Kd=TD, cm_to_deg=CM_TO_DEG,
+                              chalk=CHALK, nominal_voltage=NOMINAL_VOLTAGE, settle_precision=SETTLE_PRECISION,
+                              settle_speed=SETTLE_SPEED, brake_time=BRAKE_TIME, rapid_speed=RAPID_SPEED,
+                              rapid_accel=RAPID_ACCEL, rapid_precision=RAPID_PRECISION, chalk_rate=CHALK_RATE,
+                              chalk_reserve=CHALK_RESERVE, plan_ahead=PLAN_AHEAD, fixed_point=FIXED_POINT)
+        if plotter.load_pid_gains(PID_GAINS_FILE):
+            plotter_log.info("Loaded tuned PID gains from " + PID_GAINS_FILE)
+        t_plotter = time.time()
+
+        self.executor = PlotExecutor(on_progress=self.on_progress, on_done=self.on_done)
+        self.jobs = JobQueue('jobs')
+        self.checkpoint = Checkpointer(plotter, 'jobs/checkpoint.json', interval=CHECKPOINT_INTERVAL)
+        self.checkpoint.start()
+
+        # Plots planned on another computer come in as motor targets
+        self.stream = FrameServer(plotter, port=stream_port, buffer_size=STREAM_BUFFER,
+                                  on_connect=lambda: queue_command('stream'))
+        self.stream.start()
+
+        # Brick buttons feed the same command queue as the web page
+        button_reader = ButtonReader(on_change=on_button)
+        button_reader.start()
+        t_ready = time.time()
+
+        show_address_on_screen()
+        t_screen = time.time()
+
+        plotter_log.info("Startup timing: imports {0:.2f}s, motors {1:.2f}s, jobs and buttons {2:.2f}s, "
+                         "screen {3:.2f}s. Hardware ready {4:.2f}s after start.".format(
+                          t_import - t_start, t_plotter - t_import, t_ready - t_plotter, t_screen - t_ready,
+                          t_ready - startup_time))
+        wsSend("Plotter ready")
+
+    @staticmethod
+    def on_progress(pct_done):
+        wsSend(str(pct_done))
+        try:
+            # Some plots report "12.34% done" instead of a number
+            job_progress['pct'] = float(str(pct_done).split('%')[0])
+        except ValueError:
+            pass
+        #wsSend("[ {0:.2f}V ] Plot {1:.2f}% done".format(plotter.battery.measured_voltage/1000000.0, pct_done))
+
+    def on_done(self, name, completed, elapsed, error=None):
+        elapsed_str = time.strftime("%Hh %Mm %Ss", time.gmtime(elapsed))
+        reason = ": {0}".format(error) if error else ""
+        if self.recorder:
+            plotter.stats.recorder = None
+            self.recorder.close(completed)
+            plotter_log.info("Recorded a trace in " + self.recorder.filename)
+            self.recorder = None
+        if self.checkpoint.job is None:
+            # Not a plot, e.g. autotune
+            wsSend("{0}: {1} after {2}{3}".format(name, "done" if completed else "aborted", elapsed_str, reason))
+            if not completed:
+                plotter.stop_all_motors()
+            return
+
+        dwell_saved = plotter.dwell_saved + plotter.pen_motor.dwell_saved
+        plotter_log.info("Settle detection saved {0:.1f}s of brake time".format(dwell_saved))
+        plotter_log.info("Load while plotting: " + load_report())
+        wsSend(load_report())
+        if completed:
+            self.checkpoint.clear()
+            wsSend("Done plotting after {0}. Settle detection saved {1:.1f}s.".format(elapsed_str, dwell_saved))
+        else:
+            # Stop saving, but keep the checkpoint to resume from.
+            self.checkpoint.job = None
+            plotter.stop_all_motors()
+            wsSend("Aborted plotting after " + elapsed_str + reason)
+
+        if self.current_job:
+            self.jobs.set_status(self.current_job['id'], 'done' if completed else 'aborted')
+            if not completed:
+                # Somebody is watching. Let them decide what's next.
+                self.jobs.auto_start = False
+                self.jobs.save()
+            self.current_job = None
+            wsSend(json.dumps(self.jobs.status()))
+
+    def start_job(self, job):
+        apply_settings(job['settings'])
+        self.current_job = job
+        self.jobs.set_status(job['id'], 'running')
+        if not self.start_plot(job['mode'], job['file'],
+                               "Started job {0}: {1} {2}".format(job['id'], job['mode'], job['file']),
+                               job_id=job['id']):
+            self.jobs.set_status(job['id'], 'queued')
+            self.current_job = None
+
+    def resume_checkpoint(self):
+        """
+        Continue the job in the last checkpoint. The plot generators travel there with the pen up.
+        """
+        checkpoint = self.checkpoint.load()
+        if checkpoint is None:
+            wsSend("No checkpoint to resume from")
+            return
+        if self.executor.busy:
+            wsSend("Already plotting. Abort first.")
+            return
+        job, settings = checkpoint['job'], checkpoint['settings']
+        if checkpoint['session'] != self.checkpoint.SESSION:
+            # The server restarted and zeroed the encoders. The plotter should still be where the checkpoint
+            # says, so put the encoder positions and the rope lengths that go with them back.
+            plotter.l_rope_0 = settings['ll']
+            plotter.r_rope_0 = settings['lr']
+            plotter.att_dist = settings['aw']
+            plotter.restore_positions(checkpoint['positions'])
+            wsSend("Restored motor positions from checkpoint at " + checkpoint['time'])
+        if settings['cm_to_deg'] != plotter.cm_to_deg:
+            wsSend("Warning: cm to degrees was {0} in the checkpoint".format(settings['cm_to_deg']))
+        if job['id'] is not None:
+            self.current_job = self.jobs.get(job['id'])
+            self.jobs.set_status(job['id'], 'running')
+        self.start_plot(job['mode'], job['file'], "Resuming {0} at {1}".format(job['file'], checkpoint['progress']),
+                        job_id=job['id'], resume=checkpoint['progress'])
+
+    def start_next_job(self):
+        if not self.jobs.auto_start or self.executor.busy or self.waiting_job:
+            return
+        job = self.jobs.next_job()
+        if job is None:
+            return
+        if job['pause_before']:
+            self.waiting_job = job
+            wsSend("Job {0} is next. Change pen or chalk and send continue.".format(job['id']))
+        else:
+            self.start_job(job)
+
+    def handle_queue_command(self, c):
+        # Commands for the job queue, like {'queue': 'add', 'mode': 'plot', 'pause': True}
+        action = c['queue']
+        try:
+            if action == 'add':
+                mode = c.get('mode', 'plot')
+                if mode not in PLOT_MODES:
+                    raise ValueError("unknown plot mode {0}".format(mode))
+                settings = current_settings()
+                settings['gains'] = plotter.pid_gains()
+                job = self.jobs.add(PLOT_MODES[mode][1], mode, settings,
+                                    pause_before=c.get('pause', False), name=c.get('name'))
+                wsSend("Added job {0} to the queue".format(job['id']))
+            elif action == 'remove':
+                self.jobs.remove(c['id'])
+            elif action == 'move':
+                self.jobs.move(c['id'], c['position'])
+            elif action == 'requeue':
+                self.jobs.requeue(c['id'])
+            elif action == 'clear':
+                self.jobs.clear_done()
+            elif action == 'start':
+                self.jobs.auto_start = True
+                self.jobs.save()
+            elif action == 'stop':
+                # Finish the current job, but don't start another.
+                self.jobs.auto_start = False
+                self.waiting_job = None
+                self.jobs.save()
+        except (KeyError, ValueError, TypeError, IOError, OSError) as e:
+            # A bad id, a missing upload... Tell the page, but keep the motor thread running.
+            plotter_log.warning("Queue command {0} failed: {1}".format(c, e))
+            wsSend("Queue {0} failed: {1}".format(action, e))
+        wsSend(json.dumps(self.jobs.status()))
+
+    def vectorize(self, method, budget):
+        """
+        Turn the uploaded picture into lines for the 'plot' mode, in a thread of its own. It takes a while.
+
+        :param method: key of ropeplotter.image_paths.GENERATORS, like 'stipple'
+        :param budget: max seconds
+        """
+        if self.executor.busy:
+            # Don't take CPU away from the control loops.
+            wsSend("Can't make lines while plotting")
+            return
+
+        def generate():
+            try:
+                from PIL import Image
+                from ropeplotter.image_paths import generate_path
+                from ropeplotter.sharding import write_path
+                points, seconds = generate_path(Image.open('uploads/picture.jpg'), method,
+                                                spacing=plotter.r_step / plotter.canvas_size, budget=budget)
+                # A plot can start on coords.csv any time. Only swap in a complete file.
+                write_path('uploads/coords.csv.tmp', points)
+                os.replace('uploads/coords.csv.tmp', 'uploads/coords.csv')
+                save_preview('uploads/coords.csv')
+            except Exception as e:
+                # Nobody catches this in a thread. Without a message the page waits for the lines forever.
+                plotter_log.exception("Making lines with {0} failed".format(method))
+                wsSend("Making lines with {0} failed: {1}".format(method, e))
+                return
+            plotter_log.info("Made {0} points with {1} in {2:.1f}s".format(len(points), method, seconds))
+            wsSend(json.dumps({'vectorized': method, 'points': len(points), 'seconds': round(seconds, 1)}))
+
+        wsSend("Making lines with {0}, this takes up to {1}s".format(method, budget))
+        threading.Thread(target=generate, name="vectorize", daemon=True).start()
+
+    def dry_run(self, method):
+        """
+        Show what a raster plot of the uploaded picture will look like, without moving the motors.
+
+        :param method: key of ropeplotter.dry_run.DRY_RUNS, like 'optimized_etch'
+        """
+        if self.executor.busy:
+            wsSend("Can't do a dry run while plotting")
+            return
+
+        def render():
+            try:
+                from ropeplotter.dry_run import dry_run
+                image, stats = dry_run(plotter, method, 'uploads/picture.jpg')
+                # Swap in a complete file, in case the page loads it meanwhile
+                image.save('uploads/dry-run.png.tmp', format='PNG')
+                os.replace('uploads/dry-run.png.tmp', 'uploads/dry-run.png')
+                save_thumbnail('uploads/dry-run.png', 'uploads/dry-run-preview.jpg')
+            except Exception as e:
+                plotter_log.exception("Dry run of {0} failed".format(method))
+                wsSend("Dry run of {0} failed: {1}".format(method, e))
+                return
+            plotter_log.info("Dry run of {0}: {1}".format(method, stats))
+            stats['dry-run'] = method
+            wsSend(json.dumps(stats))
+
+        threading.Thread(target=render, name="dry-run", daemon=True).start()
+
+    def start_plot(self, mode, filename=None, message="", job_id=None, resume=None):
+        """
+        Start one of the PLOT_MODES in the executor.
+
+        :param mode: key of PLOT_MODES
+        :param filename: file to plot. Defaults to the last upload for that mode.
+        :param message: str to send when the plot has started
+        :param job_id: id of the job in the queue, if any
+        :param resume: dict from a checkpoint with keyword arguments to resume the plot generator
+        :return: True if started
+        """
+        if self.executor.busy:
+            # Maybe paused. Its progress is still needed to resume it, so don't touch anything.
+            wsSend("Already plotting. Abort first.")
+            return False
+        method, upload = PLOT_MODES[mode]
+        filename = filename or upload
+        plotter.progress = {}
+        plotter.dwell_saved = plotter.pen_motor.dwell_saved = 0.0
+        reset_load_stats()
+        plot_action = getattr(plotter, method)(filename, **(resume or {}))
+        if record_traces:
+            self.record(mode, method, filename, resume)
+        self.executor.start(plot_action, name=message)
+        self.checkpoint.job = {'mode': mode, 'file': filename, 'id': job_id}
+        job_progress.update(id=job_id, name=self.current_job.get('name') if self.current_job else None, pct=0.0)
+        wsSend(message)
+        return True
+
+    def record(self, mode, method, filename, resume):
+        # Before the job starts, so the trace has where the motors were and the first passes.
+        from ropeplotter.replay import TraceRecorder
+        trace_file = os.path.join(TRACE_DIR, "{0}-{1}.trace.gz".format(time.strftime("%Y%m%d-%H%M%S"), mode))
+        self.recorder = TraceRecorder(plotter, trace_file)
+        self.recorder.begin(mode, method, filename, resume)
+        plotter.stats.recorder = self.recorder
 
     def run(self):
-        global c, plotter
-        buttons = ev.Button()
-        right_or_up_pressed_earlier = False
-        left_or_down_pressed_earlier = False
+        try:
+            self.init_hardware()
+        except Exception as e:
+            # The web server keeps running, so say why nothing moves instead of dying silently.
+            plotter_log.exception("Hardware setup failed")
+            wsSend("Hardware setup failed: {0}".format(e))
+            return
 
         while running:
+            try:
+                c = commands.get(timeout=1.0 / MOTOR_CMD_RATE)
+            except queue.Empty:
+                c = ''
 
             if type(c) == dict:
                 # We got settings
-                if 'kp' in c:
-                    #We got pid settings
-                    plotter.Kp = c['kp']
-                    plotter.Ti = c['ti']
-                    plotter.Td = c['td']
-                    plotter.cm_to_deg = int(c['cm_to_deg'])
-                    wsSend("PID parameters set")
-
-                if 'll' in c:
-                    #we got rope length settings
-                    plotter.l_rope_0 = c['ll']
-                    plotter.r_rope_0 = c['lr']
-                    plotter.att_dist = c['aw']
-                    plotter.r_step = float(c['rs'])
-                    wsSend("Plotter settings set")
-                c=''
+                if 'queue' in c:
+                    self.handle_queue_command(c)
+                elif 'vectorize' in c:
+                    self.vectorize(c['vectorize'], c.get('budget', VECTORIZE_BUDGET))
+                elif 'dry-run' in c:
+                    self.dry_run(c['dry-run'])
+                else:
+                    apply_settings(c)
+                c = ''
 
-            # Socket commands
-            if c == 'left-fwd':
-                plotter.left_fwd()
+            self.start_next_job()
 
-            elif c == 'left-back':
-                plotter.left_back()
+            # Plot job commands. These work while plotting.
+            if c == 'pause':
+                self.executor.pause()
+                wsSend("Paused")
 
-            elif c == 'right-fwd':
-                plotter.right_fwd()
+            elif c in ('resume', 'plotting'):
+                self.executor.resume()
+                wsSend("Resumed")
 
-            elif c == 'right-back':
-                plotter.right_back()
+            elif c == 'abort':
+                self.executor.abort()
+
+            elif c == 'continue' and self.waiting_job:
+                job, self.waiting_job = self.waiting_job, None
+                self.start_job(job)
+
+            elif c == 'stream':
+                plot_action = plotter.plot_from_frames(self.stream.frames(), self.stream.total)
+                if self.executor.start(plot_action, name="Streaming from " + self.stream.host):
+                    wsSend("Plotting frames from " + self.stream.host)
+                else:
+                    # Already plotting. Let the host know by hanging up.
+                    wsSend("Already plotting. Refused frames from " + self.stream.host)
+                    self.stream.close()
+
+            elif c == 'quit':
+                self.executor.abort()
+                web_ioloop.add_callback(shutdown)
 
-            elif buttons.right:
+            elif c == 'stop':
+                # Pause any running plot and halt the drive motors.
+                self.executor.pause()
+                plotter.left_stop()
+                plotter.right_stop()
+
+            # Don't touch the motors while a plot is running, only when idle or paused.
+            elif self.executor.busy and not self.executor.paused:
+                pass
+
+            # Socket commands
+            elif c == 'left-fwd':
                 plotter.left_fwd()
-                right_or_up_pressed_earlier = True
 
-            elif buttons.up:
+            elif c == 'left-back':
                 plotter.left_back()
-                right_or_up_pressed_earlier = True
 
-            elif buttons.down:
+            elif c == 'right-fwd':
                 plotter.right_fwd()
-                left_or_down_pressed_earlier = True
 
-            elif buttons.left:
+            elif c == 'right-back':
                 plotter.right_back()
-                left_or_down_pressed_earlier = True
-
-            elif not (buttons.left and buttons.down) and left_or_down_pressed_earlier:
-                plotter.right_stop()
-                left_or_down_pressed_earlier = False
-
-            elif not (buttons.right and buttons.up) and right_or_up_pressed_earlier:
-                plotter.left_stop()
-                right_or_up_pressed_earlier = False
 
             elif c == 'right-stop':
                 plotter.right_stop()
-                c = ''
 
             elif c == 'left-stop':
                 plotter.left_stop()
-                c = ''
 
             elif c == 'pu':
                 plotter.pen_up()
-                c = ''
 
             elif c == 'pd':
                 plotter.pen_down()
-                c = ''
-
-            elif c == 'stop':
-                plotter.left_stop()
-                plotter.right_stop()
-                c = ''
 
             elif c == 'reload':
                 plotter.reload_chalk()
 
             elif c == 'testdrive':
                 plotter.test_drive()
-                c = ''
-
-            elif c == 'plot':
-                start_time = time.time()
-                # c stays 'plot' until another command is sent trough the socket
-                plot_action = plotter.plot_from_file('uploads/coords.csv')
-                c = 'plotting'
-
-            elif c == 'plotting':
-                try:
-                    pct_done = next(plot_action)
-                    wsSend(str(pct_done))
-                    #wsSend("[ {0:.2f}V ] Plot {1:.2f}% done".format(plotter.battery.measured_voltage/1000000.0, pct_done))
-                except StopIteration:
-                    c = ''
-                    if start_time:
-                        elapsed = time.time()-start_time
-                        elapsed_str = time.strftime("%Hh %Mm %Ss", time.gmtime(elapsed))
-                        wsSend("Done plotting after " + elapsed_str)
 
             elif c == 'zero':
                 wsSend("zero motor positions")
                 plotter.set_control_zeroes()
-                c = ''
+
+            elif c == 'plot':
+                self.start_plot(c, message="Plotting coordinates")
+
             elif c == 'plotcircles':
-                start_time = time.time()
-                wsSend("Plotting circles")
-                # c stays 'plot' until another command is sent trough the socket
-                plot_action = plotter.optimized_etch()
-                c = 'plotting'
+                self.start_plot(c, message="Plotting circles")
+
             elif c == 'plotwaves':
-                wsSend("Plotting waves")
-                # c stays 'plot' until another command is sent trough the socket
-                plot_action = plotter.plot_circle_waves()
-                c = 'plotting'
+                self.start_plot(c, message="Plotting waves")
+
+            elif c == 'resume-checkpoint':
+                self.resume_checkpoint()
 
-            # Button commands
-            if buttons.backspace:
-                tornado.ioloop.IOLoop.instance().stop()
-                # Close all sockets
-                for ws in websockets:
-                    ws.close()
+            elif c == 'autotune':
+                if self.executor.start(plotter.autotune(PID_GAINS_FILE), name="autotune"):
+                    wsSend("Tuning PID of the drive motors")
 
-            self.throttle.throttle()  # Don't go too fast.
 
         # Stopped running. Shutting down all motors.
+        self.executor.abort()
+        self.executor.join(timeout=5)
         plotter.stop_all_motors()
         plotter_log.info("Socket thread stopped")
 
 
 ################## Main #############################
 
+motor_thread = None
+web_ioloop = None   # Other threads hand work to the web server through this one. IOLoop.current() is per thread.
+
 if __name__ == "__main__":
-    # Start motor thread
-    running = True
-    motor_thread = MotorThread()
-    motor_thread.setDaemon(True)
-    motor_thread.start()
+    parser = argparse.ArgumentParser(description="Web server for the rope plotter")
+    parser.add_argument('--port', type=int, default=web_port, help="port to serve on")
+    parser.add_argument('--stream-port', type=int, default=stream_port, help="port for frames planned on a host")
+    parser.add_argument('--stub', action='store_true', help="simulate the motors, to run without a brick")
+    parser.add_argument('--root', help="directory for uploads, jobs and logs")
+    parser.add_argument('--record', action='store_true', help="record a trace of every plot job, see replay_trace.py")
+    parser.add_argument('-v', '--verbose', action='store_true', help="more logging, also on the console")
+    parser.add_argument('--log-level', action='append', default=[], metavar='NAME=LEVEL',
+                        help="log level of a subsystem, e.g. Plotter=DEBUG. Can be given more than once.")
+    args, other_args = parser.parse_known_args()
+    web_port = args.port
+    stream_port = args.stream_port
+    record_traces = args.record
+    if args.stub:
+        # ropeplotter isn't imported yet. The motor thread does that.
+        os.environ['ROPEPLOTTER_STUB'] = '1'
+    if args.root:
+        os.chdir(args.root)
+    for directory in ('uploads', 'logs'):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
 
     # Set logging levels
-    if len(sys.argv) > 1: # Whatever argument is enough the lower log levels...
-        log_level = logging.DEBUG
-    else:
-        log_level = logging.CRITICAL
-
-    access_log = logging.getLogger("tornado.access")
-    app_log = logging.getLogger("tornado.application")
-    gen_log = logging.getLogger("tornado.general")
-    access_log.setLevel(log_level)
-    app_log.setLevel(log_level)
-    gen_log.setLevel(log_level)
-    plotter_log.setLevel(logging.INFO)
-
-    # Prepare the screen
-    lcd = ev.Screen()
-    logo = Image.open('static/logo.jpg')
-    img = Image.new("1", (128, 178), color=255)
-    img.paste(logo.resize((100, 127)), (14, 0))
-    draw = ImageDraw.Draw(img)
-    draw.text((2, 127), 'Point your browser to:')
-    draw.text((2, 137), '{0}:9093'.format(get_ip_address()))
-    draw.text((2, 150), 'press back to exit')
-    del draw
-    lcd.image.paste(img.rotate(-90), box=(0, 0))
+    verbose = args.verbose or bool(other_args)   # Whatever argument is enough the lower log levels...
+    setup_logging(verbose)
+    levels = dict(LOG_LEVELS)
+    if verbose:
+        levels.update([(name, 'DEBUG') for name in levels])
+    levels.update(parse_log_levels(args.log_level))
+    set_log_levels(levels)
 
     # Set up web server
-    application.listen(9093)  # starts the web sockets connection
-    logging.info("Started web server at {0}:9093".format(get_ip_address()))
+    precompress_assets([os.path.join(BASE_DIR, directory) for directory in ('static', 'css', 'fonts')])
+    application.listen(web_port)  # starts the web sockets connection
+    plotter_log.info("Started web server on port {0} {1:.2f}s after start".format(web_port, time.time() - startup_time))
 
-    # Display ip number on screen for easy connection
-    lcd.update()
+    web_ioloop = tornado.ioloop.IOLoop.current()
+
+    # Start motor thread. It sets up the hardware and puts our address on the screen.
+    running = True
+    motor_thread = MotorThread()
+    motor_thread.setDaemon(True)
+    motor_thread.start()
 
     try:
-        tornado.ioloop.IOLoop.instance().start()
+        web_ioloop.start()
     except KeyboardInterrupt:   # Triggered by pressing Ctrl+C. Time to clean up.
         running = False         # Stop motor thread
         for ws in websockets:   # Close all sockets
             ws.close()
 
     except:
-        logging.critical("Unexpected error:", sys.exc_info()[0])
+        plotter_log.exception("Unexpected error")
         raise
-
-    logging.info("Stopped. Bye!")
+    finally:
+        plotter_log.info("Stopped. Bye!")
+        log_listener.stop()     # Writes what's left in the queue
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+__author__ = 'anton'
+
+# Times the float and the integer kinematics of RopePlotter on the same points, and how far apart they are.
+#
+# Run it on the brick, to see which one to use there (FIXED_POINT in settings.py). Points along a path are
+# like the control loop, where the pen moves a little per pass. Random points are like jumping around.
+#
+# USAGE
+#   python3 benchmark_kinematics.py
+#   python3 benchmark_kinematics.py --points 2000 --cm-to-deg -175
+
+import os
+# Only the kinematics are needed, never the motors.
+os.environ.setdefault('ROPEPLOTTER_STUB', '1')
+
+import argparse
+import math
+import random
+import time
+
+from ropeplotter import RopePlotter
+from settings import L_ROPE_0, R_ROPE_0, ROPE_ATTACHMENT_WIDTH, CM_TO_DEG
+
+
+def timed(function, inputs):
+    # Microseconds per call
+    t_start = time.time()
+    results = [function(*arguments) for arguments in inputs]
+    return results, (time.time() - t_start) * 1000000.0 / len(inputs)
+
+
+def compare(plotter, name, coords):
+    positions = [plotter.motor_targets_from_coords(x, y) for x, y in coords]
+    times = {}
+    results = {}
+    for fixed_point in (False, True):
+        plotter.fixed_point = fixed_point
+        targets, targets_us = timed(plotter.motor_targets_from_coords, coords)
+        norm_coords, coords_us = timed(plotter.coords_from_motor_pos, positions)
+        times[fixed_point] = targets_us, coords_us
+        results[fixed_point] = targets, norm_coords
+
+    # Differences in encoder degrees. Coordinates are normalized, so those go through the canvas size in cm.
+    target_error = max(max(abs(a - b) for a, b in zip(float_target, fixed_target))
+                       for float_target, fixed_target in zip(results[False][0], results[True][0]))
+    coords_error = max(math.hypot(a[0] - b[0], a[1] - b[1]) for a, b in zip(results[False][1], results[True][1]))
+    coords_error *= plotter.canvas_size * abs(plotter.cm_to_deg)
+
+    print("{0}, {1} points:".format(name, len(coords)))
+    print("  {0:24} {1:>10} {2:>10} {3:>8} {4:>14}".format("", "float us", "int us", "speedup", "max diff deg"))
+    for i, (label, error) in enumerate((("motor_targets_from_coords", target_error),
+                                        ("coords_from_motor_pos", coords_error))):
+        print("  {0:24} {1:>10.1f} {2:>10.1f} {3:>7.2f}x {4:>14.2f}".format(
+            label, times[False][i], times[True][i], times[False][i] / times[True][i], error))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the float and the integer kinematics")
+    parser.add_argument('--points', type=int, default=5000, help="points per test")
+    parser.add_argument('--cm-to-deg', type=int, default=CM_TO_DEG, help="default: CM_TO_DEG from settings.py")
+    args = parser.parse_args()
+
+    plotter = RopePlotter(L_ROPE_0, R_ROPE_0, ROPE_ATTACHMENT_WIDTH, cm_to_deg=args.cm_to_deg)
+    random.seed(1)
+    jumps = [plotter.normalized_to_global_coords(random.random(), random.random()) for i in range(args.points)]
+    # A spiral with about a cm between points, like a control loop at speed.
+    path = [plotter.normalized_to_global_coords(0.5 + 0.45 * t * math.cos(t * 40), 0.5 + 0.45 * t * math.sin(t * 40))
+            for t in [float(i) / args.points for i in range(args.points)]]
+
+    compare(plotter, "Along a path", path)
+    compare(plotter, "Random points", jumps)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+__author__ = 'anton'
+
+# Times travel moves against plain moves to the same targets, over long traverses. Travel moves are there
+# to get somewhere quicker with the pen up, so this exits with 1 when one of them is slower.
+#
+# Without a brick it runs on simulated motors in virtual time. That takes seconds and gives the same
+# numbers every time. On the brick, ROPEPLOTTER_STUB=0 times the real motors. Those drive all over the
+# canvas and back to where they started between moves, so zero the plotter at the origin first.
+#
+# USAGE
+#   python3 benchmark_travel.py
+#   python3 benchmark_travel.py --rapid-accel 4000
+#   ROPEPLOTTER_STUB=0 python3 benchmark_travel.py
+
+import os
+# Simulated motors, unless asked for the real ones.
+os.environ.setdefault('ROPEPLOTTER_STUB', '1')
+
+import argparse
+import sys
+import time
+
+from ropeplotter import RopePlotter
+from ropeplotter.hardware import STUB
+from ropeplotter.replay import VirtualClock, virtual_time
+from settings import L_ROPE_0, R_ROPE_0, ROPE_ATTACHMENT_WIDTH, CM_TO_DEG, KP, TI, TD, BRAKE_TIME, \
+    SETTLE_PRECISION, SETTLE_SPEED, RAPID_SPEED, RAPID_ACCEL, RAPID_PRECISION
+
+TRAVERSES = ((0.1, 0.1), (0.5, 0.2), (0.9, 0.9))     # Normalized coordinates, from the origin
+
+
+def timed(clock, move, targets):
+    t_start = clock.time()
+    move(targets, brake=True)
+    return clock.time() - t_start
+
+
+def compare(plotter, clock):
+    """
+    :return: True if every travel was at least as quick as the plain move
+    """
+    home = [motor.position for motor in plotter.drive_motors]
+    quicker = True
+    print("  {0:12} {1:>16} {2:>10} {3:>10}".format("to", "degrees", "move s", "travel s"))
+    for x_norm, y_norm in TRAVERSES:
+        targets = plotter.motor_targets_from_norm_coords(x_norm, y_norm)
+        move_time = timed(clock, plotter.move_to_targets, targets)
+        plotter.move_to_targets(home, brake=True)
+        travel_time = timed(clock, plotter.travel_to_targets, targets)
+        plotter.move_to_targets(home, brake=True)
+        quicker &= travel_time <= move_time
+        print("  {0:12} {1:>16} {2:>10.2f} {3:>10.2f} {4}".format(
+            "{0}, {1}".format(x_norm, y_norm), "{0}, {1}".format(*targets), move_time, travel_time,
+            "" if travel_time <= move_time else "SLOWER"))
+    return quicker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare travel moves with plain moves")
+    parser.add_argument('--rapid-speed', type=float, default=RAPID_SPEED, help="default: RAPID_SPEED from settings.py")
+    parser.add_argument('--rapid-accel', type=float, default=RAPID_ACCEL, help="default: RAPID_ACCEL from settings.py")
+    args = parser.parse_args()
+
+    def run(clock):
+        plotter = RopePlotter(L_ROPE_0, R_ROPE_0, ROPE_ATTACHMENT_WIDTH, Kp=KP, Ki=TI, Kd=TD, cm_to_deg=CM_TO_DEG,
+                              brake_time=BRAKE_TIME, settle_precision=SETTLE_PRECISION, settle_speed=SETTLE_SPEED,
+                              rapid_speed=args.rapid_speed, rapid_accel=args.rapid_accel,
+                              rapid_precision=RAPID_PRECISION)
+        print("Travel at {0:.0f} deg/s, slowing down at {1:.0f} deg/s/s, {2}:".format(
+            plotter.rapid_speed, plotter.rapid_accel, "simulated" if STUB else "real motors"))
+        return compare(plotter, clock)
+
+    if STUB:
+        with virtual_time(VirtualClock(time.time())) as clock:
+            quicker = run(clock)
+    else:
+        quicker = run(time)
+    if not quicker:
+        print("Travel moves are slower than plain moves. Try another RAPID_ACCEL.")
+        sys.exit(1)
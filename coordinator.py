@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+__author__ = 'anton'
+
+# Plots one big mural with several rope plotters side by side on the same wall.
+#
+# Every plotter runs its own 3nsor-plotter.py. This script reads their settings, splits the mural
+# over them, uploads each plotter's part, queues it and follows the progress until all are done.
+#
+# USAGE
+#   python3 coordinator.py mural.json picture.jpg --mode plotcircles
+#   python3 coordinator.py mural.json coords.csv
+#   python3 coordinator.py mural.json coords.csv --dry-run     (only split, look at the tiles dir)
+#
+# mural.json says where everything is on the wall, in cm from the same origin:
+# {
+#   "mural": {"x": 20, "y": 60, "width": 400},
+#   "cell_size": 20,
+#   "plotters": [{"name": "left", "url": "http://192.168.1.10:9093", "x": 0, "y": 0},
+#                {"name": "right", "url": "http://192.168.1.11:9093", "x": 200, "y": 0}]
+# }
+# x and y of a plotter are where its left rope is attached. The mural x and y are its top left corner.
+# A coords.csv mural is normalized to a square of width by width, a picture keeps its aspect ratio.
+#
+# To try it without plotters, start some servers with simulated motors, each in its own directory:
+#   python3 3nsor-plotter.py --stub --port 9093 --root /tmp/left
+#   python3 3nsor-plotter.py --stub --port 9094 --root /tmp/right
+
+import os
+# Only the kinematics of the plotter are needed here, never the motors.
+os.environ.setdefault('ROPEPLOTTER_STUB', '1')
+
+import argparse
+import json
+import logging
+import sys
+import time
+import uuid
+from urllib.request import urlopen, Request
+
+from ropeplotter.sharding import MuralPlotter, make_cells, read_path, write_path, clip_path, path_work, \
+    raster_work, tile_image, assign_cells, overall_progress, RASTER_LEVELS
+
+coordinator_log = logging.getLogger("Coordinator")
+
+FINISHED = ('done', 'aborted', 'interrupted')
+
+
+def get_status(url):
+    with urlopen(url + '/status', timeout=10) as response:
+        return json.loads(response.read().decode())
+
+
+def send_command(url, command):
+    request = Request(url + '/command', data=json.dumps(command).encode(),
+                      headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=10) as response:
+        return response.read()
+
+
+def upload(url, filename):
+    # Same multipart form as the upload forms on the web page.
+    boundary = uuid.uuid4().hex
+    with open(filename, 'rb') as f:
+        body = f.read()
+    data = ("--{0}\r\nContent-Disposition: form-data; name=\"file_0\"; filename=\"{1}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n").format(boundary, os.path.basename(filename)).encode()
+    data += body + "\r\n--{0}--\r\n".format(boundary).encode()
+    request = Request(url + '/upload', data=data,
+                      headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+    with urlopen(request, timeout=60) as response:
+        return response.read()
+
+
+def split_path(filename, mural, cells, plotters, tiles_dir):
+    """
+    Give every plotter the drawn lines in its cells, as a coords.csv in its own canvas coordinates.
+    """
+    size = mural['width']
+    points = [(mural['x'] + x * size, mural['y'] + y * size, pen) for x, y, pen in read_path(filename)]
+    unreachable = assign_cells(cells, [path_work(points, cell) for cell in cells], plotters)
+    for plotter in plotters:
+        if plotter.cells:
+            tile = [plotter.to_norm(x, y) + (pen,) for x, y, pen in clip_path(points, plotter.cells)]
+            write_path(os.path.join(tiles_dir, plotter.name + '.csv'), tile)
+    return unreachable
+
+
+def split_image(filename, mode, mural, cells, plotters, tiles_dir):
+    """
+    Give every plotter a picture of its whole canvas, with its cells of the mural and white elsewhere.
+    """
+    from PIL import Image
+    image = Image.open(filename).convert("L")
+    rect = mural_rect(mural, image.size)
+    works = [raster_work(image, rect, cell, RASTER_LEVELS[mode]) for cell in cells]
+    unreachable = assign_cells(cells, works, plotters)
+    for plotter in plotters:
+        if plotter.cells:
+            tile_image(image, rect, plotter).save(os.path.join(tiles_dir, plotter.name + '.jpg'), quality=95)
+    return unreachable
+
+
+def mural_rect(mural, image_size=None):
+    width = mural['width']
+    height = width * image_size[1] / float(image_size[0]) if image_size else width
+    return mural['x'], mural['y'], mural['x'] + width, mural['y'] + height
+
+
+def follow(plotters, interval):
+    """
+    Poll the plotters until all their jobs are finished. Logs the overall progress.
+    """
+    while True:
+        for plotter in plotters:
+            try:
+                status = get_status(plotter.url)
+            except IOError as e:
+                coordinator_log.warning("{0} doesn't answer: {1}".format(plotter.name, e))
+                continue
+            for job in status['queue']:
+                if job.get('name') == plotter.job_name:
+                    plotter.status = job['status']
+                    if job['status'] == 'done':
+                        plotter.progress = 1.0
+                    elif job['status'] == 'running' and status['progress']['id'] == job['id']:
+                        plotter.progress = status['progress']['pct'] / 100.0
+
+        coordinator_log.info("{0:.1f}% done. ".format(overall_progress(plotters) * 100) +
+                             ", ".join(["{0}: {1} {2:.0f}%".format(p.name, p.status, p.progress * 100)
+                                        for p in plotters]))
+        if all([plotter.status in FINISHED for plotter in plotters]):
+            break
+        time.sleep(interval)
+
+    for plotter in plotters:
+        if plotter.status != 'done':
+            coordinator_log.warning("{0} did not finish its part: {1}".format(plotter.name, plotter.status))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a mural over several rope plotters")
+    parser.add_argument('config', help="json file with the positions of the mural and the plotters")
+    parser.add_argument('file', help="coords.csv or a picture")
+    parser.add_argument('--mode', choices=['plot', 'plotcircles', 'plotwaves'],
+                        help="plot mode. Default: plot for csv files, plotcircles for pictures")
+    parser.add_argument('--tiles', default='tiles', help="directory for the parts of the mural")
+    parser.add_argument('--dry-run', action='store_true', help="only split the mural, don't send it")
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between progress checks")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s - %(message)s',
+                        datefmt="%H:%M:%S")
+
+    with open(args.config) as f:
+        config = json.load(f)
+    mode = args.mode or ('plot' if args.file.lower().endswith('.csv') else 'plotcircles')
+    if not os.path.isdir(args.tiles):
+        os.makedirs(args.tiles)
+
+    # Every plotter has its own rope lengths, so ask them.
+    plotters = []
+    for p in config['plotters']:
+        status = get_status(p['url'])
+        plotters.append(MuralPlotter(p['name'], p['url'], p['x'], p['y'], status['settings']))
+
+    mural = config['mural']
+    if mode == 'plot':
+        rect = mural_rect(mural)
+        cells = make_cells(rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1], config.get('cell_size', 20))
+        unreachable = split_path(args.file, mural, cells, plotters, args.tiles)
+    else:
+        from PIL import Image
+        rect = mural_rect(mural, Image.open(args.file).size)
+        cells = make_cells(rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1], config.get('cell_size', 20))
+        unreachable = split_image(args.file, mode, mural, cells, plotters, args.tiles)
+
+    for plotter in plotters:
+        coordinator_log.info("{0}: {1} cells, about {2}".format(
+            plotter.name, len(plotter.cells), time.strftime("%Hh %Mm %Ss", time.gmtime(plotter.load))))
+    if unreachable:
+        coordinator_log.warning("{0} cells with something to plot are out of reach of all plotters".format(
+            len(unreachable)))
+
+    if args.dry_run:
+        sys.exit()
+
+    job_prefix = "mural-{0}-".format(time.strftime("%H%M%S"))
+    busy = [plotter for plotter in plotters if plotter.cells]
+    for plotter in busy:
+        plotter.job_name = job_prefix + plotter.name
+        tile = os.path.join(args.tiles, plotter.name + ('.csv' if mode == 'plot' else '.jpg'))
+        upload(plotter.url, tile)
+        send_command(plotter.url, {'queue': 'add', 'mode': mode, 'name': plotter.job_name})
+        send_command(plotter.url, {'queue': 'start'})
+        coordinator_log.info("Sent {0} to {1}".format(tile, plotter.name))
+
+    follow(busy, args.interval)
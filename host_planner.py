@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+__author__ = 'anton'
+
+# Plots with the planning done on this computer instead of on the brick.
+#
+# The brick only has to drive to the motor targets it gets. This script reads the file, does the
+# kinematics and streams the targets to the frame server of 3nsor-plotter.py (port 9095).
+#
+# USAGE
+#   python3 host_planner.py 192.168.1.10 coords.csv
+#   python3 host_planner.py 192.168.1.10 picture.jpg --threshold 100
+
+import os
+# Only the kinematics of the plotter are needed here, never the motors.
+os.environ.setdefault('ROPEPLOTTER_STUB', '1')
+
+import argparse
+import logging
+import sys
+import time
+
+from ropeplotter import RopePlotter
+from ropeplotter.planning import plan_path, raster_points
+from ropeplotter.sharding import read_path
+from ropeplotter.streaming import FrameClient
+
+planner_log = logging.getLogger("Planner")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan a plot here and stream it to the plotter")
+    parser.add_argument('host', help="address of the brick")
+    parser.add_argument('file', help="coords.csv or a picture")
+    parser.add_argument('--port', type=int, default=9095, help="port of the frame server on the brick")
+    parser.add_argument('--threshold', type=int, default=128, help="pictures: pixels darker than this are hatched")
+    parser.add_argument('--step', type=float, default=1.0, help="pictures: cm between points on a hatch line")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s - %(message)s',
+                        datefmt="%H:%M:%S")
+
+    client = FrameClient(args.host, args.port)
+    geometry = client.geometry
+    plotter = RopePlotter(geometry['ll'], geometry['lr'], geometry['aw'], cm_to_deg=geometry['cm_to_deg'])
+    plotter.r_step = geometry.get('rs', plotter.r_step)
+
+    t_start = time.time()
+    if args.file.lower().endswith('.csv'):
+        points = read_path(args.file)
+    else:
+        from PIL import Image
+        points = raster_points(plotter, Image.open(args.file).convert("L"), args.threshold, args.step)
+    frames = plan_path(plotter, points)
+    planner_log.info("Planned {0} frames in {1:.2f}s".format(len(frames), time.time() - t_start))
+
+    progress = {'pct': 0}
+
+    def on_ack(seq, left, right):
+        pct = (seq + 1) * 100 // len(frames)
+        if pct >= progress['pct'] + 5:
+            progress['pct'] = pct
+            planner_log.info("{0}% done. Motors at {1}, {2}".format(pct, left, right))
+
+    t_start = time.time()
+    if client.stream(frames, on_ack=on_ack):
+        planner_log.info("Done after {0:.1f}s".format(time.time() - t_start))
+    else:
+        planner_log.warning("The plotter stopped after {0:.1f}s".format(time.time() - t_start))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+__author__ = 'anton'
+
+# Replays a trace that the server recorded with --record on simulated motors, and compares the two.
+#
+# Change PIDControl, move_to_targets or the raster loops, replay a few traces and see if the plot got
+# slower, settles longer, overshoots more or draws somewhere else. Replays take virtual time, so a trace of
+# an hour at the wall replays in about a minute, and the same code gives the same numbers every time.
+#
+# The stub motors aren't the real ones, so the first replay is compared with the recording. Save it as a
+# baseline and the next replays are compared with that, which is what shows a regression.
+#
+# USAGE
+#   python3 replay_trace.py traces/20240510-201500-plot.trace.gz
+#   python3 replay_trace.py traces/*.trace.gz --save-baseline
+#   python3 replay_trace.py traces/*.trace.gz --tolerance 0.1
+#
+# Exits with 1 if a metric got worse than the baseline by more than the tolerance.
+
+import os
+# Replays drive simulated motors only.
+os.environ.setdefault('ROPEPLOTTER_STUB', '1')
+
+import argparse
+import json
+import sys
+import time
+
+from ropeplotter.replay import replay, regressions, METRICS
+
+
+def baseline_file(trace_file):
+    return trace_file + '.baseline.json'
+
+
+def show(value):
+    return "-" if value is None else "{0:.3f}".format(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay plot job traces on simulated motors")
+    parser.add_argument('traces', nargs='+', help="traces recorded with 3nsor-plotter.py --record")
+    parser.add_argument('--tolerance', type=float, default=0.05, help="fraction a metric may get worse")
+    parser.add_argument('--save-baseline', action='store_true', help="compare the next replays with this one")
+    args = parser.parse_args()
+
+    failed = []
+    for trace_file in args.traces:
+        t_start = time.time()
+        recorded, replayed = replay(trace_file)
+        print("{0}: replayed {1} moves in {2:.1f}s{3}".format(trace_file, replayed['moves'], time.time() - t_start,
+                                                             "" if replayed['completed'] else ". The job didn't finish."))
+
+        if os.path.exists(baseline_file(trace_file)):
+            with open(baseline_file(trace_file)) as f:
+                baseline = json.load(f)
+        else:
+            baseline = recorded
+        worse = regressions(baseline, replayed, args.tolerance)
+
+        print("  {0:22} {1:>10} {2:>10} {3:>10} {4:>8}".format("", "recorded", "baseline", "replay", "change"))
+        for key, label, unit, slack in METRICS:
+            change = ""
+            if baseline.get(key) and replayed.get(key) is not None:
+                change = "{0:+.1f}%".format((replayed[key] - baseline[key]) * 100.0 / baseline[key])
+            print("  {0:22} {1:>10} {2:>10} {3:>10} {4:>8} {5}".format(
+                "{0} ({1})".format(label, unit), show(recorded.get(key)),
+                show(baseline.get(key)) if baseline is not recorded else "", show(replayed.get(key)), change,
+                "WORSE" if key in worse else ""))
+
+        if args.save_baseline:
+            with open(baseline_file(trace_file), 'w') as f:
+                json.dump(replayed, f, indent=1)
+            print("  Saved as baseline")
+        elif worse:
+            failed.append(trace_file)
+
+    if failed:
+        print("Worse than the baseline: " + ", ".join(failed))
+        sys.exit(1)
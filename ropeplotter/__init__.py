@@ -1,2 +1,5 @@
 from ropeplotter.core import RopePlotter
-from ropeplotter.robot_helpers import *
\ No newline at end of file
+from ropeplotter.robot_helpers import *
+from ropeplotter.job_queue import JobQueue
+from ropeplotter.checkpoint import Checkpointer
+from ropeplotter.streaming import FrameServer
\ No newline at end of file
@@ -0,0 +1,111 @@
+__author__ = 'anton'
+
+import json
+import math
+import os
+import time
+
+
+class RelayAutotuner(object):
+    """
+    Finds PID gains for a PIDMotor with the relay feedback method of Astrom and Hagglund.
+
+    The motor is driven with a fixed duty cycle towards its start position, switching sign every time it
+    crosses it. This makes it oscillate a few degrees around the start position. From the amplitude and
+    the period of that oscillation we get the ultimate gain Ku and the ultimate period Tu. Those go into the
+    'no overshoot' version of the Ziegler-Nichols rules.
+
+    Usage:
+
+    tuner = RelayAutotuner(plotter.left_motor)
+    for message in tuner.run():
+        print(message)
+    Kp, Ti, Td = tuner.gains()
+    """
+
+    def __init__(self, motor, relay_power=40, hysteresis=3, cycles=6, timeout=20.0, sample_time=0.005):
+        self.motor = motor
+        self.relay_power = relay_power      # duty cycle of the relay
+        self.hysteresis = hysteresis        # degrees, against switching on encoder noise
+        self.cycles = cycles                # number of full oscillations to measure
+        self.timeout = timeout
+        self.sample_time = sample_time
+        self.Ku = None
+        self.Tu = None
+
+    def run(self):
+        """
+        Generator that runs the relay test. Yields status messages after each oscillation, so it can be
+        aborted in between.
+        """
+        motor = self.motor
+        start = motor.position
+        output = self.relay_power
+        switch_times = []
+        high = low = start
+        end_time = time.time() + self.timeout
+
+        motor.run_direct(duty_cycle_sp=output)
+        try:
+            while len(switch_times) < self.cycles * 2 + 1:
+                if time.time() > end_time:
+                    raise RuntimeError("No oscillation within {0}s. Is the motor connected?".format(self.timeout))
+
+                position = motor.position
+                if switch_times:
+                    # Only measure the amplitude once we're oscillating.
+                    high = max(high, position)
+                    low = min(low, position)
+
+                error = start - position
+                if output > 0 and error < -self.hysteresis or output < 0 and error > self.hysteresis:
+                    # Switch the relay
+                    output = -output
+                    motor.duty_cycle_sp = output
+                    switch_times.append(time.time())
+                    if len(switch_times) % 2:
+                        yield "Oscillation {0} of {1}".format(len(switch_times) // 2, self.cycles)
+
+                time.sleep(self.sample_time)
+        finally:
+            motor.stop()
+
+        # A period is the time between two switches in the same direction.
+        # The first half period starts from standstill, so skip it.
+        periods = [switch_times[i + 2] - switch_times[i] for i in range(1, len(switch_times) - 2)]
+        self.Tu = sum(periods) / len(periods)
+        amplitude = (high - low) / 2.0
+        self.Ku = 4.0 * self.relay_power / (math.pi * max(amplitude, 1))
+
+    def gains(self):
+        """
+        PID gains for minimal settle time without overshoot, in the form PIDControl uses:
+        output = Kp * (error + Ti * integral + Td * derivative)
+
+        :return: Kp, Ti, Td (floats)
+        """
+        Kp = 0.2 * self.Ku
+        Ti = 2.0 / self.Tu    # Integral time Tu/2. PIDControl multiplies the integral, so invert it.
+        Td = self.Tu / 3.0
+        return Kp, Ti, Td
+
+
+def save_gains(filename, gains):
+    """
+    :param filename: str
+    :param gains: dict of motor name: {'kp': , 'ti': , 'td': }
+    """
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(gains, f, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def load_gains(filename):
+    """
+    :return: dict of motor name: {'kp': , 'ti': , 'td': }, empty if nothing was saved yet.
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
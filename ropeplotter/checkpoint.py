@@ -0,0 +1,82 @@
+__author__ = 'anton'
+
+import json
+import os
+import threading
+import time
+
+
+class Checkpointer(threading.Thread):
+    """
+    Saves the progress of the running plot job to disk every few seconds, so it can be resumed
+    after a reboot, a crash or an empty battery.
+
+    The plot generators only assign a small dict to plotter.progress and the motors keep their
+    last encoder reading in memory. This thread does the file writing, so the control loop never waits for it.
+
+    A checkpoint contains:
+    - job: mode, file and queue id of the running job
+    - progress: keyword arguments that restart the plot generator where it was
+    - positions: encoder positions relative to the zeroes set with 'zero'
+    - settings: the rope lengths and cm_to_deg that go with those zeroes
+    """
+    # Changes every time the server starts. If it's different in a checkpoint, the encoders were reset.
+    SESSION = "{0}-{1}".format(os.getpid(), time.time())
+
+    def __init__(self, plotter, filename='jobs/checkpoint.json', interval=5.0):
+        threading.Thread.__init__(self, name="checkpoint")
+        self.daemon = True
+        self.plotter = plotter
+        self.filename = filename
+        self.interval = interval
+        self.job = None     # Set when a job starts: {'mode': ..., 'file': ..., 'id': ...}
+        self.last_saved = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            job = self.job
+            if job is not None:
+                self.save(job)
+
+    def snapshot(self, job):
+        plotter = self.plotter
+        return {'job': job,
+                'progress': plotter.progress,
+                'positions': [motor.last_position for motor in plotter.drive_motors],
+                'settings': {'ll': plotter.l_rope_0, 'lr': plotter.r_rope_0, 'aw': plotter.att_dist,
+                             'cm_to_deg': plotter.cm_to_deg},
+                'session': self.SESSION}
+
+    def save(self, job):
+        checkpoint = self.snapshot(job)
+        with self.lock:
+            if checkpoint == self.last_saved or job is not self.job:
+                return
+            checkpoint_time = time.strftime("%Y-%m-%d %H:%M:%S")
+            # Write to a temp file first, so a crash halfway doesn't leave a corrupt checkpoint.
+            tmp_file = self.filename + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(dict(checkpoint, time=checkpoint_time), f)
+            os.replace(tmp_file, self.filename)
+            self.last_saved = checkpoint
+
+    def clear(self):
+        """
+        The job is done. Forget about it.
+        """
+        with self.lock:
+            self.job = None
+            self.last_saved = None
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+    def load(self):
+        """
+        :return: the last saved checkpoint (dict) or None
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as f:
+            return json.load(f)
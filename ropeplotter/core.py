@@ -1,10 +1,13 @@
 __author__ = 'anton'
 
 import time
-import ev3dev.auto as ev3
+import threading
+from ropeplotter.hardware import ev3
 import math
-from PIL import Image, ImageFilter
-from ropeplotter.robot_helpers import PIDMotor, clamp, BrickPiPowerSupply
+from ropeplotter.robot_helpers import PIDMotor, clamp, BrickPiPowerSupply, BatterySampler, Throttler, trapezoid, \
+    PlotterStats, ChalkFeeder
+from ropeplotter.autotune import RelayAutotuner, save_gains, load_gains
+from ropeplotter.kinematics import FixedPointKinematics
 import logging
 
 plotter_log = logging.getLogger("Plotter")
@@ -16,18 +19,23 @@ DOWN = 1
 UNCHANGED = -1
 SLOW = 600 # 320
 FAST = 600 # 520
+LOOP_RATE = 60  # Passes per second through control loops. More only eats the CPU the web server needs.
 
 class RopePlotter(object):
-    def __init__(self, l_rope_0, r_rope_0, attachment_distance, cm_to_deg=-175, Kp=2.2, Ki=0.2, Kd=0.02, chalk=False):
+    def __init__(self, l_rope_0, r_rope_0, attachment_distance, cm_to_deg=-175, Kp=2.2, Ki=0.2, Kd=0.02, chalk=False,
+                 nominal_voltage=None, settle_precision=5, settle_speed=30, brake_time=0.7, pen_latency=0.3,
+                 rapid_speed=None, rapid_accel=3000, rapid_precision=45, chalk_rate=10.0, chalk_reserve=150.0,
+                 plan_ahead=64, fixed_point=False):
 
-        self.cm_to_deg = cm_to_deg
         self.__l_rope_0 = float(l_rope_0)
         self.__r_rope_0 = float(r_rope_0)
         self.__att_dist = float(attachment_distance)
+        self.cm_to_deg = cm_to_deg  # This also calculates the constants
         self.direction = 1 # -1 is for reversing motors
-        self.calc_constants()
+        self.fixed_point = fixed_point     # Integer kinematics, for a brick without FPU. See benchmark_kinematics.py
         self.scanlines = 100
         self.r_step = 2.0 # cm
+        self.progress = {}  # Keyword arguments that resume the running plot generator where it is now.
 
         # Start the engines
         self.pen_motor = PIDMotor(ev3.OUTPUT_A, Kp=2, Ki=0.1, Kd=0, brake=0.1, speed_reg=True)
@@ -36,25 +44,56 @@ class RopePlotter(object):
         self.left_motor.stop_action = 'brake'
         self.right_motor = PIDMotor(ev3.OUTPUT_C, Kp=Kp, Ki=Ki, Kd=Kd)
         self.right_motor.stop_action = 'brake'
+        for motor in [self.left_motor, self.right_motor]:
+            motor.positionPID.settle_precision = settle_precision
+            motor.positionPID.settle_speed = settle_speed
+        self.brake_time = brake_time    # Max time to hold position after a move with brake=True
+        self.pen_latency = pen_latency  # Seconds the pen takes to go up or down. Learned while plotting.
+        self.pen_command_time = None    # When the pen got its last new target, to measure the latency.
+        self.dwell_saved = 0.0          # Seconds of brake time saved by settle detection
+        self.stats = PlotterStats()     # For the metrics page
+        self.last_xy = None             # Where the distance counting got to, normalized
+        self.rapid_speed = rapid_speed          # Degrees per second for travel moves with the pen up
+        self.rapid_accel = rapid_accel          # Degrees per second per second to slow down at the end of a travel
+        self.rapid_precision = rapid_precision  # Degrees. Travel moves switch to the final approach this close.
+        self.plan_ahead = plan_ahead            # Points of a coords.csv turned into motor targets ahead of the motors
 
         # Build lists for iterating over all motors
         self.drive_motors = [self.left_motor, self.right_motor]
         self.all_motors = [self.left_motor, self.right_motor, self.pen_motor]
+        if not rapid_speed:
+            # As fast as the motors go at full power. A plain move gets that far too.
+            self.rapid_speed = min([motor.max_speed for motor in self.drive_motors])
+
+        # Keep an eye on the battery and compensate drive motor power for voltage drop
+        if ev3.current_platform == 'brickpi':
+            try:
+                power_supply = BrickPiPowerSupply()
+            except (ImportError, IOError, OSError) as e:
+                # No smbus module or no i2c-dev. Plot anyway, without voltage compensation.
+                plotter_log.warning("Can't read the battery voltage, so no voltage compensation. "
+                                    "Is i2c-dev loaded? {0}".format(e))
+                power_supply = None
+        else:
+            power_supply = ev3.PowerSupply()
+        self.battery = BatterySampler(power_supply, nominal_voltage=nominal_voltage)
+        if power_supply is not None:
+            self.battery.start()     # Without samples, the voltage stays None and compensation 1.0
+        for motor in self.drive_motors:
+            motor.battery = self.battery
 
         # Set starting point
         self.set_control_zeroes()
 
         # Chalk extruder startup
         self.chalk = chalk
+        self.chalk_loaded = threading.Event()    # Set by the 'chalk-loaded' command (enter button)
+        self.chalk_homed = False    # The extruder is homed on first use, not at startup.
+        self.chalk_reserve = chalk_reserve      # cm of drawing. With less chalk left, reload before the next stroke.
         if chalk:
             self.chalk_motor = ev3.Motor(ev3.OUTPUT_D)
             self.chalk_sensor = ev3.TouchSensor(ev3.INPUT_4)
-
-            # Drive slowly to find the end position
-            self.chalk_motor.run_direct(duty_cycle_sp=-50)
-            self.chalk_motor.wait_until('stalled')
-            self.chalk_motor.stop()
-            self.chalk_motor.position = -10
+            self.chalk_feeder = ChalkFeeder(self.chalk_motor, self.chalk_sensor, rate=chalk_rate)
             self.right_motor.polarity = 'inversed'
 
     # Getters & setters for plotter properties.
@@ -95,12 +134,12 @@ class RopePlotter(object):
     @cm_to_deg.setter
     def cm_to_deg(self, setting):
         if ev3.current_platform == 'brickpi':
-            self.battery = BrickPiPowerSupply()
             factor = 2
         else:
-            self.battery = ev3.PowerSupply()
             factor = 1
+        self.cm_to_deg_setting = int(setting)   # As set, without the platform factor. Like in the settings form.
         self.__cm_to_deg = factor * int(setting)
+        self.calc_constants()
 
     @property
     def l_rope_0(self):
@@ -142,15 +181,31 @@ class RopePlotter(object):
         half_p = (a + b + c) / 2
         return (half_p * (half_p - a) * (half_p - b) * (half_p - c)) ** 0.5
 
-    def calc_constants(self):
+    @classmethod
+    def canvas_geometry(cls, l_rope_0, r_rope_0, attachment_distance):
+        """
+        Where the canvas is, relative to the left attachment point.
+
+        :param l_rope_0: Length of the left rope at the origin (top left of the canvas)
+        :param r_rope_0: Length of the right rope at the origin
+        :param attachment_distance: Distance between the attachment points
+        :return: h_margin, v_margin, canvas_size (floats)
+        """
         # Calculate the height of triangle made up by the two ropes
-        self.v_margin = self.triangle_area(self.__l_rope_0, self.__r_rope_0, self.__att_dist) / self.__att_dist * 2
+        v_margin = cls.triangle_area(l_rope_0, r_rope_0, attachment_distance) / attachment_distance * 2
 
         # Using pythagoras to find distance from bottom triangle point to left doorframe
-        self.h_margin = (self.__l_rope_0 ** 2 - self.v_margin ** 2) ** 0.5
+        h_margin = (l_rope_0 ** 2 - v_margin ** 2) ** 0.5
 
         # For convenience, the canvas is square and centered between the attachment points
-        self.canvas_size = self.__att_dist - 2 * self.h_margin
+        canvas_size = attachment_distance - 2 * h_margin
+        return h_margin, v_margin, canvas_size
+
+    def calc_constants(self):
+        self.h_margin, self.v_margin, self.canvas_size = self.canvas_geometry(self.__l_rope_0, self.__r_rope_0,
+                                                                              self.__att_dist)
+        self.fixed_kinematics = FixedPointKinematics(self.__l_rope_0, self.__r_rope_0, self.__att_dist,
+                                                     self.__cm_to_deg, self.h_margin, self.v_margin, self.canvas_size)
 
     ### Calculations for global (doorframe) to local (canvas) coordinates and back. ###
     def motor_targets_from_norm_coords(self,x_norm, y_norm):
@@ -158,6 +213,8 @@ class RopePlotter(object):
         return self.motor_targets_from_coords(x,y)
 
     def motor_targets_from_coords(self,x, y):
+        if self.fixed_point:
+            return self.fixed_kinematics.motor_targets_from_coords(x, y)
         l_rope = (x ** 2 + y ** 2) ** 0.5
         r_rope = ((self.__att_dist - x) ** 2 + y ** 2) ** 0.5
         l_target = (l_rope - self.__l_rope_0) * self.cm_to_deg
@@ -166,6 +223,8 @@ class RopePlotter(object):
         return int(l_target), int(r_target)
 
     def coords_from_motor_pos(self,l_motor,r_motor):
+        if self.fixed_point:
+            return self.fixed_kinematics.coords_from_motor_pos(l_motor, r_motor)
         l_rope = l_motor / self.cm_to_deg + self.__l_rope_0
         r_rope = r_motor / self.cm_to_deg + self.__r_rope_0
         y = self.triangle_area(l_rope,r_rope,self.att_dist)*2/self.att_dist
@@ -190,65 +249,273 @@ class RopePlotter(object):
             #motor.positionPID.zero = motor.position
         self.pen_motor.position = PEN_UP_POS
 
-    def move_to_coord(self,x,y, brake=False, pen=-1):
+    def restore_positions(self, positions):
+        """
+        Restore encoder positions relative to the zeroes, e.g. from a checkpoint after a reboot.
+        Only valid if the plotter hasn't moved since the positions were saved.
+
+        :param positions: (left, right) motor positions in degrees
+        """
+        for motor, position in zip(self.drive_motors, positions):
+            motor.position = int(position)
+        self.pen_motor.position = PEN_UP_POS
+
+    def move_to_coord(self,x,y, brake=False, pen=-1, pen_after=UNCHANGED):
         motor_b_target, motor_c_target  = self.motor_targets_from_coords(x, y)
-        self.move_to_targets((motor_b_target, motor_c_target), brake, pen)
+        self.move_to_targets((motor_b_target, motor_c_target), brake, pen, pen_after)
 
-    def move_to_norm_coord(self, x_norm, y_norm, pen=UNCHANGED, brake=False):
+    def move_to_norm_coord(self, x_norm, y_norm, pen=UNCHANGED, brake=False, pen_after=UNCHANGED):
         motor_b_target, motor_c_target = self.motor_targets_from_norm_coords(x_norm, y_norm)
-        self.move_to_targets((motor_b_target, motor_c_target),pen=pen, brake=brake)
+        self.move_to_targets((motor_b_target, motor_c_target),pen=pen, brake=brake, pen_after=pen_after)
+
+    def travel_to_coord(self, x, y, brake=False, pen_after=UNCHANGED):
+        self.travel_to_targets(self.motor_targets_from_coords(x, y), brake, pen_after)
 
-    def move_to_targets(self, targets, brake=False, pen=-1):
+    def travel_to_norm_coord(self, x_norm, y_norm, brake=False, pen_after=UNCHANGED):
+        self.travel_to_targets(self.motor_targets_from_norm_coords(x_norm, y_norm), brake, pen_after)
+
+    def travel_to_targets(self, targets, brake=False, pen_after=UNCHANGED):
+        """
+        Rapid move with the pen up. Both motors follow a motion profile, so they arrive together and keep
+        moving smoothly in between. It starts at rapid_speed, like a plain move that starts at full power,
+        and slows down with rapid_accel. The profile only has to be followed within rapid_precision.
+        The final approach is a normal move_to_targets, with its tight precision.
+
+        :param targets: (left, right) motor positions
+        :param brake: hold position at the target until the motors have settled
+        :param pen_after: UP or DOWN at the end of the move, or UNCHANGED.
+        """
+        if not self.pen_is(UP):
+            self.pen_up()
+        # A travel move is between strokes, so this is the time to reload. Not halfway a stroke.
+        if self.chalk and self.chalk_feeder.remaining_cm() < self.chalk_reserve:
+            plotter_log.info("{0:.0f}cm of chalk left. Reload.".format(self.chalk_feeder.remaining_cm()))
+            self.reload_chalk()
+
+        starts = [motor.position for motor in self.drive_motors]
+        if self.stats.recorder:
+            self.stats.recorder.event('travel', start=starts, targets=list(targets))
+        distances = [tgt - start for start, tgt in zip(starts, targets)]
+        longest = max([abs(distance) for distance in distances])
+        if longest > self.rapid_precision:
+            for motor, start in zip(self.drive_motors, starts):
+                motor.position_sp = start
+            start_time = time.time()
+            throttle = Throttler(LOOP_RATE, self.stats)
+            while 1:
+                # Scale the profile of the longest move to both motors, so they move in proportion.
+                elapsed = time.time() - start_time
+                covered, duration = trapezoid(longest, self.rapid_speed, self.rapid_accel, elapsed,
+                                              start_speed=self.rapid_speed)
+                for motor, start, distance in zip(self.drive_motors, starts, distances):
+                    motor.positionPID.track(start + distance * covered / longest)
+                    motor.run()
+                if pen_after != UNCHANGED and duration - elapsed < self.pen_latency:
+                    # Same as move_to_targets, so the pen is down when the travel ends.
+                    self.set_pen(pen_after)
+                    pen_after = UNCHANGED
+                self.run_pen()
+
+                if covered >= longest and all([abs(motor.positionPID.error) < self.rapid_precision
+                                               for motor in self.drive_motors]):
+                    break
+                throttle.throttle()
+
+        # Final approach
+        self.move_to_targets(targets, brake=brake, pen_after=pen_after)
+
+    def move_to_targets(self, targets, brake=False, pen=-1, pen_after=UNCHANGED):
+        """
+        Drive to motor targets.
+
+        :param targets: (left, right) motor positions
+        :param brake: hold position until the motors have settled
+        :param pen: UP or DOWN before moving, or UNCHANGED. Only waits if the pen isn't there yet.
+        :param pen_after: UP or DOWN at the end of the move, or UNCHANGED. The pen command is given
+        pen_latency seconds before we arrive, so the pen is there at the same time as the drive motors.
+        """
 
         # Set targets
         for motor, tgt in zip(self.drive_motors, targets):
             motor.position_sp = tgt
 
-        if pen == 1:        # Put the pen down
+        if pen == DOWN and not self.pen_is(DOWN):       # Put the pen down
             self.pen_down()
-        elif pen == 0:      # Put the pen up
+        elif pen == UP and not self.pen_is(UP):         # Put the pen up
             self.pen_up()
 
+        drawing = self.pen_motor.position_sp == PEN_DOWN_POS
+        self.stats.moves += 1
+        recorder = self.stats.recorder
+        if recorder:
+            recorder.event('move', start=[motor.last_position for motor in self.drive_motors], targets=list(targets),
+                           brake=brake)
 
         # Now run the motors and wait for the motors to reach their targets
         # Alas ev3dev's run_to_abs_pos is not usable on BrickPi. So I emulate a PID controller.
-
+        throttle = Throttler(LOOP_RATE, self.stats)
         while 1:
             for motor in self.drive_motors:
                 motor.run()
 
-            if self.chalk and self.pen_motor.position_sp == PEN_DOWN_POS:
-                # Extrude chalk if needed.
+            if pen_after != UNCHANGED and self.time_to_target() < self.pen_latency:
+                self.set_pen(pen_after)
+                pen_after = UNCHANGED
+            self.run_pen()
 
-                if self.chalk_sensor.is_pressed:
-                    self.chalk_motor.run_direct(duty_cycle_sp=60)
-                    if self.chalk_motor.position > 20552:
-                        self.reload_chalk()
-                else:
-                    self.chalk_motor.stop()
+            if self.chalk:
+                # Counting the distance feeds the chalk while drawing.
+                self.count_distance(*self.coords_from_motor_pos(*[motor.position for motor in self.drive_motors]))
 
             if all([motor.positionPID.target_reached for motor in self.drive_motors]):
-                if brake: #Run a little while long to stay in position.
-                    t=time.time()+0.7
-                    while t > time.time():
+                if recorder:
+                    recorder.event('arrived')
+                self.count_distance(*self.coords_from_motor_pos(*targets), pen_down=drawing)
+                if brake:
+                    self.stats.stops += 1
+                    # Run a little while longer to stay in position, until the motors have settled.
+                    t_end = time.time() + self.brake_time
+                    while t_end > time.time():
                         for motor in self.drive_motors:
                             motor.run()
+                        if all([motor.positionPID.settled for motor in self.drive_motors]):
+                            saved = t_end - time.time()
+                            self.dwell_saved += saved
+                            plotter_log.debug("Settled {0:.3f}s before the end of the brake time".format(saved))
+                            break
+                        throttle.throttle()
+                if pen_after != UNCHANGED:
+                    # We got there quicker than expected.
+                    self.set_pen(pen_after)
                 self.left_motor.stop()
                 self.right_motor.stop()
+                # The pen got its command pen_latency ahead and is about there. Stopping it now would leave it
+                # halfway, and the next move would wait for all of pen_up() or pen_down().
+                while not self.pen_motor.positionPID.target_reached:
+                    self.run_pen()
+                    throttle.throttle()
                 self.pen_motor.stop()
+                if recorder:
+                    recorder.event('stopped')
                 break
 
             #We're done calculating and setting all motor speeds!
-            time.sleep(0.016)
+            throttle.throttle()
+
+    def count_distance(self, x_norm, y_norm, pen_down=None):
+        """
+        Add the distance from the last counted position to the pen up or pen down distance in stats.
+        Cheap enough for every pass of a control loop.
+
+        :param pen_down: True if that distance was drawn. Default: what the pen is doing now.
+        """
+        if pen_down is None:
+            pen_down = self.pen_motor.position_sp == PEN_DOWN_POS
+        distance = 0.0
+        if self.last_xy is not None:
+            distance = math.hypot(x_norm - self.last_xy[0], y_norm - self.last_xy[1]) * self.canvas_size
+            if pen_down:
+                self.stats.pen_down_cm += distance
+            else:
+                self.stats.pen_up_cm += distance
+        self.last_xy = (x_norm, y_norm)
+        if self.chalk:
+            if pen_down:
+                self.chalk_feeder.feed(distance)
+                if self.chalk_feeder.empty:
+                    self.reload_mid_stroke()
+            else:
+                self.chalk_feeder.pause()
+
+    def time_to_target(self):
+        """
+        Estimate how long until the drive motors reach their targets at their current speed.
+
+        :return: seconds (float)
+        """
+        times = []
+        for motor in self.drive_motors:
+            rate = abs(motor.positionPID.error_rate)
+            if rate == float('inf'):
+                return rate     # Just started, no speed measured yet.
+            times.append(abs(motor.positionPID.error) / max(rate, 1))
+        return max(times)
+
+    ### Pen control without waiting. Control loops call run_pen() on every pass. ###
+
+    def set_pen(self, pen):
+        """
+        Give the pen a new target without waiting for it to get there.
+
+        :param pen: UP or DOWN
+        """
+        target = PEN_DOWN_POS if pen == DOWN else PEN_UP_POS
+        if self.pen_motor.position_sp != target:
+            self.pen_motor.position_sp = target
+            self.pen_command_time = time.time()
+
+    def pen_is(self, pen):
+        """
+        :return: True if the pen is up or down, as asked, and has arrived there.
+        """
+        target = PEN_DOWN_POS if pen == DOWN else PEN_UP_POS
+        return self.pen_motor.position_sp == target and self.pen_motor.positionPID.target_reached
+
+    def run_pen(self):
+        self.pen_motor.run()
+        if self.pen_command_time is not None and self.pen_motor.positionPID.target_reached:
+            # Learn how long the pen takes, so we can give pen commands that much ahead of time.
+            latency = time.time() - self.pen_command_time
+            self.pen_latency += (latency - self.pen_latency) * 0.2
+            self.pen_command_time = None
+
+    def look_ahead(self, positions, speeds):
+        """
+        Where will the pen be when a pen command given now is done, with the motors at these speeds?
+
+        :param positions: (left, right) motor positions
+        :param speeds: (left, right) motor speeds in degrees per second
+        :return: x_norm, y_norm
+        """
+        return self.coords_from_motor_pos(*[position + speed * self.pen_latency
+                                            for position, speed in zip(positions, speeds)])
+
+    def home_chalk(self):
+        """
+        Find the end position of the chalk extruder, if that wasn't done yet.
+        """
+        if self.chalk and not self.chalk_homed:
+            # Drive slowly to find the end position
+            self.chalk_motor.run_direct(duty_cycle_sp=-50)
+            self.chalk_motor.wait_until('stalled')
+            self.chalk_motor.stop()
+            self.chalk_motor.position = -10
+            self.chalk_feeder.reset(0)
+            self.chalk_homed = True
 
     def reload_chalk(self):
         if self.chalk:
+            self.home_chalk()
             # Drive the loader back and wait for human to insert new chalk and resume
+            self.chalk_loaded.clear()
             self.chalk_motor.run_to_abs_pos(position_sp=0, speed_sp=600)
             self.chalk_motor.wait_while('running')
-            buttons = ev3.Button()
-            while not buttons.enter():
-                time.sleep(0.5)
+            self.chalk_loaded.wait()
+            self.chalk_feeder.reset(self.chalk_motor.position)
+
+    def reload_mid_stroke(self):
+        # A stroke was longer than the chalk_reserve, so the holder got empty while drawing. Stop right here,
+        # reload and put the pen down at the same spot. The control loop that called this just goes on.
+        self.chalk_feeder.ran_out += 1
+        plotter_log.warning("Chalk ran out halfway a stroke. Reload.")
+        for motor in self.drive_motors:
+            motor.stop()
+        self.pen_up()
+        self.reload_chalk()
+        self.pen_down()
+        # Don't count the wait for the human as time the motors were off target.
+        for motor in self.drive_motors:
+            motor.positionPID.reset()
 
     ### Advanced plotting functions by chaining movement functions ###
 
@@ -258,7 +525,7 @@ class RopePlotter(object):
         self.move_to_norm_coord(0.3,0.3)
         self.move_to_norm_coord(0.0,0.0)
 
-    def plot_from_file(self, filename):
+    def plot_from_file(self, filename, start_point=0):
         """
         Generator function for plotting from coords.csv file. After each next() it returns the pct done of the plotting
         This way the plotting can easily be aborted and status can be given. Gotta love python for this.
@@ -271,656 +538,284 @@ class RopePlotter(object):
             except StopIteration:
                 break
 
+        The first line of the file is the number of points. Then every line is a point: x_norm,y_norm
+        An optional third column is 1 to draw to the point or 0 to travel to it with the pen up. That way a file
+        can hold more than one stroke. Without it, all points are one line.
+
+        The file is read and turned into motor targets by a PathPlanner thread, plan_ahead points ahead,
+        so this loop only drives.
+
         :param filename: str
+        :param start_point: index of the point to start from, to resume an interrupted plot.
         :return: percentage done: float
         """
-        coords = open(filename)
-        num_coords = int(coords.readline())  #coords contains it's length on the first line.
+        from ropeplotter.planning import PathPlanner
+        planner = PathPlanner(self, filename, start_point, depth=self.plan_ahead)
+        planner.start()
+        for seq, left, right, pen, flags in planner.frames():
+            self.drive_frame(left, right, pen, flags)
+            if seq < planner.total:
+                self.progress = {'start_point': seq}
+            yield float(seq) / max(planner.total, 1) * 100
+        if planner.underruns:
+            plotter_log.info("The motors waited {0} times for the planner".format(planner.underruns))
+
+    def plot_from_frames(self, frames, total=0):
+        """
+        Generator function that drives to motor targets planned somewhere else, e.g. streamed by a FrameServer.
+        No kinematics, no files: only driving.
+
+        :param frames: iterable of (seq, left target, right target, pen, flags), flags as in ropeplotter.streaming
+        :param total: number of frames, for the percentage done
+        :return: percentage done: float
+        """
+        for seq, left, right, pen, flags in frames:
+            self.drive_frame(left, right, pen, flags)
+            yield float(seq + 1) / max(total, 1) * 100
 
-        #drive to the first coordinate
-        self.pen_up()
-        # read from file
-        x_norm, y_norm = [float(n) for n in coords.readline().split(",")]
-        #move
-        self.move_to_norm_coord(x_norm, y_norm)
-        self.pen_down()
-        for i in range(num_coords - 1):
-            # read from file
-            x_norm, y_norm = [float(n) for n in coords.readline().split(",")]
-            #move
-            self.move_to_norm_coord(x_norm, y_norm)
-            yield float(i+1)/num_coords*100
-
-        coords.close()
         self.pen_up()
-        self.move_to_norm_coord(0, 0)
-        yield 100
 
-    def plot_circle_waves(self):
+    def drive_frame(self, left, right, pen, flags):
+        """
+        Drive to the motor targets of one frame. Travel if the pen is up.
+
+        :param flags: as in ropeplotter.streaming
+        """
+        from ropeplotter.streaming import BRAKE, PEN_DOWN_AFTER, PEN_UP_AFTER
+        if flags & PEN_DOWN_AFTER:
+            pen_after = DOWN
+        elif flags & PEN_UP_AFTER:
+            pen_after = UP
+        else:
+            pen_after = UNCHANGED
+        if pen == UP:
+            self.travel_to_targets((left, right), brake=bool(flags & BRAKE), pen_after=pen_after)
+        else:
+            self.move_to_targets((left, right), brake=bool(flags & BRAKE), pen=pen, pen_after=pen_after)
+
+    @staticmethod
+    def read_coord(coords):
+        """
+        Read a point from a coords file.
+
+        :param coords: open file
+        :return: x_norm, y_norm, pen
+        """
+        values = coords.readline().split(",")
+        pen = int(float(values[2])) if len(values) > 2 else DOWN
+        return float(values[0]), float(values[1]), pen
+
+    def plot_circle_waves(self, filename="uploads/picture.jpg", start_arc=0):
         """
         Draws a grayscale image of the uploaded photo by tracing the canvas with circles and
         oscilating more in darker areas.
 
         This is a generator method that yields progress and can be paused after each progress report.
 
-        :param num_circles: The amount of circles to put on the complete canvas.
+        :param filename: The picture to plot.
+        :param start_arc: The circle to start with, to resume an interrupted plot.
         :yield: progress.
         """
-
-        # Load grayscale image
-        im = Image.open("uploads/picture.jpg").convert("L")
-        w, h = im.size
-        pixels = im.load()
-
-        # Calculate circles, smallest, largest and offset.
-        r_min = (self.h_margin ** 2 + self.v_margin ** 2) ** 0.5
-        r_max = ((self.h_margin + self.canvas_size) ** 2 + (self.v_margin + self.canvas_size) ** 2) ** 0.5
-        r_step = (r_max - r_min) / self.scanlines
+        from PIL import Image
+        from ropeplotter.raster import Picture, WaveScan, Waves, canvas_box, canvas_radii, sweep
+        picture = Picture(Image.open(filename).convert("L"))
+        throttle = Throttler(LOOP_RATE, self.stats)
+
+        # Circles with the left anchor point as center, up and down.
+        box = canvas_box(self)
+        r_min, r_step = canvas_radii(self, self.scanlines)
         amplitude = r_step * self.cm_to_deg / 2 * 1.15  # Sine amplitude in motor degrees
-        half_wavelength = 0.5                           # Time in seconds it takes to draw half a sine wave.
 
-        anchor_motor, drive_motor = self.drive_motors
-
-        # Draw circles with left anchor point as center.
         for i in range(1, self.scanlines, 2):
-            # Find the starting point x,y
-            # where a circle with radius r_min+r_step*i crosses the left margin.
-            x = self.h_margin
-            y = ((r_min + r_step * i) ** 2 - self.h_margin ** 2) ** 0.5
-
-            # Check whether we reached the bottom
-            if y > self.v_margin + self.canvas_size:
-                # Now we check where circles cross the bottom margin
-                x = ((r_min + r_step * i) ** 2 - (self.v_margin + self.canvas_size) ** 2) ** 0.5
-                y = self.v_margin + self.canvas_size
-
-            self.move_to_coord(x, y, brake=True, pen=0)
-
-            #Intialise
-            anchor_line = anchor_motor.position
-            next_sample_time = time.time()
-            darkness = 0
-            weighted_amplitude = 0
-
-            # Start driving (up)
-            drive_motor.run_forever(speed_sp=100)
-            while 1:
-                # In each loop read motor positions.
-                drive_motor_pos = drive_motor.position
-                anchor_motor_pos = anchor_motor.position
-
-                now = time.time()
-
-                x_norm, y_norm = self.coords_from_motor_pos(anchor_motor_pos, drive_motor_pos)
-                # Look at the pixel we're at and move pen up & down according to it's darkness
-                pixel_location = (clamp(x_norm * w, (0, w - 1)), clamp(y_norm * w, (0, h - 1)))
-                darkness = (pixels[pixel_location] - 255.0) / -255.0
-                drive_speed = 600 - 578 * darkness ** 0.9   # Exponential darkness for more contrast.
-
-                if darkness > 0.2:
-                    self.pen_motor.position_sp = PEN_DOWN_POS
-                    if not self.pen_motor.positionPID.target_reached:
-                        drive_motor.stop()
-                    else:
-                        drive_motor.run_forever(speed_sp=drive_speed)
-                else:
-                    self.pen_motor.position_sp = PEN_UP_POS
-
-                if now >= next_sample_time:
-                    weighted_amplitude = amplitude * darkness # this turns 0 when white (255), 1 when black.
-                    next_sample_time = now + half_wavelength
-
-                drive_motor.run_forever(speed_sp=drive_speed) # Exponential darkness for more contrast.
-                anchor_motor.position_sp = anchor_line + math.sin(now * math.pi / half_wavelength) * weighted_amplitude
-                anchor_motor.run()
-                self.pen_motor.run()
-
-                if y_norm <= 0:
-                    break  # reached the top
-                if x_norm >= 1:
-                    break  # reached the right side
-
-            anchor_motor.stop()
-            drive_motor.stop()
-
-            # Yield to allow pause/stop and show percentage completion
-            yield (i * 50.0) / self.scanlines
-
-            # Good, now move to the next point and roll down.
-            x = ((r_min + r_step * (i + 1)) ** 2 - self.v_margin ** 2) ** 0.5
-            y = self.v_margin
-
-            if x > (self.h_margin + self.canvas_size):  # Reached right side
-                x = self.h_margin + self.canvas_size
-                y = ((r_min + r_step * (i + 1)) ** 2 - (self.h_margin + self.canvas_size) ** 2) ** 0.5
-
-            self.move_to_coord(x, y, brake=True, pen=0)
-
-            # Start driving down
-            anchor_line = anchor_motor.position
-            drive_motor.run_forever(speed_sp=-100)
-            while 1:
-                drive_motor_pos = drive_motor.position
-                anchor_motor_pos = anchor_motor.position
-
-                now = time.time()
-
-                #Get our current location in normalised coordinates.
-                x_norm, y_norm = self.coords_from_motor_pos(anchor_motor_pos, drive_motor_pos)
-                pixel_location = (clamp(x_norm * w, (0, w - 1)), clamp(y_norm * w, (0, h - 1)))
-                darkness = (pixels[pixel_location] - 255.0) / -255.0  # this turns 0 when white (255), 1 when black.
-                drive_speed = (600 - 578 * darkness ** 0.9) * -1  # Exponential darkness for more contrast.
-
-                if darkness > 0.2:
-                    self.pen_motor.position_sp = PEN_DOWN_POS
-                    if not self.pen_motor.positionPID.target_reached:
-                        drive_motor.stop()
-                    else:
-                        drive_motor.run_forever(speed_sp=drive_speed)
-                else:
-                    self.pen_motor.position_sp = PEN_UP_POS
-
-                if now >= next_sample_time:
-                    weighted_amplitude = amplitude * darkness
-                    next_sample_time = now + half_wavelength
-
-                drive_motor.run_forever(speed_sp=drive_speed)
-                anchor_motor.position_sp = anchor_line + math.sin(now * math.pi / half_wavelength) * weighted_amplitude
-                anchor_motor.run()
-                self.pen_motor.run()
-
-                if y_norm >= 1:
-                    break  # reached the bottom
-                if x_norm <= 0:
-                    break  # reached the left side
-
-            anchor_motor.stop()
-            drive_motor.stop()
-
-            # Yield to allow pause/stop and show percentage
-            yield ((i + 1) * 50.0) / self.scanlines
+            if i < start_arc:
+                continue
+            self.progress = {'start_arc': i}
+            for j, up in ((i, True), (i + 1, False)):
+                scan = WaveScan(self, r_min + r_step * j, box, amplitude, up=up)
+                self.travel_to_coord(*scan.start, brake=True)
+                sweep(self, scan, Waves(), picture, throttle)
+                # Yield to allow pause/stop and show percentage
+                yield j * 100.0 / self.scanlines
 
-        self.pen_up()
-        self.move_to_norm_coord(0,0)
+        self.travel_to_norm_coord(0, 0)
 
-    def plot_circles(self):
+    def plot_circles(self, filename="uploads/picture.jpg"):
+        from PIL import Image
+        from ropeplotter.raster import Picture, ArcScan, RowScan, Threshold, canvas_box, canvas_radii, sweep
         num_circles = self.scanlines
+        picture = Picture(Image.open(filename).convert("L"))
+        throttle = Throttler(LOOP_RATE, self.stats)
+        box = canvas_box(self)
+        r_min, r_step = canvas_radii(self, num_circles)
 
-        im = Image.open("uploads/picture.jpg").convert("L")
-        w, h = im.size
-        pixels = im.load()
-
-        r_min = (self.h_margin**2+self.v_margin**2)**0.5
-        r_max = ((self.h_margin+self.canvas_size)**2 + (self.v_margin+self.canvas_size)**2)**0.5
-        r_step = (r_max-r_min)/num_circles
-
-        for right_side_mode in [0, 1]: # Multiply all terms that only apply to the right side circles with right_side_mode
-            if right_side_mode:
-                drive_motor, anchor_motor = self.drive_motors
-            else:
-                anchor_motor, drive_motor = self.drive_motors
-
-            # First draw circles with left anchor point as center.
+        # Circles around the left anchor point, then around the right one, with a lighter threshold.
+        for right_side_mode in [0, 1]:
             for i in range(1, num_circles, 2):
-                # Move to the starting point at x,y
-                # Calculate where a circle with radius r_min+r_step*i crosses the left margin.
-                x = self.h_margin + (right_side_mode * self.canvas_size)
-                y = ((r_min+r_step*i)**2 - self.h_margin ** 2) ** 0.5   # This is the same left and right
-                if y > self.v_margin+self.canvas_size:
-                    # We reached the bottom, now we check where circles cross the bottom margin
-                    if right_side_mode:
-                        x = self.h_margin*2 + self.canvas_size - ((r_min + r_step*i) ** 2 - (self.v_margin + self.canvas_size) ** 2) ** 0.5
-                    else:
-                        x = ((r_min + r_step*i) ** 2 - (self.v_margin + self.canvas_size) ** 2) ** 0.5
-                    y = self.v_margin+self.canvas_size  # This is the same left and right
-                self.move_to_coord(x, y, pen=UP, brake=True)
-                # Yield to allow pause/stop and show percentage
-                yield (i * 50.0 + right_side_mode * 50.0) / num_circles * 0.66
-
-                # Now calculate coordinates continuously until we reach the top, or right side of the canvas
-                # Motor B is off, so let's get it's encoder only once
-                while 1:
-                    # Look at the pixel we're at and move pen up or down accordingly
-                    x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                    pixel_location = (clamp(x_norm * w, (0,w-1)), clamp(y_norm * w, (0,h-1)))
-                    if pixels[pixel_location] < 120 + 60 * right_side_mode:
-                        self.pen_motor.position_sp = PEN_DOWN_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            drive_motor.run_forever(speed_sp=SLOW)
-                    else:
-                        self.pen_motor.position_sp = PEN_UP_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            drive_motor.run_forever(speed_sp=FAST)
-                    self.pen_motor.run()
-
-                    if y_norm <= 0:
-                        break # reached the top
-                    if (not right_side_mode) and x_norm >= 1:
-                        break # reached the right side
-                    if right_side_mode and x_norm <= 0:
-                        break
-
-                drive_motor.stop()
-
-
-                #Good, now move to the next point and roll down.
-                if right_side_mode:
-                    x = self.h_margin*2 + self.canvas_size - ((r_min + r_step*(i+1)) ** 2 - self.v_margin ** 2) ** 0.5
-                else:
-                    x = ((r_min + r_step*(i+1)) ** 2 - self.v_margin ** 2) ** 0.5
-                y = self.v_margin
-
-                if (not right_side_mode) and x > (self.h_margin + self.canvas_size): # Reached right side
-                    x = self.h_margin + self.canvas_size
-                    y = ((r_min+r_step*(i+1)) ** 2 - (self.h_margin+self.canvas_size) ** 2) ** 0.5
-
-                if right_side_mode and x < self.h_margin: # Reached left side
-                    x = self.h_margin
-                    y = ((r_min+r_step*(i+1)) ** 2 - (self.h_margin+self.canvas_size) ** 2) ** 0.5
-
-                self.move_to_coord(x, y, pen=UP, brake=True)
-                # Yield to allow pause/stop and show percentage
-                yield ((i+1)*50.0+right_side_mode*50.0)/num_circles * 0.66
-
-                # Calculate coordinates continuously until we reach the top, or right side of the canvas
-                while 1:
-                    # Look at the pixel we're at and move pen up or down accordingly
-                    x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                    pixel_location = (int(clamp(x_norm * w, (0,w-1))), int(clamp(y_norm * w, (0,h-1))))
-
-                    if pixels[pixel_location] < 120 + 60 * right_side_mode:
-                        self.pen_motor.position_sp = PEN_DOWN_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            drive_motor.run_forever(speed_sp=-SLOW)
-                    else:
-                        self.pen_motor.position_sp = PEN_UP_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            drive_motor.run_forever(speed_sp=-FAST)
-                    self.pen_motor.run()
-
-                    if y_norm >= 1:
-                        break # reached the bottom
-                    if x_norm <= 0 and not right_side_mode:
-                        break # reached the left side
-                    if x_norm >= 1 and right_side_mode:
-                        break
-                    time.sleep(0.02)
-
-                drive_motor.stop()
-
-        # Now draw horizontalish lines.
-        self.pen_up()
-        for i in range(0,num_circles, 2):
-            x = self.h_margin
-            y = self.v_margin + i * self.canvas_size * 1.0 / num_circles
-            self.move_to_coord(x, y, pen=UP, brake=True)
-            yield 66 + i * 33.33 / num_circles
-
-            while 1:
-                    # Look at the pixel we're at and move pen up or down accordingly
-                    x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                    pixel_location = (clamp(x_norm * w, (0,w-1)), clamp(y_norm * w, (0,h-1)))
-
-                    if pixels[pixel_location] < 60:
-                        self.pen_motor.position_sp = PEN_DOWN_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            self.right_motor.stop()
-                            self.left_motor.stop()
-                        else:
-                            self.right_motor.run_forever(speed_sp=SLOW)
-                            self.left_motor.run_forever(speed_sp=-SLOW)
-                    else:
-                        self.pen_motor.position_sp = PEN_UP_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            self.right_motor.stop()
-                            self.left_motor.stop()
-                        else:
-                            self.right_motor.run_forever(speed_sp=FAST)
-                            self.left_motor.run_forever(speed_sp=-FAST)
-                    self.pen_motor.run()
-
-                    if x_norm >= 1:
-                        break
-
-            self.right_motor.stop()
-            self.left_motor.stop()
-
-            x = self.h_margin + self.canvas_size
-            y = self.v_margin + (i+1) * self.canvas_size * 1.0 / num_circles
-            self.move_to_coord(x, y, pen=UP, brake=True)
-            yield 66 + (i+1) * 33.33 / num_circles
-
-            while 1:
-
-                    # Look at the pixel we're at and move pen up or down accordingly
-                    x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                    pixel_location = (clamp(x_norm * w, (0,w-1)), clamp(y_norm * w, (0,h-1)))
-                    if pixels[pixel_location] < 60:
-                        self.pen_motor.position_sp = PEN_DOWN_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            self.right_motor.stop()
-                            self.left_motor.stop()
-                        else:
-                            self.right_motor.run_forever(speed_sp=-SLOW)
-                            self.left_motor.run_forever(speed_sp=SLOW)
-                    else:
-                        self.pen_motor.position_sp = PEN_UP_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            self.right_motor.stop()
-                            self.left_motor.stop()
-                        else:
-                            self.right_motor.run_forever(speed_sp=-FAST)
-                            self.left_motor.run_forever(speed_sp=FAST)
-                    self.pen_motor.run()
-
-                    if x_norm <= 0:
-                        break
-
-            self.right_motor.stop()
-            self.left_motor.stop()
-
-        self.move_to_norm_coord(0,0,pen=UP, brake=True)
-
-    def optimized_etch(self):
+                for j, up in ((i, True), (i + 1, False)):
+                    scan = ArcScan(self, r_min + r_step * j, box, right_side=right_side_mode, up=up)
+                    self.travel_to_coord(*scan.start, brake=True)
+                    # Yield to allow pause/stop and show percentage
+                    yield right_side_mode * 33.33 + j * 33.33 / num_circles
+                    sweep(self, scan, Threshold(120 + 60 * right_side_mode), picture, throttle)
+
+        # Now draw horizontal lines in the darkest parts.
+        for i in range(0, num_circles, 2):
+            for j, rightward in ((i, True), (i + 1, False)):
+                scan = RowScan(self, self.v_margin + j * self.canvas_size * 1.0 / num_circles, box, rightward)
+                self.travel_to_coord(*scan.start, brake=True)
+                yield 66 + j * 33.33 / num_circles
+                sweep(self, scan, Threshold(60), picture, throttle)
+
+        self.travel_to_norm_coord(0, 0, brake=True)
+
+    def optimized_etch(self, filename="uploads/picture.jpg", start_level=0, start_region=0, start_arc=0):
         # load image
-        im = Image.open("uploads/picture.jpg").convert("L")
+        from PIL import Image
+        from ropeplotter.regions import find_regions
+        im = Image.open(filename).convert("L")
+        w = im.size[0]
         levels = [180, 120, 65]
-        for i in range(3):
+        for i in range(start_level, 3):
             # make all pixels with brightness between 0 and levels[i] white, the rest black.
             etch_area = Image.eval(im, lambda x: (x < levels[i]) * 255)
             yield "Pixels < " + str(levels[i]) + " selected"
-            # Get the Bounding rectangle of the result
-            bbox = etch_area.getbbox()
-            yield "Plotting inside " + str(bbox)
-            # create a blurred version to slow the robot down when it nears a white area
-            # im_blur = etch_area.filter(ImageFilter.GaussianBlur(20))
-            # yield "Image blurred"
-            # composite the images to create map for robot speed and pen up/down
-            # etch_area = Image.composite(etch_area, im_blur, etch_area)
-            # yield "Image composited"
-            # etch only the resulting rectangle with the resulting image
-            plot_action = self.etch_region(bbox, etch_area, i)
-            while True:
-                try:
-                    message = "{0:.2f}% done".format(next(plot_action))
-                    plotter_log.info(message)
-                    yield message
-                except StopIteration:
-                    break
+            # Etch the dark parts one by one, each inside its own bounding rectangle.
+            # Cells of one etch line wide, in pixels. The image width is the canvas width.
+            regions = find_regions(etch_area, cell=self.r_step / self.canvas_size * w)
+            yield "Plotting {0} regions: {1}".format(len(regions), ", ".join([str(r.box) for r in regions]))
+            for j, region in enumerate(regions):
+                if i == start_level and j < start_region:
+                    continue
+                resume_arc = start_arc if (i == start_level and j == start_region) else 0
+                plot_action = self.etch_region(region.box, region.mask(etch_area), i, resume_arc, region=j)
+                while True:
+                    try:
+                        pct = next(plot_action)
+                    except StopIteration:
+                        break
+                    # etch_region counts in its third of the plot. Spread that third over the regions.
+                    pct = i * 33.33 + (j + clamp((pct - i * 33.33) / 33.33, (0, 1))) * 33.33 / len(regions)
+                    plotter_log.debug("%.2f%% done", pct)
+                    yield "{0:.2f}% done".format(pct)
 
-        self.move_to_norm_coord(0, 0, pen=UP, brake=True)
+        self.travel_to_norm_coord(0, 0, brake=True)
 
-    def etch_region(self, bbox, im, direction):
+    def etch_region(self, bbox, im, direction, start_arc=0, region=0):
+        from ropeplotter.raster import Picture, ArcScan, RowScan, Etch, sweep
+        self.home_chalk()
         w, h = im.size
-        pixels = im.load()
+        picture = Picture(im)
+        throttle = Throttler(LOOP_RATE, self.stats)
 
         # convert bbox to absolute global coordinates in cm
         # The bounding box is returned as a 4-tuple defining the left, upper, right, and lower pixel
-        left, top = self.normalized_to_global_coords(float(bbox[0]) / w, float(bbox[1]) / w)
-        right, bottom = self.normalized_to_global_coords(float(bbox[2]) / w, float(bbox[3]) / w)
+        left, top = self.normalized_to_global_coords(float(bbox[0]) / w, float(bbox[1]) / h)
+        right, bottom = self.normalized_to_global_coords(float(bbox[2]) / w, float(bbox[3]) / h)
+        box = (left, top, right, bottom)
 
         r_step = self.r_step
 
         if direction < 2:
-            # Calculate the number of circles to be drawn.
-            r_min = (left ** 2 + top ** 2) ** 0.5
-            r_max = (right ** 2 + bottom ** 2) ** 0.5
-            num_circles = round((r_max - r_min) / r_step)
-
-            right_side_mode = direction
-            if right_side_mode:
-                drive_motor, anchor_motor = self.drive_motors
+            # Calculate the number of circles to be drawn, around the anchor point of this direction.
+            if direction:
+                r_min = ((self.att_dist - right) ** 2 + top ** 2) ** 0.5
+                r_max = ((self.att_dist - left) ** 2 + bottom ** 2) ** 0.5
             else:
-                anchor_motor, drive_motor = self.drive_motors
+                r_min = (left ** 2 + top ** 2) ** 0.5
+                r_max = (right ** 2 + bottom ** 2) ** 0.5
+            num_circles = round((r_max - r_min) / r_step)
 
             for i in range(1, num_circles, 2):
-                # Move to the starting point at x,y which is slightly below the top left of the rectangle
-                # Calculate where a circle with radius r_min+r_step*i crosses the left (or right) margin.
-                if right_side_mode:
-                    x = right
-                    y = ((r_min+r_step*i)**2 - (self.att_dist - x) ** 2) ** 0.5
-                else:
-                    x = left
-                    y = ((r_min + r_step * i) ** 2 - x ** 2) ** 0.5
-                if y >= bottom:
-                    # We reached the bottom, now we check where circles cross the bottom margin
-                    if right_side_mode:
-                        x = self.att_dist - ((r_min + r_step*i) ** 2 - bottom ** 2) ** 0.5
-                    else:
-                        x = ((r_min + r_step*i) ** 2 - bottom ** 2) ** 0.5
-                    y = bottom  # This is the same left and right
-
-                self.move_to_coord(x, y, pen=UP, brake=True)
-                # Yield to allow pause/stop and show percentage
-                yield (i * 50.0 + right_side_mode * 50.0) / num_circles * 0.66
-
-                # Now calculate coordinates continuously until we reach the top, or right side of the canvas
-                # Motor B is off, so let's get it's encoder only once
-                while 1:
-                    # Look at the pixel we're at and move pen up or down accordingly
-                    x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                    x, y = self.normalized_to_global_coords(x_norm, y_norm)
-                    pixel_location = (clamp(x_norm * w, (0, w-1)), clamp(y_norm * w, (0, h-1)))
-                    if pixels[pixel_location] == 255:
-                        self.pen_motor.position_sp = PEN_DOWN_POS
-
-                        while self.chalk_sensor.is_pressed:
-                            drive_motor.stop()
-                            self.chalk_motor.run_forever(speed_sp=300)
-                        self.chalk_motor.stop()
-
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            drive_motor.run_forever(speed_sp=SLOW)
-                    else:
-                        self.pen_motor.position_sp = PEN_UP_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            # Calculate speed. At pixel value 255 it should be slow, at 0 fast, and otherwise
-                            # proportionally in between.
-                            speed = FAST - pixels[pixel_location] * (FAST-SLOW) // 255
-                            drive_motor.run_forever(speed_sp=speed)
-                    self.pen_motor.run()
-
-                    if y <= top:    # reached the top
-                        break
-                    if (not right_side_mode) and x >= right:    # reached the right side
-                        break
-                    if right_side_mode and x <= left:           # reached the left side
-                        break
-
-                drive_motor.stop()
-                self.pen_up()
-
-
-                #Good, now move to the next point and roll down.
-                if right_side_mode:
-                    x = self.att_dist - ((r_min + r_step*(i+1)) ** 2 - top ** 2) ** 0.5
-                else:
-                    x = ((r_min + r_step*(i+1)) ** 2 - top ** 2) ** 0.5
-                y = top
-
-                if (not right_side_mode) and x >= right: # Reached right side
-                    x = right
-                    y = ((r_min+r_step*(i+1)) ** 2 - right ** 2) ** 0.5
+                if i < start_arc:
+                    continue
+                self.progress = {'start_level': direction, 'start_region': region, 'start_arc': i}
+                for j, up in ((i, True), (i + 1, False)):
+                    scan = ArcScan(self, r_min + r_step * j, box, right_side=direction, up=up)
+                    self.travel_to_coord(*scan.start, brake=True)
+                    # Yield to allow pause/stop and show percentage
+                    yield direction * 33.33 + j * 33.33 / num_circles
+                    sweep(self, scan, Etch(), picture, throttle)
 
-                if right_side_mode and x <= left: # Reached left side
-                    x = left
-                    y = ((r_min+r_step*(i+1)) ** 2 - (self.att_dist - left) ** 2) ** 0.5
-
-                self.move_to_coord(x, y, pen=UP, brake=True)
-                # Yield to allow pause/stop and show percentage
-                yield ((i+1)*33.3+right_side_mode*33.3)/num_circles
-
-                # Calculate coordinates continuously until we reach the top, or right side of the canvas
-                while 1:
-                    # Look at the pixel we're at and move pen up or down accordingly
-                    x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                    x, y = self.normalized_to_global_coords(x_norm, y_norm)
-                    pixel_location = (int(clamp(x_norm * w, (0,w-1))), int(clamp(y_norm * w, (0,h-1))))
-                    if pixels[pixel_location] == 255:
-                        self.pen_motor.position_sp = PEN_DOWN_POS
-
-                        while self.chalk_sensor.is_pressed: #pause to load chalk
-                            drive_motor.stop()
-                            self.chalk_motor.run_forever(speed_sp=300)
-                        self.chalk_motor.stop()
-
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            drive_motor.run_forever(speed_sp=-SLOW)
-                    else:
-                        self.pen_motor.position_sp = PEN_UP_POS
-                        if not self.pen_motor.positionPID.target_reached:
-                            drive_motor.stop()
-                        else:
-                            speed = FAST - pixels[pixel_location] * (FAST - SLOW) // 255
-                            drive_motor.run_forever(speed_sp=-speed)
-                    self.pen_motor.run()
-
-                    if y >= bottom:
-                        break # reached the bottom
-                    if x <= left and not right_side_mode:
-                        break # reached the left side
-                    if x >= right and right_side_mode:
-                        break
-                    time.sleep(0.02)
+        if direction == 2:
+            # Now draw horizontal lines, a bit slower.
+            num_circles = round((bottom - top) / r_step)
 
-                drive_motor.stop()
-                self.pen_up()
+            for i in range(0, num_circles, 2):
+                if i < start_arc:
+                    continue
+                self.progress = {'start_level': direction, 'start_region': region, 'start_arc': i}
+                for j, rightward in ((i, True), (i + 1, False)):
+                    scan = RowScan(self, top + j * r_step, box, rightward)
+                    self.travel_to_coord(*scan.start, brake=True)
+                    yield 66 + j * 33.33 / num_circles
+                    sweep(self, scan, Etch(SLOW - 100, FAST - 150), picture, throttle)
 
-        if direction == 2:
-            # Now draw horizontalish lines.
+        self.pen_up()
 
-            num_circles = round((bottom - top) / r_step)
+    ### Calibration & manual movement functions ###
 
-            self.pen_up()
+    def autotune(self, filename='pid_gains.json'):
+        """
+        Generator that measures the step response of each drive motor with a relay test and sets
+        PID gains for the fastest settle time without overshoot. The gains are saved per motor.
+        The plotter jiggles a few millimeters up and down around its current position while tuning.
 
-            for i in range(0, num_circles, 2):
-                x = left
-                y = top + i * r_step
-                self.move_to_coord(x, y, pen=UP, brake=True)
-                yield 66 + i * 33.33 / num_circles
-
-                while 1:
-                        # Look at the pixel we're at and move pen up or down accordingly
-                        x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                        x, y = self.normalized_to_global_coords(x_norm, y_norm)
-                        pixel_location = (clamp(x_norm * w, (0, w-1)), clamp(y_norm * w, (0, h-1)))
-                        if pixels[pixel_location] == 255:
-
-                            self.pen_motor.position_sp = PEN_DOWN_POS
-
-                            while self.chalk_sensor.is_pressed:
-                                # Pause to load chalk
-                                self.right_motor.stop()
-                                self.left_motor.stop()
-                                self.chalk_motor.run_forever(speed_sp=300)
-                            self.chalk_motor.stop()
-                            # Resume
-
-                            if not self.pen_motor.positionPID.target_reached:
-                                self.right_motor.stop()
-                                self.left_motor.stop()
-                            else:
-                                self.right_motor.run_forever(speed_sp=SLOW-100)
-                                l_tgt, r_tgt = self.motor_targets_from_coords(x, top + i * r_step)
-                                self.left_motor.position_sp = l_tgt
-                                self.left_motor.run()
-                                #self.left_motor.run_forever(speed_sp=-SLOW)
-                        else:
-                            self.pen_motor.position_sp = PEN_UP_POS
-                            if not self.pen_motor.positionPID.target_reached:
-                                self.right_motor.stop()
-                                self.left_motor.stop()
-                            else:
-                                speed = FAST - pixels[pixel_location] * (FAST - SLOW) // 255
-                                self.right_motor.run_forever(speed_sp=speed-150)
-                                l_tgt, r_tgt = self.motor_targets_from_coords(x, top + i * r_step)
-                                self.left_motor.position_sp = l_tgt
-                                self.left_motor.run()
-                                # self.left_motor.run_forever(speed_sp=-speed)
-                        self.pen_motor.run()
-
-                        if x >= right:
-                            break
+        :param filename: json file to save the gains to
+        :yield: status messages
+        """
+        gains = load_gains(filename)
+        for name, motor in (('left', self.left_motor), ('right', self.right_motor)):
+            tuner = RelayAutotuner(motor)
+            for message in tuner.run():
+                yield "Tuning {0} motor. {1}".format(name, message)
+            Kp, Ti, Td = tuner.gains()
+            motor.positionPID.Kp = Kp
+            motor.positionPID.Ti = Ti
+            motor.positionPID.Td = Td
+            gains[name] = {'kp': Kp, 'ti': Ti, 'td': Td, 'ku': tuner.Ku, 'tu': tuner.Tu}
+            save_gains(filename, gains)
+            yield "{0} motor: Ku={1:.3f} Tu={2:.3f}s. Kp={3:.3f} Ti={4:.3f} Td={5:.3f}".format(
+                name, tuner.Ku, tuner.Tu, Kp, Ti, Td)
+
+    def load_pid_gains(self, filename='pid_gains.json'):
+        """
+        Apply the gains that were saved by autotune, per motor.
 
-                self.right_motor.stop()
-                self.left_motor.stop()
-                self.pen_up()
-
-                x = right
-                y += r_step
-                self.move_to_coord(x, y, pen=UP, brake=True)
-                yield 66 + (i+1) * 33.33 / num_circles
-
-                while 1:
-
-                        # Look at the pixel we're at and move pen up or down accordingly
-                        x_norm, y_norm = self.coords_from_motor_pos(self.drive_motors[0].position, self.drive_motors[1].position)
-                        x, y = self.normalized_to_global_coords(x_norm, y_norm)
-                        pixel_location = (clamp(x_norm * w, (0,w-1)), clamp(y_norm * w, (0,h-1)))
-                        if pixels[pixel_location] == 255:
-                            self.pen_motor.position_sp = PEN_DOWN_POS
-                            if not self.pen_motor.positionPID.target_reached:
-                                self.right_motor.stop()
-                                self.left_motor.stop()
-                            else:
-                                # self.right_motor.run_forever(speed_sp=-SLOW)
-
-                                self.left_motor.run_forever(speed_sp=SLOW-100)
-                                l_tgt, r_tgt = self.motor_targets_from_coords(x, top + (i+1) * r_step)
-                                self.right_motor.position_sp = r_tgt
-                                self.right_motor.run()
-                        else:
-                            self.pen_motor.position_sp = PEN_UP_POS
-                            if not self.pen_motor.positionPID.target_reached:
-                                self.right_motor.stop()
-                                self.left_motor.stop()
-                            else:
-                                speed = FAST - pixels[pixel_location] * (FAST - SLOW) // 255
-                                #self.right_motor.run_forever(speed_sp=-speed)
-                                self.left_motor.run_forever(speed_sp=speed-150)
-                                l_tgt, r_tgt = self.motor_targets_from_coords(x, top + (i + 1) * r_step)
-                                self.right_motor.position_sp = r_tgt
-                                self.right_motor.run()
-                        self.pen_motor.run()
-
-                        if x <= left:
-                            break
+        :return: True if gains were found
+        """
+        gains = load_gains(filename)
+        self.set_pid_gains(gains)
+        return bool(gains)
 
-            self.right_motor.stop()
-            self.left_motor.stop()
-            self.pen_up()
+    def pid_gains(self):
+        """
+        :return: {'left': {'kp': ..., 'ti': ..., 'td': ...}, 'right': {...}}, like autotune saves them
+        """
+        return dict((name, {'kp': motor.positionPID.Kp, 'ti': motor.positionPID.Ti, 'td': motor.positionPID.Td})
+                    for name, motor in (('left', self.left_motor), ('right', self.right_motor)))
 
-    ### Calibration & manual movement functions ###
+    def set_pid_gains(self, gains):
+        # Per motor, unlike the Kp, Ti and Td properties. Motors that aren't in gains keep theirs.
+        for name, motor in (('left', self.left_motor), ('right', self.right_motor)):
+            if name in gains:
+                motor.positionPID.Kp = gains[name]['kp']
+                motor.positionPID.Ti = gains[name]['ti']
+                motor.positionPID.Td = gains[name]['td']
 
     def pen_up(self):
         self.pen_motor.run_to_abs_pos(position_sp=PEN_UP_POS)
         self.pen_motor.wait_while('running')
 
     def pen_down(self):
+        self.home_chalk()
         self.pen_motor.run_to_abs_pos(position_sp=PEN_DOWN_POS)
         self.pen_motor.wait_while('running')
-        time.sleep(0.5) # Wait a bit to avoid touch sensor bounce.
-        while self.chalk_sensor.is_pressed:
-            self.chalk_motor.run_forever(speed_sp=150)
-            if self.chalk_motor.position > 20552:
+        if self.chalk:
+            time.sleep(0.5) # Wait a bit to avoid touch sensor bounce.
+            # Before the stroke, so an empty holder is reloaded here and not halfway.
+            while not self.chalk_feeder.prime(Throttler(LOOP_RATE, self.stats)):
                 self.reload_chalk()
 
-        self.chalk_motor.stop()
-
     def left_fwd(self):
         self.left_motor.run_direct(duty_cycle_sp=100)
 
@@ -942,5 +837,5 @@ class RopePlotter(object):
     def stop_all_motors(self):
         for motor in self.all_motors:
             motor.stop()
-        print("Motors stopped")
+        plotter_log.info("Motors stopped")
 
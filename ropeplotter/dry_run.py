@@ -0,0 +1,231 @@
+__author__ = 'anton'
+
+import time
+
+import numpy as np
+
+from ropeplotter.raster import canvas_box, canvas_radii
+
+# Shows what plot_circles, plot_circle_waves and optimized_etch will draw, in seconds instead of hours.
+# The same arcs and lines, and the same pen decisions from the same pixels, but computed with numpy
+# on the canvas instead of by driving the motors.
+#
+# It's the ideal plot: the pen goes down exactly where the pixel says so, where the real plotter looks
+# ahead by pen_latency and sometimes lands a bit early or late.
+#
+# Coordinates are in cm from the left attachment point, like in RopePlotter. Pixels are looked up like
+# ropeplotter.raster does, with the picture stretched over the canvas.
+#
+# Usage:
+#
+# image, stats = dry_run(plotter, 'optimized_etch', 'uploads/picture.jpg')
+# image.save('uploads/dry-run.png')
+
+PEN_WIDTH = 0.4     # Width of a drawn line in cm. About a marker.
+WAVE_SPEEDS = (600, 22)     # Fastest and slowest drive speed of plot_circle_waves, in degrees per second
+
+
+class DryRun(object):
+    """
+    Follows the lines of a plot on the canvas, draws them and counts what the plotter would do.
+
+    :param plotter: RopePlotter, or anything with its geometry attributes
+    :param size: (w, h) of the picture, the size of the result
+    :param step: distance between samples along a line, in cm
+    """
+
+    def __init__(self, plotter, size, step=None):
+        from PIL import Image, ImageDraw
+        self.h_margin, self.v_margin = plotter.h_margin, plotter.v_margin
+        self.canvas_size = plotter.canvas_size
+        self.att_dist = plotter.att_dist
+        self.w, self.h = size
+        self.scale = np.array([self.w, self.h], dtype=float) / self.canvas_size     # Pixels per cm, x and y
+        self.step = step or 0.5 / self.scale.max()
+        self.image = Image.new("L", size, 255)
+        self.draw = ImageDraw.Draw(self.image)
+        self.pen_px = max(int(round(PEN_WIDTH * self.scale.mean())), 1)
+        self.position = np.array([self.h_margin, self.v_margin])
+        self.stats = {'lines': 0, 'pen_down_cm': 0.0, 'pen_up_cm': 0.0, 'travel_cm': 0.0, 'pen_toggles': 0}
+
+    def pixels(self, xy):
+        """
+        :param xy: array of (x, y) in cm
+        :return: array of (column, row) of the pixels under those points, clamped to the picture
+        """
+        pixels = (xy - [self.h_margin, self.v_margin]) * self.scale
+        return np.clip(pixels, 0, [self.w - 1, self.h - 1]).astype(int)
+
+    def lookup(self, array, xy):
+        columns, rows = self.pixels(xy).T
+        return array[rows, columns]
+
+    def arc(self, center_x, radius, box, up=True):
+        """
+        Points on a circle around an attachment point, inside a box.
+
+        :param center_x: x of the attachment point, 0 or att_dist
+        :param box: (left, top, right, bottom) in cm
+        :param up: ordered from the bottom up, or else down
+        :return: array of (x, y), can be empty
+        """
+        left, top, right, bottom = box
+        # The box is below the attachment points, so the arc in it lies between the angles of its corners.
+        angles = [np.arctan2(y, x - center_x) for x in (left, right) for y in (top, bottom)]
+        theta = np.arange(min(angles), max(angles), self.step / radius)
+        xy = np.column_stack((center_x + radius * np.cos(theta), radius * np.sin(theta)))
+        xy = xy[(xy[:, 0] >= left) & (xy[:, 0] <= right) & (xy[:, 1] >= top) & (xy[:, 1] <= bottom)]
+        if len(xy) and (xy[0, 1] < xy[-1, 1]) == up:
+            xy = xy[::-1]
+        return xy
+
+    def row(self, y, box, rightward=True):
+        left, top, right, bottom = box
+        x = np.arange(left, right, self.step)
+        if not rightward:
+            x = x[::-1]
+        return np.column_stack((x, np.full(len(x), y)))
+
+    def line(self, xy, pen):
+        """
+        Travel to the start of a line with the pen up and follow it, drawing where pen is True.
+
+        :param xy: array of (x, y) in cm
+        :param pen: array of bool, one for every point
+        """
+        if len(xy) < 2:
+            return
+        self.stats['lines'] += 1
+        self.stats['travel_cm'] += float(np.hypot(*(xy[0] - self.position)))
+        self.position = xy[-1]
+        lengths = np.hypot(*np.diff(xy, axis=0).T)
+        down = pen[:-1]
+        self.stats['pen_down_cm'] += float(lengths[down].sum())
+        self.stats['pen_up_cm'] += float(lengths[~down].sum())
+
+        # Every line starts and ends with the pen up.
+        edges = np.diff(np.concatenate(([0], pen.astype(int), [0])))
+        self.stats['pen_toggles'] += int(np.count_nonzero(edges))
+        starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+        pixels = (xy - [self.h_margin, self.v_margin]) * self.scale
+        for start, end in zip(starts, ends):
+            stroke = pixels[start:end + 1].ravel().tolist()
+            self.draw.line(stroke, fill=0, width=self.pen_px)
+
+    def finish(self):
+        # Back to the origin, like the plot methods.
+        self.stats['travel_cm'] += float(np.hypot(*(self.position - [self.h_margin, self.v_margin])))
+        for key in ('pen_down_cm', 'pen_up_cm', 'travel_cm'):
+            self.stats[key] = round(self.stats[key], 1)
+        del self.draw
+        return self.image, self.stats
+
+
+def circles(plotter, im):
+    """
+    Like RopePlotter.plot_circles: arcs around both attachment points and then horizontal lines.
+    """
+    num_circles = plotter.scanlines
+    pixels = np.asarray(im)
+    run = DryRun(plotter, im.size)
+    box = canvas_box(plotter)
+    r_min, r_step = canvas_radii(plotter, num_circles)
+    for right_side_mode in [0, 1]:
+        center_x = right_side_mode * plotter.att_dist
+        for i in range(1, num_circles + 1):
+            xy = run.arc(center_x, r_min + r_step * i, box, up=i % 2)
+            run.line(xy, run.lookup(pixels, xy) < 120 + 60 * right_side_mode)
+    for i in range(num_circles):
+        xy = run.row(plotter.v_margin + i * plotter.canvas_size * 1.0 / num_circles, box, rightward=not i % 2)
+        run.line(xy, run.lookup(pixels, xy) < 60)
+    return run.finish()
+
+
+def circle_waves(plotter, im):
+    """
+    Like RopePlotter.plot_circle_waves: arcs around the left attachment point that wiggle more and drive
+    slower where it's darker. The wiggle is timed, so the time along the arc comes from the drive speed.
+    """
+    fast, slow = WAVE_SPEEDS
+    cm_to_deg = abs(plotter.cm_to_deg)
+    # Samples close enough to follow the shortest wiggles, at the slowest speed.
+    run = DryRun(plotter, im.size)
+    run.step = min(run.step, float(slow) / cm_to_deg / 8)
+    darkness = 1 - np.asarray(im, dtype=float) / 255
+    box = canvas_box(plotter)
+    r_min, r_step = canvas_radii(plotter, plotter.scanlines)
+    amplitude = r_step / 2 * 1.15     # In cm, plot_circle_waves has it in degrees.
+    half_wavelength = 0.5
+    for i in range(1, plotter.scanlines + 1):
+        radius = r_min + r_step * i
+        xy = run.arc(0, radius, box, up=i % 2)
+        if len(xy) < 2:
+            continue
+        dark = run.lookup(darkness, xy)
+        speed = fast - (fast - slow) * dark ** 0.9
+        t = np.cumsum(run.step * cm_to_deg / speed)
+        # The amplitude is sampled once every half wave and held.
+        samples = np.floor(t / half_wavelength).astype(int)
+        first = np.unique(samples, return_index=True)[1]
+        held = dark[first][np.searchsorted(samples[first], samples)]
+        # The anchor motor wiggles the radius. The arc is around (0, 0), so scale the points.
+        wiggle = 1 + amplitude * held * np.sin(t * np.pi / half_wavelength) / radius
+        run.line(xy * wiggle[:, None], dark > 0.2)
+    return run.finish()
+
+
+def etch(plotter, im):
+    """
+    Like RopePlotter.optimized_etch: three darkness levels, each etched region by region.
+    """
+    from ropeplotter.regions import find_regions
+    from PIL import Image
+    w, h = im.size
+    run = DryRun(plotter, im.size)
+    r_step = plotter.r_step
+    for direction, level in enumerate([180, 120, 65]):
+        etch_area = Image.eval(im, lambda x: (x < level) * 255)
+        for region in find_regions(etch_area, cell=r_step / plotter.canvas_size * w):
+            mask = np.asarray(region.mask(etch_area))
+            left, top = plotter.normalized_to_global_coords(float(region.box[0]) / w, float(region.box[1]) / h)
+            right, bottom = plotter.normalized_to_global_coords(float(region.box[2]) / w, float(region.box[3]) / h)
+            box = (left, top, right, bottom)
+            if direction < 2:
+                if direction:
+                    r_min = ((plotter.att_dist - right) ** 2 + top ** 2) ** 0.5
+                    r_max = ((plotter.att_dist - left) ** 2 + bottom ** 2) ** 0.5
+                else:
+                    r_min = (left ** 2 + top ** 2) ** 0.5
+                    r_max = (right ** 2 + bottom ** 2) ** 0.5
+                num_circles = int(round((r_max - r_min) / r_step))
+                for i in range(1, num_circles, 2):
+                    for j, up in ((i, True), (i + 1, False)):
+                        xy = run.arc(direction * plotter.att_dist, r_min + r_step * j, box, up=up)
+                        run.line(xy, run.lookup(mask, xy) == 255)
+            else:
+                num_circles = int(round((bottom - top) / r_step))
+                for i in range(0, num_circles, 2):
+                    for j, rightward in ((i, True), (i + 1, False)):
+                        xy = run.row(top + j * r_step, box, rightward)
+                        run.line(xy, run.lookup(mask, xy) == 255)
+    return run.finish()
+
+
+DRY_RUNS = {'plot_circles': circles,
+            'plot_circle_waves': circle_waves,
+            'optimized_etch': etch}
+
+
+def dry_run(plotter, method, filename):
+    """
+    :param plotter: RopePlotter, for its geometry. Its motors aren't used.
+    :param method: name of the plot method, a key of DRY_RUNS
+    :param filename: the picture
+    :return: PIL image of the result, the size of the picture, and a dict of stats: lines, pen_down_cm,
+        pen_up_cm (along the lines), travel_cm (between them), pen_toggles and seconds it took
+    """
+    from PIL import Image
+    t_start = time.time()
+    image, stats = DRY_RUNS[method](plotter, Image.open(filename).convert("L"))
+    stats['seconds'] = round(time.time() - t_start, 1)
+    return image, stats
@@ -0,0 +1,19 @@
+__author__ = 'anton'
+
+# Picks the library that talks to the motors and sensors. On the brick that's ev3dev.
+# With ROPEPLOTTER_STUB=1 in the environment it's ropeplotter.stub, which simulates the motors,
+# so the server and the tools that use the plotter kinematics can run on a laptop.
+#
+# Usage:
+#
+# from ropeplotter.hardware import ev3
+# motor = ev3.Motor(ev3.OUTPUT_B)
+
+import os
+
+STUB = os.environ.get('ROPEPLOTTER_STUB', '') not in ('', '0')
+
+if STUB:
+    from ropeplotter import stub as ev3
+else:
+    import ev3dev.auto as ev3
@@ -0,0 +1,330 @@
+__author__ = 'anton'
+
+import time
+
+import numpy as np
+
+from ropeplotter.core import UP, DOWN
+
+# Turns a picture into lines for plot_from_file, on the brick. No need for a vector tool on another computer.
+#
+# Every generator gets a deadline. Whatever isn't done by then is done the quick way, like a tour that
+# isn't optimized any further, so the result is always complete.
+#
+# Coordinates are normalized like in a coords.csv. The picture keeps its aspect ratio and its long side
+# fills the canvas. Spacing is the distance between lines or dots, normalized too, e.g. r_step / canvas_size.
+#
+# Usage:
+#
+# points, seconds = generate_path(Image.open('uploads/picture.jpg'), 'stipple', spacing=0.02, budget=60)
+# write_path('uploads/coords.csv', points)
+
+
+def generate_path(image, method, spacing, budget=60):
+    """
+    :param image: PIL image
+    :param method: key of GENERATORS
+    :param spacing: normalized distance between dots or lines
+    :param budget: seconds the generator may take. It will stop optimizing after that.
+    :return: list of (x_norm, y_norm, pen), seconds it took
+    """
+    t_start = time.time()
+    points = GENERATORS[method](image.convert("L"), spacing, t_start + budget)
+    return points, time.time() - t_start
+
+
+def darkness_map(image, size, blur=0):
+    """
+    The picture as an array of darkness, from 0 (white) to 1 (black), scaled so its long side is size pixels.
+    """
+    from PIL import ImageFilter
+    w, h = image.size
+    scale = float(size) / max(w, h)
+    image = image.resize((max(int(w * scale), 1), max(int(h * scale), 1)))
+    if blur:
+        image = image.filter(ImageFilter.GaussianBlur(blur))
+    return 1 - np.asarray(image, dtype=float) / 255
+
+
+def pen_runs(xy, drawn):
+    """
+    Points along a line, drawn where drawn is True. Every run of drawn points is a stroke that starts with
+    a travel move. Runs of a single point are left out.
+
+    :param xy: array of (x_norm, y_norm)
+    :param drawn: array of bool
+    :return: list of (x_norm, y_norm, pen)
+    """
+    edges = np.diff(np.concatenate(([0], drawn.astype(int), [0])))
+    starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    points = []
+    for start, end in zip(starts, ends):
+        if end - start > 1:
+            stroke = xy[start:end].tolist()
+            points.append((stroke[0][0], stroke[0][1], UP))
+            points += [(x, y, DOWN) for x, y in stroke[1:]]
+    return points
+
+
+### Stippling ###
+
+def stipple_path(image, spacing, deadline):
+    """
+    Dots, where Floyd-Steinberg error diffusion puts them. The pen visits them in a tour that
+    starts as a serpentine and is then shortened with 2-opt until the deadline.
+    """
+    size = int(1 / spacing)
+    error = darkness_map(image, size)
+    h, w = error.shape
+    dots = np.zeros((h, w), dtype=bool)
+    for y in range(h):
+        if time.time() > deadline:
+            # Out of time. Threshold the rest.
+            dots[y:] = error[y:] > 0.5
+            break
+        # Every other row goes right to left, that gives less streaks. The error to the right goes
+        # along the row one pixel at a time, the error to the row below is added all at once.
+        reverse = y % 2 == 1
+        values = (error[y, ::-1] if reverse else error[y]).tolist()
+        below = [0.0] * (w + 2)
+        row = [False] * w
+        carry = 0.0
+        for x in range(w):
+            value = values[x] + carry
+            row[x] = value > 0.5
+            e = value - row[x]
+            carry = e * 7 / 16
+            below[x] += e * 3 / 16
+            below[x + 1] += e * 5 / 16
+            below[x + 2] += e * 1 / 16
+        below = np.array(below[1:w + 1])
+        row = np.array(row)
+        if reverse:
+            below, row = below[::-1], row[::-1]
+        dots[y] = row
+        if y + 1 < h:
+            error[y + 1] += below
+
+    ys, xs = np.nonzero(dots)
+    if not len(xs):
+        return []
+    # np.nonzero goes row by row. Turn every other row around for a serpentine.
+    xs = np.where(ys % 2 == 1, w - 1 - xs, xs)
+    order = np.lexsort((xs, ys))
+    xs = np.where(ys % 2 == 1, w - 1 - xs, xs)
+    tour = (np.column_stack((xs, ys))[order] + 0.5) / size
+    tour = two_opt(tour, deadline)
+
+    points = []
+    for x, y in tour.tolist():
+        # A dot: travel there, then 'draw' to the same spot, which puts the pen down.
+        points += [(x, y, UP), (x, y, DOWN)]
+    return points
+
+
+def two_opt(tour, deadline, window=100):
+    """
+    Shorten an open tour by reversing parts of it, as long as that makes it shorter. Only looks
+    window points ahead, because a serpentine is already close to good.
+
+    :param tour: array of (x, y)
+    :return: array of (x, y)
+    """
+    tour = tour.copy()
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 3):
+            if i % 64 == 0 and time.time() > deadline:
+                return tour
+            j = np.arange(i + 2, min(i + window, n - 1))
+            a, b = tour[i], tour[i + 1]
+            c, d = tour[j], tour[j + 1]
+            gain = (np.hypot(*(a - b)) + np.hypot(*(c - d).T) -
+                    np.hypot(*(c - a).T) - np.hypot(*(d - b).T))
+            best = np.argmax(gain)
+            if gain[best] > 1e-9:
+                tour[i + 1:j[best] + 1] = tour[i + 1:j[best] + 1][::-1]
+                improved = True
+    return tour
+
+
+### Contour hatching ###
+
+CONTOUR_LEVELS = (0.2, 0.4, 0.6, 0.8)     # Darkness of the tones that get their own contours
+
+# Marching squares. Corners of a cell above the level: top left 8, top right 4, bottom right 2,
+# bottom left 1. For every case the edges that the contour crosses, in pairs.
+TOP, RIGHT, BOTTOM, LEFT = range(4)
+SQUARE_CASES = {1: [(LEFT, BOTTOM)], 2: [(BOTTOM, RIGHT)], 3: [(LEFT, RIGHT)], 4: [(TOP, RIGHT)],
+                5: [(LEFT, BOTTOM), (TOP, RIGHT)], 6: [(TOP, BOTTOM)], 7: [(LEFT, TOP)], 8: [(LEFT, TOP)],
+                9: [(TOP, BOTTOM)], 10: [(LEFT, TOP), (BOTTOM, RIGHT)], 11: [(TOP, RIGHT)], 12: [(LEFT, RIGHT)],
+                13: [(BOTTOM, RIGHT)], 14: [(LEFT, BOTTOM)]}
+
+
+def contour_path(image, spacing, deadline):
+    """
+    Lines that follow the outlines of the dark parts. Every tone in CONTOUR_LEVELS gets rings at the same
+    distance from its outline, so darker parts, that have more tones, get more rings.
+    """
+    size = int(2 / spacing)     # Two pixels between the lines of the darkest parts
+    darkness = darkness_map(image, size, blur=1)
+    period = 2.0 * len(CONTOUR_LEVELS)
+    lines = []
+    for k, level in enumerate(CONTOUR_LEVELS):
+        if time.time() > deadline:
+            break
+        # A white border makes all contours closed loops.
+        distance = distance_field(np.pad(darkness > level, 1))
+        offset = 0.5 + period * k / len(CONTOUR_LEVELS)
+        for ring in np.arange(offset, distance.max(), period):
+            lines += marching_squares(distance, ring)
+
+    lines = [(line - 0.5) / size for line in lines if len(line) > 2]    # There's a one pixel border
+    points = []
+    for line in nearest_first(lines, deadline):
+        points += [(line[0][0], line[0][1], UP)] + [(x, y, DOWN) for x, y in line[1:].tolist()]
+    return points
+
+
+def distance_field(mask):
+    """
+    How far every pixel of mask is inside it, counted in erosion steps. Steps go alternately
+    straight and diagonal, for rings that are nearly round. Smoothed a bit for the contours.
+    """
+    distance = np.zeros(mask.shape)
+    step = 0
+    while mask.any():
+        distance += mask
+        inner = mask.copy()
+        inner[1:] &= mask[:-1]
+        inner[:-1] &= mask[1:]
+        inner[:, 1:] &= mask[:, :-1]
+        inner[:, :-1] &= mask[:, 1:]
+        if step % 2:
+            inner[1:, 1:] &= mask[:-1, :-1]
+            inner[:-1, :-1] &= mask[1:, 1:]
+            inner[1:, :-1] &= mask[:-1, 1:]
+            inner[:-1, 1:] &= mask[1:, :-1]
+        mask = inner
+        step += 1
+    smooth = distance.copy()
+    smooth[1:-1, 1:-1] = sum([distance[1 + dy:distance.shape[0] - 1 + dy, 1 + dx:distance.shape[1] - 1 + dx]
+                              for dy in (-1, 0, 1) for dx in (-1, 0, 1)]) / 9.0
+    return smooth
+
+
+def marching_squares(field, level):
+    """
+    Contours of a 2d array at a level.
+
+    :return: list of arrays of (x, y) in pixels. Closed contours end where they start.
+    """
+    h, w = field.shape
+    above = field > level
+    case = above[:-1, :-1] * 8 + above[:-1, 1:] * 4 + above[1:, 1:] * 2 + above[1:, :-1] * 1
+
+    # Where the contour crosses every edge between two pixels. Horizontal edges get the first ids,
+    # vertical ones the rest.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_h = np.clip((level - field[:, :-1]) / (field[:, 1:] - field[:, :-1]), 0, 1)
+        t_v = np.clip((level - field[:-1]) / (field[1:] - field[:-1]), 0, 1)
+    rows, columns = np.mgrid[0:h, 0:w]
+    x = np.concatenate(((columns[:, :-1] + np.nan_to_num(t_h)).ravel(), columns[:-1].ravel()))
+    y = np.concatenate((rows[:, :-1].ravel(), (rows[:-1] + np.nan_to_num(t_v)).ravel()))
+    n_horizontal = h * (w - 1)
+
+    def edge_ids(r, c, edge):
+        if edge == TOP:
+            return r * (w - 1) + c
+        if edge == BOTTOM:
+            return (r + 1) * (w - 1) + c
+        if edge == LEFT:
+            return n_horizontal + r * w + c
+        return n_horizontal + r * w + c + 1
+
+    neighbours = {}
+    for square, segments in SQUARE_CASES.items():
+        r, c = np.nonzero(case == square)
+        for edge_a, edge_b in segments:
+            for a, b in zip(edge_ids(r, c, edge_a).tolist(), edge_ids(r, c, edge_b).tolist()):
+                neighbours.setdefault(a, []).append(b)
+                neighbours.setdefault(b, []).append(a)
+
+    # Walk along the segments. Every edge has two of them, so this goes round until it's back at the start.
+    contours = []
+    while neighbours:
+        current = next(iter(neighbours))
+        contour = [current]
+        while current in neighbours:
+            following = neighbours[current]
+            next_edge = following.pop()
+            if not following:
+                del neighbours[current]
+            neighbours[next_edge].remove(current)
+            if not neighbours[next_edge]:
+                del neighbours[next_edge]
+            contour.append(next_edge)
+            current = next_edge
+        contours.append(np.column_stack((x[contour], y[contour])))
+    return contours
+
+
+def nearest_first(lines, deadline):
+    """
+    Order lines so the next one starts close to where the last one ended. After the deadline the
+    rest goes in the order it was in.
+    """
+    ordered = []
+    starts = np.array([line[0] for line in lines]).reshape(-1, 2)
+    left = np.ones(len(lines), dtype=bool)
+    position = np.zeros(2)
+    while left.any():
+        if time.time() > deadline:
+            return ordered + [line for line, todo in zip(lines, left) if todo]
+        distances = np.hypot(*(starts - position).T)
+        distances[~left] = np.inf
+        nearest = np.argmin(distances)
+        left[nearest] = False
+        ordered.append(lines[nearest])
+        position = lines[nearest][-1]
+    return ordered
+
+
+### Spiral ###
+
+def spiral_path(image, spacing, deadline):
+    """
+    One spiral from the middle out, that wiggles more where the picture is darker. White parts
+    are skipped with the pen up.
+    """
+    size = int(2 / spacing)
+    darkness = darkness_map(image, size)
+    h, w = darkness.shape
+    pitch = 2 * spacing         # Between the turns
+    wavelength = spacing
+    center = np.array([w, h]) / 2.0 / size
+    radius = np.hypot(*center)
+
+    # Points at about equal distances along an archimedean spiral r = b * theta.
+    b = pitch / (2 * np.pi)
+    length = np.pi * radius ** 2 / pitch
+    s = np.arange(0, length, wavelength / 4)
+    theta = np.sqrt(2 * s / b)
+    r = b * theta
+    base = center + np.column_stack((r * np.cos(theta), r * np.sin(theta)))
+
+    pixel = np.clip((base * size).astype(int), 0, [w - 1, h - 1])
+    inside = np.all((base >= 0) & (base * size < [w, h]), axis=1)
+    dark = np.where(inside, darkness[pixel[:, 1], pixel[:, 0]], 0)
+    r = r + dark * pitch / 2 * np.sin(2 * np.pi * s / wavelength)
+    xy = center + np.column_stack((r * np.cos(theta), r * np.sin(theta)))
+    # Wiggles at the edge of the picture reach half a pitch past it, off the canvas.
+    xy = np.clip(xy, 0, np.array([w, h]) / float(size))
+    return pen_runs(xy, dark > 0.05)
+
+
+GENERATORS = {'stipple': stipple_path,
+              'contours': contour_path,
+              'spiral': spiral_path}
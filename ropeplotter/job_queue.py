@@ -0,0 +1,160 @@
+__author__ = 'anton'
+
+import json
+import os
+import shutil
+import threading
+import time
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ABORTED = 'aborted'
+INTERRUPTED = 'interrupted'
+
+
+class JobQueue(object):
+    """
+    A persistent list of plot jobs. Every job has its own copy of the file to plot, the mode
+    to plot it in and the plotter settings at the time it was added. The list is saved as json
+    after every change, so it survives a restart of the server or the brick.
+
+    Usage:
+
+    jobs = JobQueue('jobs')
+    jobs.add('uploads/coords.csv', 'plot', {'kp': 2}, pause_before=True)
+    job = jobs.next_job()
+    """
+    MODES = ('plot', 'plotcircles', 'plotwaves')
+
+    def __init__(self, path='jobs'):
+        self.path = path
+        self.index_file = os.path.join(path, 'queue.json')
+        self.lock = threading.RLock()
+        self.jobs = []
+        self.next_id = 1
+        self.auto_start = False     # Start the next job as soon as the previous one is done.
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file) as f:
+            data = json.load(f)
+        self.jobs = data['jobs']
+        self.next_id = data['next_id']
+        self.auto_start = data.get('auto_start', False)
+        for job in self.jobs:
+            # A job that was running when we went down can't just be started over. Leave it for a human.
+            if job['status'] == RUNNING:
+                job['status'] = INTERRUPTED
+
+    def save(self):
+        with self.lock:
+            data = {'jobs': self.jobs, 'next_id': self.next_id, 'auto_start': self.auto_start}
+            # Write to a temp file first, so a crash halfway doesn't leave a corrupt queue.
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_file, self.index_file)
+
+    def add(self, source_file, mode, settings, pause_before=False, name=None):
+        """
+        Add a job to the end of the queue. The source file is copied, so later uploads don't change the job.
+
+        :param source_file: str, path of the coords.csv or picture.jpg to plot
+        :param mode: one of JobQueue.MODES
+        :param settings: dict with plotter settings, same keys as the settings forms on the web page, and the gains
+            of each motor
+        :param pause_before: bool, wait for a 'continue' command before starting, e.g. to change the pen.
+        :param name: str to recognize the job by, e.g. the tile of a mural. Optional.
+        :return: the new job (dict)
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown plot mode: {0}".format(mode))
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            job_file = os.path.join(self.path, "{0}-{1}".format(job_id, os.path.basename(source_file)))
+            shutil.copyfile(source_file, job_file)
+            job = {'id': job_id,
+                   'file': job_file,
+                   'mode': mode,
+                   'settings': settings,
+                   'pause_before': bool(pause_before),
+                   'name': name,
+                   'status': QUEUED,
+                   'added': time.strftime("%Y-%m-%d %H:%M:%S")}
+            self.jobs.append(job)
+            self.save()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            for job in self.jobs:
+                if job['id'] == int(job_id):
+                    return job
+
+    def remove(self, job_id):
+        with self.lock:
+            job = self.get(job_id)
+            if job is None or job['status'] == RUNNING:
+                return False
+            self.jobs.remove(job)
+            if os.path.exists(job['file']):
+                os.remove(job['file'])
+            self.save()
+            return True
+
+    def move(self, job_id, position):
+        """
+        Move a job to a new position in the queue.
+
+        :param job_id: int
+        :param position: int, 0 is the front of the queue
+        :return: True if the job was found
+        """
+        with self.lock:
+            job = self.get(job_id)
+            if job is None:
+                return False
+            self.jobs.remove(job)
+            self.jobs.insert(max(0, int(position)), job)
+            self.save()
+            return True
+
+    def requeue(self, job_id):
+        with self.lock:
+            job = self.get(job_id)
+            if job is None or job['status'] == RUNNING:
+                return False
+            job['status'] = QUEUED
+            self.save()
+            return True
+
+    def set_status(self, job_id, status):
+        with self.lock:
+            job = self.get(job_id)
+            if job is not None:
+                job['status'] = status
+                self.save()
+
+    def clear_done(self):
+        with self.lock:
+            for job in [job for job in self.jobs if job['status'] == DONE]:
+                self.remove(job['id'])
+
+    def next_job(self):
+        with self.lock:
+            for job in self.jobs:
+                if job['status'] == QUEUED:
+                    return job
+
+    def status(self):
+        """
+        :return: dict that can be sent over the websocket as json.
+        """
+        with self.lock:
+            return {'queue': [dict(job) for job in self.jobs], 'auto_start': self.auto_start}
@@ -0,0 +1,88 @@
+__author__ = 'anton'
+
+# Rope lengths to coordinates and back, with integers only.
+#
+# The EV3's ARM9 has no FPU. Every float multiply is a function call there, and a square root or ** 0.5 is a
+# long one. Those are in every pass of the control loops. Here lengths are ints in 1/SCALE cm, which is
+# less than a tenth of an encoder degree for any sensible cm_to_deg, so the results are within one degree
+# of the float math in RopePlotter.
+#
+# Square roots are Newton's method on ints, started from the root of the last call. The plotter moves
+# a little per pass, so that takes two or three steps. x comes from the two rope lengths in one go:
+# the pen is where two circles around the attachment points cross. No Heron's formula and no second root.
+#
+# RopePlotter uses this when it's made with fixed_point=True. That's off by default, until
+# benchmark_kinematics.py on an EV3 shows it's faster there. It compares both on the same inputs.
+#
+# Usage:
+#
+# kinematics = FixedPointKinematics(l_rope_0, r_rope_0, att_dist, cm_to_deg, h_margin, v_margin, canvas_size)
+# left, right = kinematics.motor_targets_from_coords(x, y)
+# x_norm, y_norm = kinematics.coords_from_motor_pos(left, right)
+
+SCALE_BITS = 12
+SCALE = 1 << SCALE_BITS     # Units per cm
+
+
+def isqrt(n, guess=0):
+    """
+    Square root of an int, rounded down.
+
+    :param n: int >= 0
+    :param guess: a root close by speeds it up, e.g. the one of the last pass. Not needed.
+    :return: int
+    """
+    if n <= 0:
+        return 0
+    x = guess if guess > 0 else 1 << ((n.bit_length() + 1) >> 1)
+    # One step from anywhere lands on or above the root. From there, every step goes down to it.
+    x = (x + n // x) >> 1
+    while 1:
+        y = (x + n // x) >> 1
+        if y >= x:
+            return x
+        x = y
+
+
+class FixedPointKinematics(object):
+    """
+    The kinematics of RopePlotter in ints. Coordinates in and out are cm and normalized canvas
+    coordinates, like RopePlotter's. Only the math in between is integer.
+
+    The last roots are kept as guesses for the next call. When two threads use it, like the path
+    planner and the control loop, a guess can be off. That only takes a few more steps.
+    """
+
+    def __init__(self, l_rope_0, r_rope_0, att_dist, cm_to_deg, h_margin, v_margin, canvas_size):
+        self.cm_to_deg = int(cm_to_deg)
+        self.l_rope_0 = int(round(l_rope_0 * SCALE))
+        self.r_rope_0 = int(round(r_rope_0 * SCALE))
+        self.att_dist = int(round(att_dist * SCALE))
+        self.att_dist_sq = self.att_dist ** 2
+        self.h_margin = int(round(h_margin * SCALE))
+        self.v_margin = int(round(v_margin * SCALE))
+        self.canvas_size = int(round(canvas_size * SCALE))
+        self.last_l = self.last_r = self.last_y = 0
+
+    def motor_targets_from_coords(self, x, y):
+        x = int(x * SCALE)
+        y = int(y * SCALE)
+        y_sq = y * y
+        l_rope = self.last_l = isqrt(x * x + y_sq, self.last_l)
+        dx = self.att_dist - x
+        r_rope = self.last_r = isqrt(dx * dx + y_sq, self.last_r)
+        # Rounded toward zero, like int() of the float targets.
+        l_target = (l_rope - self.l_rope_0) * self.cm_to_deg
+        r_target = (r_rope - self.r_rope_0) * self.cm_to_deg
+        return (l_target >> SCALE_BITS if l_target >= 0 else -(-l_target >> SCALE_BITS),
+                r_target >> SCALE_BITS if r_target >= 0 else -(-r_target >> SCALE_BITS))
+
+    def coords_from_motor_pos(self, l_motor, r_motor):
+        # Positions are ints, but look ahead gives floats. One multiply makes those ints too.
+        l_rope = int(l_motor * SCALE) // self.cm_to_deg + self.l_rope_0
+        r_rope = int(r_motor * SCALE) // self.cm_to_deg + self.r_rope_0
+        l_sq = l_rope * l_rope
+        x = (l_sq - r_rope * r_rope + self.att_dist_sq) // (2 * self.att_dist)
+        y = self.last_y = isqrt(l_sq - x * x, self.last_y)
+        # The callers work with floats. These are the only float operations.
+        return (x - self.h_margin) / self.canvas_size, (y - self.v_margin) / self.canvas_size
@@ -0,0 +1,175 @@
+__author__ = 'anton'
+
+import queue
+import threading
+
+from ropeplotter.core import UP, DOWN
+from ropeplotter.streaming import BRAKE, PEN_DOWN_AFTER, PEN_UP_AFTER
+
+# Turns files into motor frames for a FrameServer. This is the work the brick is too slow for,
+# so it runs on the host, with a RopePlotter that has the same geometry as the one on the brick.
+#
+# On the brick, PathPlanner makes the same frames for plot_from_file, in a thread that stays ahead
+# of the motors.
+
+
+def plan_path(plotter, points):
+    """
+    Frames for a list of points, the way plot_from_file would drive them. Travels to the first point
+    and back to the origin at the end.
+
+    :param plotter: RopePlotter, for the kinematics
+    :param points: list of (x_norm, y_norm, pen)
+    :return: list of (left, right, pen, flags)
+    """
+    frames = []
+    for i, (x_norm, y_norm, pen) in enumerate(points):
+        if i == 0:
+            pen = UP
+        next_pen = points[i + 1][2] if i + 1 < len(points) else UP
+        flags = 0
+        if next_pen != pen:
+            flags = PEN_DOWN_AFTER if next_pen == DOWN else PEN_UP_AFTER
+        left, right = plotter.motor_targets_from_norm_coords(x_norm, y_norm)
+        frames.append((left, right, pen, flags))
+    left, right = plotter.motor_targets_from_norm_coords(0, 0)
+    frames.append((left, right, UP, BRAKE))
+    return frames
+
+
+def raster_points(plotter, image, threshold=128, step=1.0):
+    """
+    Hatch the dark parts of an image with horizontal lines, r_step apart. Every line goes the other way,
+    so there's no travel back.
+
+    :param plotter: RopePlotter, for canvas_size and r_step
+    :param image: grayscale PIL image
+    :param threshold: pixels darker than this get a line
+    :param step: cm between points on a line
+    :return: list of (x_norm, y_norm, pen)
+    """
+    w, h = image.size
+    pixels = image.load()
+    rows = max(int(plotter.canvas_size / plotter.r_step), 1)
+    samples = max(int(plotter.canvas_size / step), 1)
+    points = []
+    for row in range(rows + 1):
+        y_norm = float(row) / rows
+        columns = range(samples + 1) if row % 2 == 0 else range(samples, -1, -1)
+        run = []
+        for column in columns:
+            x_norm = float(column) / samples
+            if pixels[min(int(x_norm * w), w - 1), min(int(y_norm * h), h - 1)] < threshold:
+                run.append((x_norm, y_norm))
+                continue
+            points += run_points(run)
+            run = []
+        points += run_points(run)
+    return points
+
+
+def run_points(run):
+    # Travel to the start of a dark run and draw to the end. A single dark dot isn't worth it.
+    if len(run) < 2:
+        return []
+    return [run[0] + (UP,)] + [point + (DOWN,) for point in run[1:]]
+
+
+def point_frame(plotter, seq, point, pen, next_pen):
+    """
+    :return: (seq, left, right, pen, flags) to drive to a point, like plot_path makes them
+    """
+    flags = 0
+    if next_pen != pen:
+        flags = PEN_DOWN_AFTER if next_pen == DOWN else PEN_UP_AFTER
+    left, right = plotter.motor_targets_from_norm_coords(point[0], point[1])
+    return seq, left, right, pen, flags
+
+
+class PathPlanner(threading.Thread):
+    """
+    Reads a coords.csv and turns the points into motor frames, in a thread of its own and at most depth
+    frames ahead of the motors. The motor thread only takes finished frames, so reading the file and the
+    kinematics don't stall the motors, unless the queue runs dry. That's an underrun. They're counted,
+    like the depth of the queue, in plotter.stats.
+
+    Usage:
+
+    planner = PathPlanner(plotter, 'uploads/coords.csv', depth=64)
+    planner.start()
+    for seq, left, right, pen, flags in planner.frames():
+        plotter.drive_frame(left, right, pen, flags)
+
+    :param start_point: index of the first point, to resume. The plotter travels to it with the pen up.
+    """
+
+    def __init__(self, plotter, filename, start_point=0, depth=64):
+        threading.Thread.__init__(self, name="planner")
+        self.daemon = True
+        self.plotter = plotter
+        self.filename = filename
+        self.start_point = start_point
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.total = 0          # Number of points in the file. The last frame, back to the origin, has this seq.
+        self.underruns = 0      # Times the motors had to wait for a frame
+
+    def run(self):
+        try:
+            with open(self.filename) as coords:
+                total = int(coords.readline())  # coords contains it's length on the first line.
+                for i in range(self.start_point):
+                    coords.readline()
+                self.total = total
+                point, pen = None, UP
+                for i in range(self.start_point, total):
+                    next_point = self.plotter.read_coord(coords)
+                    if point is not None:
+                        if not self.put(point_frame(self.plotter, i - 1, point, pen, next_point[2])):
+                            return
+                        pen = next_point[2]
+                    point = next_point
+                if point is not None and not self.put(point_frame(self.plotter, total - 1, point, pen, UP)):
+                    return
+            self.put((total,) + self.plotter.motor_targets_from_norm_coords(0, 0) + (UP, 0))
+        except (IOError, ValueError, IndexError) as e:
+            self.put(e)
+        self.put(None)
+
+    def put(self, item):
+        # Wait for room in the queue, but not after stop().
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def frames(self):
+        """
+        Generator of the planned frames, until the end of the file.
+
+        :yield: (seq, left, right, pen, flags), like the frames of a FrameServer
+        """
+        stats = self.plotter.stats
+        first = True
+        try:
+            while True:
+                if self.queue.empty() and not first:
+                    self.underruns += 1
+                    stats.plan_underruns += 1
+                frame = self.queue.get()
+                first = False
+                stats.plan_depth = self.queue.qsize()
+                if frame is None:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        finally:
+            self.stop()
+
+    def stop(self):
+        # After the last frame or an abort. The thread ends the next time it has something to put.
+        self.stopped.set()
@@ -0,0 +1,260 @@
+__author__ = 'anton'
+
+import math
+import time
+
+from ropeplotter.core import UP, DOWN, SLOW, FAST
+from ropeplotter.robot_helpers import clamp
+
+# The control loop of the raster modes: plot_circles, plot_circle_waves and etch_region. They all drive
+# along lines over the picture, with one motor or both, and put the pen down where the picture says so.
+#
+# A scan is one line: where it starts, how to drive the motors along it and where it ends. A policy says
+# what the pen does and how fast to drive, from the pixel under the pen. sweep() is the loop that puts
+# them together, so every mode gets the same pacing, look ahead and distance counting, which feeds the chalk.
+#
+# Usage:
+#
+# picture = Picture(Image.open('uploads/picture.jpg').convert("L"))
+# scan = ArcScan(plotter, radius, canvas_box(plotter), up=True)
+# plotter.travel_to_coord(*scan.start, brake=True)
+# sweep(plotter, scan, Threshold(120), picture, throttle)
+
+
+class Picture(object):
+    """
+    Pixels of a grayscale picture that fills the canvas.
+
+    :param image: PIL image, mode "L"
+    """
+
+    def __init__(self, image):
+        self.pixels = image.load()
+        self.w, self.h = image.size
+
+    def pixel(self, x_norm, y_norm):
+        # Columns go with the width and rows with the height, also when the picture isn't square.
+        return self.pixels[int(clamp(x_norm * self.w, (0, self.w - 1))), int(clamp(y_norm * self.h, (0, self.h - 1)))]
+
+
+def canvas_box(plotter):
+    """
+    :return: (left, top, right, bottom) of the canvas in cm, from the left attachment point
+    """
+    return (plotter.h_margin, plotter.v_margin,
+            plotter.h_margin + plotter.canvas_size, plotter.v_margin + plotter.canvas_size)
+
+
+def canvas_radii(plotter, num_circles):
+    """
+    :return: r_min, r_step of num_circles arcs around the left attachment point, that cover the canvas
+    """
+    r_min = (plotter.h_margin ** 2 + plotter.v_margin ** 2) ** 0.5
+    r_max = ((plotter.h_margin + plotter.canvas_size) ** 2 + (plotter.v_margin + plotter.canvas_size) ** 2) ** 0.5
+    return r_min, (r_max - r_min) / num_circles
+
+
+### Scans ###
+
+class ArcScan(object):
+    """
+    An arc around the left or right attachment point, inside a box. One motor drives, the other
+    one is the anchor and holds still.
+
+    :param plotter: RopePlotter
+    :param radius: cm
+    :param box: (left, top, right, bottom) in cm
+    :param right_side: around the right attachment point
+    :param up: from the bottom or left edge up to the top or right edge, or else back down
+    """
+
+    def __init__(self, plotter, radius, box, right_side=False, up=True):
+        self.plotter = plotter
+        self.box = box
+        self.right_side = right_side
+        self.direction = 1 if up else -1
+        if right_side:
+            self.drive_motor, self.anchor_motor = plotter.drive_motors
+        else:
+            self.anchor_motor, self.drive_motor = plotter.drive_motors
+        self.motors = [self.drive_motor, self.anchor_motor]
+        self.start = self.start_point(radius)
+
+    def start_point(self, radius):
+        # Where the circle enters the box, with x measured from the anchor.
+        left, top, right, bottom = self.box
+        att_dist = self.plotter.att_dist
+        if self.right_side:
+            near, far, to_x = att_dist - right, att_dist - left, lambda dx: att_dist - dx
+        else:
+            near, far, to_x = left, right, lambda dx: dx
+        if self.direction > 0:
+            # Up from the near side, or from the bottom if the circle crosses that first.
+            y = (radius ** 2 - near ** 2) ** 0.5
+            if y >= bottom:
+                return to_x((radius ** 2 - bottom ** 2) ** 0.5), bottom
+            return to_x(near), y
+        else:
+            # Down from the top, or from the far side.
+            dx = (radius ** 2 - top ** 2) ** 0.5
+            if dx >= far:
+                return to_x(far), (radius ** 2 - far ** 2) ** 0.5
+            return to_x(dx), top
+
+    def begin(self):
+        pass
+
+    def look_ahead_speeds(self, speed):
+        return [speed * self.direction if motor is self.drive_motor else 0 for motor in self.plotter.drive_motors]
+
+    def steer(self, speed, x, y, pixel):
+        self.drive_motor.run_forever(speed_sp=speed * self.direction)
+
+    def done(self, x, y):
+        left, top, right, bottom = self.box
+        if self.direction > 0:
+            return y <= top or (x <= left if self.right_side else x >= right)
+        return y >= bottom or (x >= right if self.right_side else x <= left)
+
+    def stop(self):
+        for motor in self.motors:
+            motor.stop()
+
+
+class WaveScan(ArcScan):
+    """
+    An arc around the left attachment point, with the anchor motor wiggling it like a sine. The wiggle
+    is bigger where the picture is darker. Its amplitude is sampled once every half wave.
+
+    :param amplitude: motor degrees of the wiggle in black
+    :param half_wavelength: seconds per half wave
+    """
+
+    def __init__(self, plotter, radius, box, amplitude, up=True, half_wavelength=0.5):
+        ArcScan.__init__(self, plotter, radius, box, up=up)
+        self.amplitude = amplitude
+        self.half_wavelength = half_wavelength
+
+    def begin(self):
+        self.anchor_line = self.anchor_motor.position
+        self.next_sample_time = time.time()
+        self.weighted_amplitude = 0
+
+    def steer(self, speed, x, y, pixel):
+        now = time.time()
+        if now >= self.next_sample_time:
+            self.weighted_amplitude = self.amplitude * (255 - pixel) / 255.0
+            self.next_sample_time = now + self.half_wavelength
+        self.drive_motor.run_forever(speed_sp=speed * self.direction)
+        self.anchor_motor.position_sp = (self.anchor_line +
+                                         math.sin(now * math.pi / self.half_wavelength) * self.weighted_amplitude)
+        self.anchor_motor.run()
+
+
+class RowScan(object):
+    """
+    A horizontal line inside a box. One motor drives and the other one follows, so the pen stays at height y.
+
+    :param plotter: RopePlotter
+    :param y: cm
+    :param box: (left, top, right, bottom) in cm
+    :param rightward: from left to right, or else back
+    """
+
+    def __init__(self, plotter, y, box, rightward=True):
+        self.plotter = plotter
+        self.y = y
+        self.box = box
+        self.rightward = rightward
+        if rightward:
+            self.held_motor, self.drive_motor = plotter.drive_motors
+            self.start = (box[0], y)
+        else:
+            self.drive_motor, self.held_motor = plotter.drive_motors
+            self.start = (box[2], y)
+        self.motors = [self.drive_motor, self.held_motor]
+
+    def begin(self):
+        pass
+
+    def look_ahead_speeds(self, speed):
+        return (-speed, speed) if self.rightward else (speed, -speed)
+
+    def steer(self, speed, x, y, pixel):
+        self.drive_motor.run_forever(speed_sp=speed)
+        targets = self.plotter.motor_targets_from_coords(x, self.y)
+        self.held_motor.position_sp = targets[0] if self.rightward else targets[1]
+        self.held_motor.run()
+
+    def done(self, x, y):
+        return x >= self.box[2] if self.rightward else x <= self.box[0]
+
+    def stop(self):
+        for motor in self.motors:
+            motor.stop()
+
+
+### Pen and speed policies. They get a pixel, 0 is black, and return (pen, speed). ###
+
+class Threshold(object):
+    # Pen down where the picture is darker than a level.
+    def __init__(self, level, slow=SLOW, fast=FAST):
+        self.level, self.slow, self.fast = level, slow, fast
+
+    def __call__(self, pixel):
+        if pixel < self.level:
+            return DOWN, self.slow
+        return UP, self.fast
+
+
+class Etch(object):
+    # Pen down on the pixels of an etch mask (255). Between them, faster where it's further from etching.
+    def __init__(self, slow=SLOW, fast=FAST):
+        self.slow, self.fast = slow, fast
+
+    def __call__(self, pixel):
+        if pixel == 255:
+            return DOWN, self.slow
+        return UP, self.fast - pixel * (self.fast - self.slow) // 255
+
+
+class Waves(object):
+    # Slower in darker parts, where the waves are bigger, and the pen only up where it's almost white.
+    def __call__(self, pixel):
+        darkness = (255 - pixel) / 255.0
+        return (DOWN if darkness > 0.2 else UP), 600 - 578 * darkness ** 0.9   # Exponential for more contrast.
+
+
+### The loop ###
+
+def sweep(plotter, scan, policy, picture, throttle):
+    """
+    Drive along a scan until its end, with the pen following the picture. The plotter must be at the
+    start of the scan.
+
+    :param plotter: RopePlotter
+    :param scan: ArcScan, WaveScan or RowScan
+    :param policy: callable that returns (pen, speed) for a pixel
+    :param picture: Picture
+    :param throttle: Throttler
+    """
+    scan.begin()
+    speed = SLOW
+    while 1:
+        throttle.throttle()
+        positions = [motor.position for motor in plotter.drive_motors]
+        x_norm, y_norm = plotter.coords_from_motor_pos(*positions)
+        plotter.count_distance(x_norm, y_norm)
+        x, y = plotter.normalized_to_global_coords(x_norm, y_norm)
+
+        # Look at the pixel we'll be at when the pen gets there and move the pen up or down for it.
+        # This way the drive doesn't have to stop for the pen.
+        pixel = picture.pixel(*plotter.look_ahead(positions, scan.look_ahead_speeds(speed)))
+        pen, speed = policy(pixel)
+        plotter.set_pen(pen)
+        scan.steer(speed, x, y, pixel)
+        plotter.run_pen()
+
+        if scan.done(x, y):
+            break
+    scan.stop()
@@ -0,0 +1,247 @@
+__author__ = 'anton'
+
+from collections import deque
+import heapq
+
+# Splits what optimized_etch has to etch into separate regions, so it doesn't sweep the whole
+# bounding box of all dark pixels. Two dots in opposite corners are two small regions, not the whole canvas.
+#
+# The mask is looked at in cells of about one etch line. Cells with something dark that touch are a region.
+# Regions that are close together are merged if etching their common bounding box is cheaper than etching
+# both and driving between them. Then they're ordered nearest first.
+#
+# Usage:
+#
+# for region in find_regions(etch_area, cell=r_step_in_pixels):
+#     plot_action = plotter.etch_region(region.box, region.mask(etch_area), direction)
+
+# Costs, in cells of sweeping. Sweeping a region costs its area in cells.
+LINE_COST = 1.0         # Travel, braking and pen moves at both ends of every etch line
+REGION_COST = 10.0      # Getting to a region and starting on it
+INDEX_BUCKET = 8        # Cells per side of a bucket in the spatial index
+
+
+class Region(object):
+    """
+    Dark cells that are etched together.
+
+    :param cells: list of (column, row) of cells
+    :param cell: cell size in pixels
+    :param box: (left, top, right, bottom) in pixels, around the dark pixels. Also the bounds to etch.
+    """
+
+    def __init__(self, cells, cell, box):
+        self.cells = cells
+        self.cell = cell
+        self.box = box
+
+    def cost(self):
+        return box_cost(self.box, self.cell)
+
+    def merge(self, other):
+        return Region(self.cells + other.cells, self.cell, merge_box(self.box, other.box))
+
+    def merge_gain(self, other):
+        # Cells of sweeping saved by etching both as one region
+        return self.cost() + other.cost() - box_cost(merge_box(self.box, other.box), self.cell)
+
+    def distance(self, x, y):
+        # From a point to the box, in pixels. 0 inside.
+        left, top, right, bottom = self.box
+        dx = max(left - x, 0, x - right)
+        dy = max(top - y, 0, y - bottom)
+        return (dx ** 2 + dy ** 2) ** 0.5
+
+    def center(self):
+        left, top, right, bottom = self.box
+        return (left + right) / 2.0, (top + bottom) / 2.0
+
+    def pixel_box(self, mask):
+        """
+        Tight box around the dark pixels of this region. Only looks at its own cells, not the whole mask.
+
+        :param mask: PIL image, 255 where to etch
+        :return: (left, top, right, bottom) in pixels
+        """
+        box = None
+        for column, row in self.cells:
+            left, top = column * self.cell, row * self.cell
+            dark = mask.crop((left, top, left + self.cell, top + self.cell)).getbbox()
+            if dark:
+                dark = (left + dark[0], top + dark[1], left + dark[2], top + dark[3])
+                box = merge_box(box, dark) if box else dark
+        return box
+
+    def mask(self, mask):
+        """
+        The part of the mask in this region. Other regions can be inside its box, e.g. a dot
+        inside a ring, and they shouldn't be etched twice.
+
+        :param mask: PIL image, 255 where to etch
+        :return: PIL image of the same size, with only the pixels of this region
+        """
+        from PIL import Image
+        result = Image.new(mask.mode, mask.size, 0)
+        w, h = mask.size
+        for column, row in self.cells:
+            box = (column * self.cell, row * self.cell, min((column + 1) * self.cell, w), min((row + 1) * self.cell, h))
+            result.paste(mask.crop(box), box)
+        return result
+
+
+def merge_box(box, other):
+    return tuple([min(a, b) for a, b in zip(box[:2], other[:2])] + [max(a, b) for a, b in zip(box[2:], other[2:])])
+
+
+def box_cost(box, cell):
+    left, top, right, bottom = box
+    w, h = float(right - left) / cell, float(bottom - top) / cell
+    return w * h + (w + h) * LINE_COST + REGION_COST
+
+
+class GridIndex(object):
+    """
+    Finds regions near a place, without looking at all of them. Regions are in every bucket
+    that their box touches.
+
+    :param bucket: bucket size in pixels
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.buckets = {}
+        self.regions = {}
+
+    def keys(self, box):
+        left, top, right, bottom = [int(v // self.bucket) for v in box]
+        return [(x, y) for x in range(left, right + 1) for y in range(top, bottom + 1)]
+
+    def add(self, key, region):
+        self.regions[key] = region
+        for bucket in self.keys(region.box):
+            self.buckets.setdefault(bucket, set()).add(key)
+
+    def remove(self, key):
+        region = self.regions.pop(key)
+        for bucket in self.keys(region.box):
+            self.buckets[bucket].discard(key)
+
+    def near(self, box, margin):
+        """
+        :return: set of keys of regions that might be within margin pixels of box
+        """
+        left, top, right, bottom = box
+        keys = set()
+        for bucket in self.keys((max(left - margin, 0), max(top - margin, 0), right + margin, bottom + margin)):
+            keys |= self.buckets.get(bucket, set())
+        return keys
+
+    def nearest(self, x, y):
+        """
+        :return: key of the region closest to x, y, or None if there are none left.
+        """
+        if not self.regions:
+            return None
+        margin = self.bucket
+        while True:
+            keys = self.near((x, y, x, y), margin)
+            if keys:
+                key = min(keys, key=lambda k: self.regions[k].distance(x, y))
+                distance = self.regions[key].distance(x, y)
+                if distance <= margin:
+                    return key
+                # Something in a farther bucket can still be closer. Look that far.
+                keys = self.near((x, y, x, y), distance)
+                return min(keys, key=lambda k: self.regions[k].distance(x, y))
+            margin *= 2
+
+
+def label_cells(mask, cell):
+    """
+    Which cells have something to etch, grouped into connected parts. Diagonal neighbours count.
+
+    :param mask: PIL image, 255 where to etch
+    :param cell: pixels per cell
+    :return: list of lists of (column, row)
+    """
+    from PIL import Image
+    w, h = mask.size
+    columns, rows = -(-w // cell), -(-h // cell)
+    # Float, so a single dark pixel in a big cell still counts. Cropped to whole cells, so every cell
+    # of the small image is exactly cell by cell pixels.
+    small = mask.convert("F").crop((0, 0, columns * cell, rows * cell)).resize((columns, rows), Image.BOX)
+    pixels = small.load()
+    todo = set([(c, r) for c in range(columns) for r in range(rows) if pixels[c, r] > 0])
+    parts = []
+    while todo:
+        start = todo.pop()
+        part = [start]
+        queue = deque([start])
+        while queue:
+            c, r = queue.popleft()
+            for neighbour in ((c + 1, r), (c - 1, r), (c, r + 1), (c, r - 1),
+                              (c + 1, r + 1), (c - 1, r - 1), (c + 1, r - 1), (c - 1, r + 1)):
+                if neighbour in todo:
+                    todo.remove(neighbour)
+                    part.append(neighbour)
+                    queue.append(neighbour)
+        parts.append(part)
+    return parts
+
+
+def find_regions(mask, cell, start=(0, 0)):
+    """
+    Regions to etch, merged where that's cheaper and in the order to etch them.
+
+    :param mask: PIL image, 255 where to etch
+    :param cell: pixels per cell, about the distance between etch lines
+    :param start: (x, y) in pixels, where the plotter starts
+    :return: list of Region
+    """
+    cell = max(int(cell), 1)
+    index = GridIndex(cell * INDEX_BUCKET)
+    for key, cells in enumerate(label_cells(mask, cell)):
+        region = Region(cells, cell, None)
+        region.box = region.pixel_box(mask)
+        index.add(key, region)
+    next_key = len(index.regions)
+
+    # Merge the pair that saves the most, until no merge saves anything. Regions farther apart than
+    # the cost of a region can't save anything, so the index only has to look that far.
+    # The gains of all pairs are in a heap, most first. A merge only adds the pairs of the new region.
+    # Pairs with a region that was merged away stay in the heap and are skipped when they come up.
+    margin = REGION_COST * cell
+    gains = []
+    for key, region in index.regions.items():
+        for other_key in index.near(region.box, margin):
+            if other_key > key:
+                gain = region.merge_gain(index.regions[other_key])
+                if gain > 0:
+                    gains.append((-gain, key, other_key))
+    heapq.heapify(gains)
+    while gains:
+        gain, key, other_key = heapq.heappop(gains)
+        if key not in index.regions or other_key not in index.regions:
+            continue
+        merged = index.regions[key].merge(index.regions[other_key])
+        index.remove(key)
+        index.remove(other_key)
+        for other_key in index.near(merged.box, margin):
+            gain = merged.merge_gain(index.regions[other_key])
+            if gain > 0:
+                heapq.heappush(gains, (-gain, other_key, next_key))
+        index.add(next_key, merged)
+        next_key += 1
+
+    # Nearest first, from where the last one was.
+    ordered = []
+    x, y = start
+    while True:
+        key = index.nearest(x, y)
+        if key is None:
+            break
+        region = index.regions[key]
+        index.remove(key)
+        ordered.append(region)
+        x, y = region.center()
+    return ordered
@@ -0,0 +1,485 @@
+__author__ = 'anton'
+
+import base64
+import bisect
+import collections
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from ropeplotter.hardware import ev3
+from ropeplotter.core import PEN_DOWN_POS
+
+# Traces of plot jobs, to see what a change to the control loops does without going to the wall.
+#
+# A TraceRecorder writes down what happens in every pass of the control loops: encoder positions, set points,
+# the pen, battery voltage and the chalk sensor, and the moves with their targets. The trace starts with
+# everything needed to do the job again: the settings, the PID gains, where the motors were and the file.
+#
+# replay() does the job again on stub motors, in virtual time. Sleeping only moves a clock forward, so an
+# hour of plotting takes a minute, and the same trace gives the same result every time. Battery voltage and
+# the chalk sensor come from the trace. Then it measures both runs the same way: plot time, move and settle
+# times, overshoot and how far the drawn lines are from the recorded ones.
+#
+# Usage:
+#
+# recorder = TraceRecorder(plotter, 'traces/etch.trace.gz')
+# recorder.begin(mode, method, filename, resume)
+# plotter.stats.recorder = recorder        # Throttler takes a sample every pass
+# ...plot...
+# recorder.close(completed)
+#
+# recorded, replayed = replay('traces/etch.trace.gz')
+#
+# Or from the command line: python3 replay_trace.py traces/etch.trace.gz
+
+TRACE_VERSION = 1
+PATH_SAMPLES = 2000     # Points along the drawn lines to compare them by. Both ways, that's 4M distances.
+
+# Columns of a sample
+T, LEFT, RIGHT, LEFT_SP, RIGHT_SP, PEN, PEN_SP, VOLTS, PRESSED = range(9)
+
+# What replay_trace.py compares: key, label, unit and how much worse it may get without counting as a regression,
+# on top of the relative tolerance. The timing of a control loop pass is already 17ms.
+METRICS = [('plot_time', "Plot time", "s", 0.5),
+           ('move_time', "Mean move time", "s", 0.02),
+           ('settle_mean', "Mean settle time", "s", 0.02),
+           ('settle_max', "Max settle time", "s", 0.05),
+           ('overshoot_mean', "Mean overshoot", "deg", 0.5),
+           ('overshoot_max', "Max overshoot", "deg", 1.0),
+           ('path_mean', "Mean path error", "cm", 0.02),
+           ('path_max', "Max path error", "cm", 0.05)]
+
+
+def trace_header(plotter, mode, method, filename, resume=None):
+    """
+    Everything a replay needs to do a plot job again.
+
+    :param mode: key of PLOT_MODES in the server
+    :param method: name of the plot generator method of RopePlotter
+    :param filename: the file it plots. Its contents go into the header.
+    :param resume: keyword arguments of the generator, to resume a plot
+    :return: dict
+    """
+    with open(filename, 'rb') as f:
+        data = base64.b64encode(f.read()).decode('ascii')
+    gains = {}
+    for name, motor in (('left', plotter.left_motor), ('right', plotter.right_motor), ('pen', plotter.pen_motor)):
+        pid = motor.positionPID
+        gains[name] = {'kp': pid.Kp, 'ti': pid.Ti, 'td': pid.Td, 'precision': pid.precision,
+                       'settle_precision': pid.settle_precision, 'settle_speed': pid.settle_speed}
+    header = {'trace': TRACE_VERSION, 'platform': ev3.current_platform,
+              'mode': mode, 'method': method, 'resume': resume or {},
+              'file': os.path.basename(filename), 'data': data,
+              'settings': {'l_rope_0': plotter.l_rope_0, 'r_rope_0': plotter.r_rope_0,
+                           'attachment_distance': plotter.att_dist, 'cm_to_deg': plotter.cm_to_deg,
+                           'chalk': plotter.chalk, 'nominal_voltage': plotter.battery.nominal_voltage,
+                           'brake_time': plotter.brake_time, 'pen_latency': plotter.pen_latency,
+                           'rapid_speed': plotter.rapid_speed, 'rapid_accel': plotter.rapid_accel,
+                           'rapid_precision': plotter.rapid_precision, 'chalk_reserve': plotter.chalk_reserve,
+                           'plan_ahead': plotter.plan_ahead, 'fixed_point': plotter.fixed_point},
+              'scanlines': plotter.scanlines, 'r_step': plotter.r_step, 'gains': gains,
+              'positions': [motor.last_position for motor in plotter.all_motors]}
+    if plotter.chalk:
+        header['chalk'] = {'homed': plotter.chalk_homed, 'position': plotter.chalk_motor.position,
+                           'rate': plotter.chalk_feeder.rate}
+    return header
+
+
+class TraceRecorder(threading.Thread):
+    """
+    Records a plot job. The control loop only appends a tuple per pass. This thread turns them into
+    json lines and writes them, gzipped, every few seconds.
+
+    Without a filename, it keeps everything in memory. replay() records that way.
+
+    :param plotter: RopePlotter
+    :param filename: str, or None
+    :param interval: seconds between writes
+    :param clock: where the time of the samples comes from, the time module or a VirtualClock
+    """
+
+    def __init__(self, plotter, filename=None, interval=2.0, clock=time):
+        threading.Thread.__init__(self, name="trace")
+        self.daemon = True
+        self.plotter = plotter
+        self.filename = filename
+        self.interval = interval
+        self.lines = collections.deque()    # Samples and events that aren't written yet. Appending is thread safe.
+        self.t0 = None
+        self.done = threading.Event()
+        self.file = None
+        self.clock = clock
+
+    def begin(self, mode=None, method=None, filename=None, resume=None):
+        self.t0 = self.clock.time()
+        if self.filename:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file = gzip.open(self.filename, 'wt')
+            self.write(trace_header(self.plotter, mode, method, filename, resume))
+            self.start()
+
+    def sample(self):
+        # Called on every pass of a control loop. Only reads what's in memory already, no sysfs.
+        plotter = self.plotter
+        left, right, pen = plotter.left_motor, plotter.right_motor, plotter.pen_motor
+        self.lines.append((round(self.clock.time() - self.t0, 4), left.last_position, right.last_position,
+                           left.positionPID.set_point, right.positionPID.set_point,
+                           pen.last_position, pen.positionPID.set_point, plotter.battery.voltage,
+                           bool(plotter.chalk and plotter.chalk_feeder.pressed)))
+
+    def event(self, name, **data):
+        data['event'] = name
+        data['t'] = round(self.clock.time() - self.t0, 4)
+        self.lines.append(data)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        while self.lines:
+            self.write(self.lines.popleft())
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def close(self, completed=True):
+        self.event('end', completed=completed)
+        if self.file:
+            self.done.set()
+            self.join()
+            self.flush()
+            self.file.close()
+
+    def records(self):
+        """
+        :return: samples (list of tuples) and events (list of dicts), of a recorder without a file.
+        """
+        return split_records(self.lines)
+
+
+def split_records(records):
+    samples, events = [], []
+    for record in records:
+        if isinstance(record, dict):
+            events.append(record)
+        else:
+            samples.append(record)
+    return samples, events
+
+
+def read_trace(filename):
+    """
+    :return: header (dict), samples (list of lists) and events (list of dicts)
+    """
+    with gzip.open(filename, 'rt') as f:
+        header = json.loads(f.readline())
+        if header.get('trace') != TRACE_VERSION:
+            raise ValueError("{0} is not a version {1} trace".format(filename, TRACE_VERSION))
+        samples, events = split_records(json.loads(line) for line in f)
+    return header, samples, events
+
+
+### Replay ###
+
+class VirtualClock(object):
+    """
+    Stands in for the time module. For the thread that replays, sleep() moves the clock forward
+    without waiting. Other threads, like the battery sampler and the path planner, sleep for real.
+
+    Every time() call takes a little time too, like the code between two readings of the clock does for
+    real. Nothing happens in no time at all, and PIDControl divides by the time between two passes.
+
+    :param start: time() at the start
+    :param on_tick: called with the new time after every sleep of the replaying thread
+    :param step: seconds a time() call takes
+    """
+
+    def __init__(self, start=0.0, on_tick=None, step=0.0001):
+        self.now = float(start)
+        self.on_tick = on_tick
+        self.step = step
+        self.owner = threading.current_thread()
+
+    def time(self):
+        if threading.current_thread() is self.owner:
+            self.now += self.step
+        return self.now
+
+    def sleep(self, seconds):
+        if threading.current_thread() is not self.owner:
+            time.sleep(seconds)
+            return
+        self.now += max(seconds, 0)
+        if self.on_tick:
+            self.on_tick(self.now)
+
+    def __getattr__(self, name):
+        # strftime() and the like
+        return getattr(time, name)
+
+
+@contextlib.contextmanager
+def virtual_time(clock):
+    # The modules that time the control loops and the stub motors.
+    import ropeplotter.core
+    import ropeplotter.robot_helpers
+    import ropeplotter.raster
+    modules = [ropeplotter.core, ropeplotter.robot_helpers, ropeplotter.raster, ev3]
+    for module in modules:
+        module.time = clock
+    try:
+        yield clock
+    finally:
+        for module in modules:
+            module.time = time
+
+
+class ChalkReloaded(object):
+    # Stands in for the chalk_loaded event. The chalk is reloaded right away.
+    def set(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def wait(self, timeout=None):
+        return True
+
+
+class TracePlayer(object):
+    """
+    Feeds the inputs of a trace to a replaying plotter, at the time they were recorded: battery voltage
+    and the chalk sensor.
+    """
+
+    def __init__(self, plotter, samples, start):
+        self.plotter = plotter
+        self.samples = samples
+        self.start = start
+        self.index = 0
+
+    def __call__(self, now):
+        samples = self.samples
+        t = now - self.start
+        while self.index + 1 < len(samples) and samples[self.index + 1][T] <= t:
+            self.index += 1
+        if not samples:
+            return
+        sample = samples[self.index]
+        self.plotter.battery.voltage = sample[VOLTS]
+        if self.plotter.chalk:
+            self.plotter.chalk_sensor.is_pressed = sample[PRESSED]
+
+
+def replay_plotter(header):
+    """
+    A RopePlotter on stub motors with the settings, gains and positions of a trace.
+    """
+    from ropeplotter.core import RopePlotter
+    from ropeplotter.robot_helpers import BatterySampler
+    settings = header['settings']
+    plotter = RopePlotter(**settings)
+    plotter.scanlines = header['scanlines']
+    plotter.r_step = header['r_step']
+    for motor, name in ((plotter.left_motor, 'left'), (plotter.right_motor, 'right'), (plotter.pen_motor, 'pen')):
+        pid, gains = motor.positionPID, header['gains'][name]
+        pid.Kp, pid.Ti, pid.Td = gains['kp'], gains['ti'], gains['td']
+        pid.precision = gains['precision']
+        pid.settle_precision, pid.settle_speed = gains['settle_precision'], gains['settle_speed']
+    for motor, position in zip(plotter.all_motors, header['positions']):
+        motor.position = position
+    # The battery voltage comes from the trace, not from a sampler that runs in real time.
+    plotter.battery = BatterySampler(ev3.PowerSupply(), nominal_voltage=settings['nominal_voltage'])
+    for motor in plotter.drive_motors:
+        motor.battery = plotter.battery
+    if plotter.chalk:
+        chalk = header['chalk']
+        plotter.chalk_homed = chalk['homed']
+        plotter.chalk_motor.position = chalk['position']
+        plotter.chalk_feeder.reset(chalk['position'])
+        plotter.chalk_feeder.rate = chalk['rate']
+        plotter.chalk_loaded = ChalkReloaded()
+    return plotter
+
+
+def replay(filename, on_progress=None):
+    """
+    Do the job of a trace again, on stub motors in virtual time, and measure both.
+
+    :param filename: trace
+    :param on_progress: called with what the plot generator yields
+    :return: metrics of the recording and of the replay, dicts as returned by analyze()
+    """
+    if ev3.current_platform != 'stub':
+        raise RuntimeError("Replays drive stub motors. Set ROPEPLOTTER_STUB=1.")
+    header, samples, events = read_trace(filename)
+
+    directory = tempfile.mkdtemp()
+    try:
+        plot_file = os.path.join(directory, header['file'])
+        with open(plot_file, 'wb') as f:
+            f.write(base64.b64decode(header['data']))
+
+        clock = VirtualClock(start=1000000.0)
+        with virtual_time(clock):
+            plotter = replay_plotter(header)
+            clock.on_tick = TracePlayer(plotter, samples, clock.now)
+            clock.on_tick(clock.now)
+            recorder = TraceRecorder(plotter, clock=clock)
+            recorder.begin()
+            plotter.stats.recorder = recorder
+            for progress in getattr(plotter, header['method'])(plot_file, **header['resume']):
+                if on_progress:
+                    on_progress(progress)
+            recorder.close()
+    finally:
+        shutil.rmtree(directory)
+
+    replay_samples, replay_events = recorder.records()
+    recorded = analyze(plotter, samples, events)
+    replayed = analyze(plotter, replay_samples, replay_events, reference=drawn_path(plotter, samples))
+    return recorded, replayed
+
+
+### Measuring ###
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def analyze(plotter, samples, events, reference=None):
+    """
+    Measure a recorded or replayed job.
+
+    :param plotter: RopePlotter, for the kinematics
+    :param samples: as recorded by TraceRecorder
+    :param events: as recorded by TraceRecorder
+    :param reference: drawn path of another run, to measure the path error against
+    :return: dict with a value or None for every key of METRICS, plus 'moves' and 'completed'
+    """
+    end = [event for event in events if event['event'] == 'end']
+    metrics = {'plot_time': end[-1]['t'] if end else (samples[-1][T] if samples else 0.0),
+               'completed': bool(end and end[-1]['completed'])}
+
+    # Times and overshoot of the moves. Events come in order: move, arrived, stopped. Only moves that brake settle.
+    # A travel is a rapid move with a move for the final approach. It ends the move before it, like a move does.
+    times = [sample[T] for sample in samples]
+    move_times, settle_times, overshoots = [], [], []
+    moves = [i for i, event in enumerate(events) if event['event'] == 'move']
+    starts = [i for i, event in enumerate(events) if event['event'] in ('move', 'travel')] + [len(events)]
+    for i in moves:
+        move = events[i]
+        next_start = starts[bisect.bisect_right(starts, i)]
+        following = events[i + 1:next_start]
+        arrived = [event['t'] for event in following if event['event'] == 'arrived']
+        stopped = [event['t'] for event in following if event['event'] == 'stopped']
+        if arrived:
+            move_times.append(arrived[0] - move['t'])
+            if move['brake'] and stopped:
+                settle_times.append(stopped[0] - arrived[0])
+        # Until the next move or travel, the motors can still drift past their target after they stopped.
+        t_next = events[next_start]['t'] if next_start < len(events) else None
+        overshoots.append(overshoot(plotter, samples, times, move, t_next))
+
+    metrics.update(moves=len(moves), move_time=mean(move_times), settle_mean=mean(settle_times),
+                   settle_max=max(settle_times) if settle_times else None,
+                   overshoot_mean=mean(overshoots), overshoot_max=max(overshoots) if overshoots else None,
+                   path_mean=None, path_max=None)
+    if reference is not None:
+        metrics['path_mean'], metrics['path_max'] = path_error(drawn_path(plotter, samples), reference)
+    return metrics
+
+
+def overshoot(plotter, samples, times, move, t_end=None):
+    """
+    How far the motors went past their targets in a move, in degrees. Moves shorter than the precision
+    of the PID don't count, they don't really have a direction to overshoot in.
+
+    :param times: times of the samples, to find the ones of the move
+    :param move: event
+    :param t_end: time of the next move or travel, or None for the end
+    """
+    first = bisect.bisect_left(times, move['t'])
+    last = bisect.bisect_left(times, t_end) if t_end is not None else len(samples)
+    worst = 0
+    for column, start, target, motor in zip((LEFT, RIGHT), move['start'], move['targets'], plotter.drive_motors):
+        if abs(target - start) <= motor.positionPID.precision:
+            continue
+        direction = 1 if target > start else -1
+        for sample in samples[first:last]:
+            worst = max(worst, (sample[column] - target) * direction)
+    return worst
+
+
+def drawn_path(plotter, samples):
+    """
+    :return: numpy array of (x, y) in cm of the pen while it was down, with NaN rows between strokes
+    """
+    import numpy as np
+    points = []
+    down = False
+    for sample in samples:
+        if sample[PEN] < PEN_DOWN_POS / 2:
+            x_norm, y_norm = plotter.coords_from_motor_pos(sample[LEFT], sample[RIGHT])
+            points.append(plotter.normalized_to_global_coords(x_norm, y_norm))
+            down = True
+        elif down:
+            points.append((np.nan, np.nan))
+            down = False
+    return np.array(points, dtype=float).reshape(-1, 2)
+
+
+def resample(path, n=PATH_SAMPLES):
+    """
+    :param path: as returned by drawn_path()
+    :return: n points at equal distances along the strokes, without the jumps between them. None if nothing was drawn.
+    """
+    import numpy as np
+    steps = np.hypot(*np.diff(path, axis=0).T)
+    steps[np.isnan(steps)] = 0      # Between strokes
+    distance = np.concatenate(([0], np.cumsum(steps)))
+    drawn = ~np.isnan(path[:, 0])
+    if distance[-1] <= 0:
+        return None
+    along = np.linspace(0, distance[-1], n)
+    return np.column_stack([np.interp(along, distance[drawn], path[drawn, i]) for i in (0, 1)])
+
+
+def path_error(path, reference):
+    """
+    How far the lines of one drawing are from those of the other: for points along each, the distance
+    to the closest point of the other one.
+
+    :return: mean and max distance in cm, or None, None if one of them didn't draw
+    """
+    import numpy as np
+    a, b = resample(path), resample(reference)
+    if a is None or b is None:
+        return None, None
+    distances = np.hypot(*(a[:, None, :] - b[None, :, :]).transpose(2, 0, 1))
+    closest = np.concatenate((distances.min(axis=1), distances.min(axis=0)))
+    return round(float(closest.mean()), 3), round(float(closest.max()), 3)
+
+
+def regressions(baseline, current, tolerance=0.05):
+    """
+    :param baseline: metrics of the run to compare with
+    :param current: metrics of this run
+    :param tolerance: fraction a metric may get worse, on top of the slack in METRICS
+    :return: list of keys of the metrics that got worse. Lower is better for all of them.
+    """
+    worse = []
+    for key, label, unit, slack in METRICS:
+        if baseline.get(key) is not None and current.get(key) is not None:
+            if current[key] > baseline[key] * (1 + tolerance) + slack:
+                worse.append(key)
+    return worse
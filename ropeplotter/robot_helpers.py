@@ -1,22 +1,60 @@
 __author__ = 'anton'
 
 import time
+import threading
 from collections import deque
-import ev3dev.auto as ev3
-import smbus
+from ropeplotter.hardware import ev3
+import logging
+import os
 import socket
 
 
 def get_ip_address():
+    """
+    Find our IPv4 address from the network interfaces, without sending anything over the network.
+    Wifi is preferred over other interfaces. Works when the network is down, then it returns 127.0.0.1.
+
+    :return: str
+    """
+    import fcntl
+    import struct
+    SIOCGIFADDR = 0x8915
+    addresses = {}
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(("8.8.8.8", 80))
-    return s.getsockname()[0]
+    try:
+        for index, name in socket.if_nameindex():
+            if name == 'lo':
+                continue
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+            except (IOError, OSError):
+                continue    # Interface without an IPv4 address
+            addresses[name] = socket.inet_ntoa(ifreq[20:24])
+    finally:
+        s.close()
+
+    for prefix in ('wlan', 'wl', 'usb', 'eth', 'en'):
+        for name in sorted(addresses):
+            if name.startswith(prefix):
+                return addresses[name]
+    for name in sorted(addresses):
+        return addresses[name]
+    return '127.0.0.1'
 
 
 class BrickPiPowerSupply(object):
+    """
+    Battery voltage of a BrickPi+, read from its MCP3021 chip over i2c.
+    The bus is opened once and kept open.
+    """
+    ADDRESS = 0x48
 
-    @staticmethod
-    def measured_voltage():
+    def __init__(self, bus_number=1):
+        import smbus
+        self.bus = smbus.SMBus(bus_number)            # SMBUS 1 because we're using greater than V1.
+
+    @property
+    def measured_voltage(self):
         """
         Reads the digital output code of the MCP3021 chip on the BrickPi+ over i2c.
         Some bit operation magic to get a voltage floating number.
@@ -25,32 +63,88 @@ class BrickPiPowerSupply(object):
         The 1 in there is the bus number, same as in bus = smbus.SMBus(1)
         Google the resulting error.
 
-        :return: voltage (float)
+        :return: voltage in microvolts (float), same as ev3dev's PowerSupply
         """
+        # read data from i2c bus. the 0 command is mandatory for the protocol but not used in this chip.
+        data = self.bus.read_word_data(self.ADDRESS, 0)
 
-        try:
-                bus = smbus.SMBus(1)            # SMBUS 1 because we're using greater than V1.
-                address = 0x48
-                # time.sleep(0.1) #Is this necessary?
+        # from this data we need the last 4 bites and the first 6.
+        last_4 = data & 0b1111 # using a byte mask
+        first_6 = data >> 10 # left shift 10 because data is 16 bits
+
+        # together they make the voltage conversion ratio
+        # to make it all easier the last_4 bits are most significant :S
+        vdata = ((last_4 << 6) | first_6)
+
+        # Now we can calculate the battery voltage like so:
+        voltage = vdata * 0.0179 * 1000000    # This is an empirical number for voltage conversion.
+
+        return voltage
 
-                # read data from i2c bus. the 0 command is mandatory for the protocol but not used in this chip.
-                data = bus.read_word_data(address, 0)
 
-                # from this data we need the last 4 bites and the first 6.
-                last_4 = data & 0b1111 # using a byte mask
-                first_6 = data >> 10 # left shift 10 because data is 16 bits
+class BatterySampler(threading.Thread):
+    """
+    Reads the battery voltage in the background every few seconds and keeps a smoothed value.
+    Motors use it to scale their duty cycle, so the same PID output gives the same speed on a full
+    and on an almost empty battery.
+
+    Usage:
+
+    battery = BatterySampler(ev3.PowerSupply(), nominal_voltage=7.5)
+    battery.start()
+    duty_cycle = battery.compensation * duty_cycle
+    """
+
+    def __init__(self, power_supply, nominal_voltage=None, interval=2.0, smoothing=0.2):
+        threading.Thread.__init__(self, name="battery")
+        self.daemon = True
+        self.power_supply = power_supply
+        self.nominal_voltage = nominal_voltage  # Volts. The voltage the PID was tuned at. None is no compensation.
+        self.interval = interval
+        self.smoothing = smoothing              # Weight of a new sample in the moving average
+        self.voltage = None                     # Smoothed voltage in volts
+        self.errors = 0
+
+    def run(self):
+        while True:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        try:
+            voltage = self.power_supply.measured_voltage / 1000000.0
+        except (IOError, OSError) as e:
+            self.errors += 1
+            if self.errors == 1:
+                logging.getLogger("Plotter").warning("Can't read battery voltage: {0}".format(e))
+            return
+        if voltage <= 0:
+            return
+        if self.voltage is None:
+            self.voltage = voltage
+        else:
+            self.voltage += (voltage - self.voltage) * self.smoothing
 
-                # together they make the voltage conversion ratio
-                # to make it all easier the last_4 bits are most significant :S
-                vdata = ((last_4 << 6) | first_6)
+    @property
+    def measured_voltage(self):
+        """
+        Smoothed voltage in microvolts, to be a drop-in for ev3dev's PowerSupply
 
-                # Now we can calculate the battery voltage like so:
-                voltage = vdata * 0.0179 * 1000000    # This is an empirical number for voltage conversion.
+        :return: float
+        """
+        return (self.voltage or 0.0) * 1000000
 
-                return voltage
+    @property
+    def compensation(self):
+        """
+        Factor to multiply duty cycles with: nominal/actual voltage. Limited, so a bad reading
+        can't make the motors go wild.
 
-        except:
-                return 0.0
+        :return: float
+        """
+        if not self.nominal_voltage or not self.voltage:
+            return 1.0
+        return clamp(self.nominal_voltage / self.voltage, (0.8, 1.5))
 
 
 def clamp(n, clamp_range):
@@ -77,17 +171,54 @@ def scale(val, src, dst):
     return (float(val - src[0]) / (src[1] - src[0])) * (dst[1] - dst[0]) + dst[0]
 
 
+def trapezoid(distance, max_speed, accel, t, start_speed=0.0):
+    """
+    Motion profile that accelerates, cruises at max speed and decelerates to a stop. When the distance is too
+    short to reach max speed, it's a triangle instead.
+
+    :param distance: total distance, positive
+    :param max_speed: distance per second
+    :param accel: distance per second per second
+    :param t: seconds since the start
+    :param start_speed: speed at the start. With max_speed, only the deceleration is shaped. Lower when
+    there isn't room to stop from it.
+    :return: distance covered at time t, total duration of the profile
+    """
+    accel = float(accel)
+    start_speed = min(start_speed, max_speed, (2 * accel * distance) ** 0.5)
+    # Speeding up from start_speed to the peak and slowing down from there have to fit in the distance.
+    peak = min(max_speed, (accel * distance + start_speed ** 2 / 2.0) ** 0.5)
+    t_acc = (peak - start_speed) / accel
+    t_dec = peak / accel
+    t_cruise = max(distance - (start_speed + peak) / 2.0 * t_acc - peak / 2.0 * t_dec, 0) / peak if peak else 0
+    duration = t_acc + t_cruise + t_dec
+
+    t = clamp(t, (0, duration))
+    if t < t_acc:
+        covered = start_speed * t + 0.5 * accel * t ** 2
+    elif t < t_acc + t_cruise:
+        covered = (start_speed + peak) / 2.0 * t_acc + peak * (t - t_acc)
+    else:
+        covered = distance - 0.5 * accel * (duration - t) ** 2
+    return covered, duration
+
+
 class Throttler(object):
     """
     Helper class to make sure a certain amount of time has passed before entering the next pass trough a loop.
     Allows me to set a 'framerate' and makes sure a loop doesn't run faster than that.
     """
 
-    def __init__(self, framerate):
+    def __init__(self, framerate, stats=None):
         self.fps = framerate
         self.timestamp = time.time()
+        self.stats = stats  # PlotterStats that counts the passes, if any
 
     def throttle(self):
+        if self.stats:
+            self.stats.loop_passes += 1
+            if self.stats.recorder:
+                self.stats.recorder.sample()
         wait_time = 1.0 / self.fps - (
             time.time() - self.timestamp)  # has enough time passed? If not, this is the remainder
         if wait_time > 0:
@@ -95,13 +226,150 @@ class Throttler(object):
         self.timestamp = time.time()
 
 
+class PlotterStats(object):
+    """
+    Counters for the metrics page. Only the thread that drives the motors adds to them. Other threads
+    only read them, and reading a number is atomic in python, so there are no locks to wait for.
+    """
+
+    def __init__(self):
+        self.loop_passes = 0    # Passes through control loops
+        self.moves = 0          # Moves to a target
+        self.stops = 0          # Moves that stopped to settle at their target
+        self.pen_down_cm = 0.0  # Distance driven with the pen down
+        self.pen_up_cm = 0.0    # Distance driven with the pen up
+        self.plan_depth = 0     # Frames planned ahead of the motors
+        self.plan_underruns = 0 # Times the motors waited for the planner
+        self.recorder = None    # TraceRecorder that samples every pass, while a job is recorded
+
+
+class ChalkFeeder(object):
+    """
+    Pushes the chalk out at the rate it wears off, so the plotter doesn't have to stop and wait for the
+    touch sensor. The rate is in extruder degrees per cm drawn. When the sensor says the chalk lost contact
+    anyway, the rate was too low: it goes up and the extruder catches up while drawing goes on. Without
+    that, the rate slowly goes down, so too much chalk isn't pushed out either.
+
+    Usage:
+
+    feeder = ChalkFeeder(ev3.Motor(ev3.OUTPUT_D), ev3.TouchSensor(ev3.INPUT_4), rate=10)
+    feeder.feed(cm)         # On every pass of a control loop, with the distance drawn since the last one.
+    feeder.pause()          # When the pen goes up
+    if feeder.remaining_cm() < 150:
+        # Not enough chalk for another long stroke. Reload before starting it.
+    if feeder.empty:
+        # A stroke was longer than that. Stop and reload now.
+    """
+
+    def __init__(self, motor, sensor, rate=10.0, end=20552, catch_up=300, learn=0.1, decay=0.0005):
+        self.motor = motor
+        self.sensor = sensor
+        self.rate = rate            # Extruder degrees per cm drawn
+        self.min_rate = rate / 4    # The rate doesn't decay below this
+        self.end = end              # Extruder position where the holder is empty
+        self.catch_up = catch_up    # Extra degrees per second while the chalk has no contact
+        self.learn = learn          # Fraction the rate goes up at every loss of contact
+        self.decay = decay          # Fraction the rate goes down per cm drawn with contact
+        self.target = 0.0           # Where the extruder should be
+        self.commanded = None       # Target the motor got last, so it isn't sent the same one every pass
+        self.pressed = False
+        self.last_time = None
+        self.contact_losses = 0
+        self.ran_out = 0            # Times the holder got empty halfway a stroke
+
+    def reset(self, position=0):
+        # After homing or reloading
+        self.target = float(position)
+        self.commanded = None
+        self.pressed = False
+        self.last_time = None
+
+    def feed(self, distance):
+        """
+        :param distance: cm drawn since the last call
+        """
+        now = time.time()
+        dt = min(now - self.last_time, 0.5) if self.last_time else 0.0
+        self.last_time = now
+
+        pressed = self.sensor.is_pressed
+        if pressed and not self.pressed:
+            self.rate *= 1 + self.learn
+            self.contact_losses += 1
+            logging.getLogger("Plotter").debug("Chalk lost contact. Feeding {0:.2f} deg/cm now".format(self.rate))
+        elif not pressed:
+            self.rate = max(self.rate * (1 - self.decay * distance), self.min_rate)
+        self.pressed = pressed
+
+        self.target = min(self.target + self.rate * distance + (self.catch_up * dt if pressed else 0), self.end)
+        if self.commanded is None or self.target - self.commanded >= 1:
+            self.commanded = int(self.target)
+            self.motor.run_to_abs_pos(position_sp=self.commanded, speed_sp=600)
+
+    @property
+    def empty(self):
+        return self.target >= self.end
+
+    def pause(self):
+        # The pen is up. Time without drawing shouldn't count as catch up time.
+        self.last_time = None
+
+    def prime(self, throttle):
+        """
+        Extrude until the chalk has contact, with the pen down before a stroke. After that the model takes over.
+
+        :return: False if the holder ran empty
+        """
+        if self.sensor.is_pressed:
+            self.motor.run_forever(speed_sp=150)
+            while self.sensor.is_pressed:
+                throttle.throttle()
+                if self.motor.position > self.end:
+                    self.motor.stop()
+                    return False
+            self.motor.stop()
+        self.reset(self.motor.position)
+        return True
+
+    def remaining_cm(self):
+        return (self.end - self.target) / self.rate
+
+
+class CpuMeter(object):
+    """
+    Measures the CPU time used by this process, all threads together, as a percentage of wall time.
+
+    Usage:
+
+    meter = CpuMeter()
+    ...
+    print(meter.read())  # percentage since the last read
+    """
+
+    def __init__(self):
+        self.last_cpu = self.cpu_time()
+        self.last_time = time.time()
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return times[0] + times[1]  # user + system
+
+    def read(self):
+        cpu, now = self.cpu_time(), time.time()
+        percentage = 100.0 * (cpu - self.last_cpu) / max(now - self.last_time, 1e-6)
+        self.last_cpu, self.last_time = cpu, now
+        return percentage
+
+
 class PIDControl(object):
     """
     Helper class that remembers the integral and derivative of an error and uses that to calculate
     feedback power.
     """
 
-    def __init__(self, Kp=1.0, Ti=0.0, Td=0.0, Kp_neg_factor=1, max_out=100, max_integral=100, direction=1, precision=15):
+    def __init__(self, Kp=1.0, Ti=0.0, Td=0.0, Kp_neg_factor=1, max_out=100, max_integral=100, direction=1, precision=15,
+                 settle_precision=5, settle_speed=30):
         self.direction = direction
         self.__Kp = Kp
         self.Kp_neg_factor = Kp_neg_factor
@@ -111,6 +379,8 @@ class PIDControl(object):
         self.zero = 0
         self.__current = 0
         self.precision = precision
+        self.settle_precision = settle_precision    # Max error to count as settled
+        self.settle_speed = settle_speed            # Max speed in degrees per second to count as settled
         self.set_point = 0         # This also initializes other properties using setter
         self.max_out = max_out
         self.max_i = max_integral
@@ -145,6 +415,10 @@ class PIDControl(object):
         # Setter, python style!
         # Not only set a new target, but also reset other steering factors
         self.__set_point = target * self.direction     # Change direction if necessary
+        self.reset()
+
+    def reset(self):
+        # Start over at the same set point, e.g. after the motor was stopped for a while.
         self.integral = 0                           # Reset integral part
         self.prev_error = self.error                # Reset errors
         self.timestamp = time.time()-0.02           # Reset derivative timer
@@ -152,6 +426,13 @@ class PIDControl(object):
         self.history = deque(maxlen=3)
         self.intervals = deque(maxlen=3)
 
+    def track(self, target):
+        """
+        Move the set point without resetting integral and derivative, to follow a target that moves a
+        little every pass, like a motion profile.
+        """
+        self.__set_point = target * self.direction
+
     @property
     def target_reached(self):
         return abs(self.error) < self.precision
@@ -160,6 +441,23 @@ class PIDControl(object):
     def speed(self):
         return sum(self.history)/sum(self.intervals)
 
+    @property
+    def error_rate(self):
+        """
+        How fast the error changes over the last few calc_power() calls, in degrees per second.
+        This is minus the speed of the motor when the set point doesn't change.
+        """
+        if len(self.history) < 2:
+            return float('inf')     # Don't know yet.
+        return (self.history[-1] - self.history[0]) / sum(list(self.intervals)[1:])
+
+    @property
+    def settled(self):
+        """
+        True when the motor is close to its set point and has practically stopped moving.
+        """
+        return abs(self.error) < self.settle_precision and abs(self.error_rate) < self.settle_speed
+
     def calc_power(self):
         """
         Saves a timestamp, integral and previous error and does PID calculations.
@@ -201,13 +499,28 @@ class PIDControl(object):
 
 
 class PIDMotor(ev3.Motor):
-    def __init__(self, port=None, name='*', Kp=3.0, Ki=0.0, Kd=0.0, brake=0, verbose=False, speed_reg=False, **kwargs):
+    def __init__(self, port=None, name='*', Kp=3.0, Ki=0.0, Kd=0.0, brake=0, verbose=False, speed_reg=False, loop_rate=60,
+                 **kwargs):
         ev3.Motor.__init__(self, port, name)
         self.positionPID = PIDControl(Kp=Kp, Ti=Ki, Td=Kd, max_out=100)
         self.brake = brake
         self.verbose = verbose
         self.speed_reg = speed_reg
         self.power = 0
+        self.battery = None     # BatterySampler for voltage compensation of the duty cycle
+        self.dwell_saved = 0.0  # Seconds of brake time saved by settle detection
+        self.loop_rate = loop_rate  # Passes per second through the blocking run_ methods
+        self.last_position = 0  # Last encoder reading, so other threads can use it without sysfs reads.
+
+    @property
+    def position(self):
+        self.last_position = ev3.Motor.position.fget(self)
+        return self.last_position
+
+    @position.setter
+    def position(self, value):
+        ev3.Motor.position.fset(self, value)
+        self.last_position = value
 
     @property
     def position_sp(self):
@@ -227,6 +540,8 @@ class PIDMotor(ev3.Motor):
         if self.speed_reg:
             self.run_forever(speed_sp = pospower)
         else:
+            if self.battery:
+                pospower = int(clamp(pospower * self.battery.compensation, (-100, 100)))
             self.duty_cycle_sp = pospower
             self.run_direct()
 
@@ -237,18 +552,140 @@ class PIDMotor(ev3.Motor):
 
     def run_for_time(self, time_in_s, speed):
         end_time = time.time() + time_in_s
+        throttle = Throttler(self.loop_rate)
         while time.time() < end_time:
             self.run_at_speed_sp(speed)
+            throttle.throttle()
 
     def run_to_abs_pos(self, position_sp=None):
         if position_sp is not None:
             self.positionPID.set_point = position_sp
+        throttle = Throttler(self.loop_rate)
         while not self.positionPID.target_reached:
             self.run()
+            throttle.throttle()
 
+        # Brake: keep the PID running until we've settled, but no longer than self.brake seconds.
         t_end = time.time() + self.brake
         while time.time() < t_end:
             #print "Braking"
             self.run()
+            if self.positionPID.settled:
+                self.dwell_saved += t_end - time.time()
+                break
+            throttle.throttle()
+
+        self.stop()
+
+class PlotExecutor(object):
+    """
+    Runs plot generators in their own thread, advancing them back-to-back without throttling.
+    Between two steps of the generator it checks the pause and abort flags, so plotting
+    can be paused, resumed or aborted by explicit commands from another thread.
+
+    Usage:
+
+    executor = PlotExecutor(on_progress=print, on_done=print)     # on_done(name, completed, seconds, error)
+    executor.start(plotter.plot_from_file('uploads/coords.csv'))
+    executor.pause()
+    executor.resume()
+    executor.abort()
+    """
+
+    def __init__(self, on_progress=None, on_done=None):
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.__running = threading.Event()   # Cleared while paused
+        self.__running.set()
+        self.__abort = False
+        self.__thread = None
+
+    @property
+    def busy(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    @property
+    def paused(self):
+        return self.busy and not self.__running.is_set()
+
+    def start(self, generator, name="plot"):
+        """
+        Start running a generator. Refuses to start if another one is still running.
+
+        :param generator: generator yielding progress
+        :param name: str, used in thread name and passed to on_done
+        :return: True if started
+        """
+        if self.busy:
+            return False
+        self.__abort = False
+        self.__running.set()
+        self.__thread = threading.Thread(target=self.__run, args=(generator, name), name=name)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def pause(self):
+        self.__running.clear()
+
+    def resume(self):
+        self.__running.set()
+
+    def abort(self):
+        self.__abort = True
+        self.__running.set()    # Wake up a paused generator so it can be closed.
+
+    def join(self, timeout=None):
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def __run(self, generator, name):
+        start_time = time.time()
+        completed = False
+        error = None
+        try:
+            for progress in generator:
+                if self.on_progress:
+                    self.on_progress(progress)
+                self.__running.wait()
+                if self.__abort:
+                    break
+            else:
+                completed = True
+        except Exception as e:
+            # Nobody else sees exceptions in this thread. Log it and tell on_done why the plot stopped.
+            logging.getLogger("Plotter").exception("{0} failed".format(name))
+            error = e
+        finally:
+            generator.close()
+            if self.on_done:
+                self.on_done(name, completed, time.time() - start_time, error)
+
+
+class ButtonReader(threading.Thread):
+    """
+    Blocks on the evdev input device of the brick buttons and reports press and release edges.
+    No polling: the thread sleeps in the kernel until a button changes state.
+
+    Usage:
+
+    reader = ButtonReader(on_change=lambda name, pressed: print(name, pressed))
+    reader.start()
+    """
+    # evdev key codes of the brick buttons
+    KEY_NAMES = {103: 'up', 108: 'down', 105: 'left', 106: 'right', 28: 'enter', 14: 'backspace'}
+
+    def __init__(self, on_change, buttons=None):
+        threading.Thread.__init__(self, name="buttons")
+        self.daemon = True
+        self.on_change = on_change
+        self.buttons = buttons if buttons is not None else ev3.Button()
 
-        self.stop()
\ No newline at end of file
+    def run(self):
+        if self.buttons.evdev_device is None:
+            return      # No buttons, e.g. with stub hardware.
+        from evdev import ecodes
+        for event in self.buttons.evdev_device.read_loop():
+            # value is 1 for press, 0 for release and 2 for autorepeat, which we don't need.
+            if event.type == ecodes.EV_KEY and event.code in self.KEY_NAMES and event.value in (0, 1):
+                self.on_change(self.KEY_NAMES[event.code], event.value == 1)
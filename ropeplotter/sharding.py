@@ -0,0 +1,288 @@
+__author__ = 'anton'
+
+import math
+
+from ropeplotter.core import RopePlotter, UP, DOWN
+
+# Splits a mural that's too big for one plotter over several plotters on the same wall.
+# All coordinates here are wall coordinates in cm, with the same origin for every plotter,
+# e.g. the top left corner of the wall. Each plotter knows where its left rope is attached.
+#
+# The mural is cut into a grid of square cells. Every cell that has something to plot is given
+# to one of the plotters that can reach all of it. Cells are handed out biggest first, each to the
+# plotter that would be done soonest with it (longest processing time first).
+
+# For estimating plot times. They only need to be right relative to each other.
+DRAW_SPEED = 600        # Motor degrees per second while drawing, like SLOW in core
+TRAVEL_SPEED = 1050     # Motor degrees per second for travel moves, the max_speed of an EV3 large motor
+POINT_TIME = 0.1        # Extra seconds per point, for the final approach
+PEN_TIME = 0.3          # Seconds to move the pen up or down
+
+# Gray levels that the raster modes plot in separate passes
+RASTER_LEVELS = {'plotcircles': (180, 120, 65),
+                 'plotwaves': (256,)}
+
+EPSILON = 1e-6
+
+
+class MuralPlotter(object):
+    """
+    One plotter on the wall, with its canvas in wall coordinates.
+
+    :param name: str, for messages and job names
+    :param url: str, like http://192.168.1.10:9093
+    :param x: wall x of the left rope attachment point in cm
+    :param y: wall y of the left rope attachment point in cm
+    :param settings: dict with the plotter settings, like /status reports them: ll, lr, aw, cm_to_deg, rs
+    """
+
+    def __init__(self, name, url, x, y, settings):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.settings = settings
+        h_margin, v_margin, self.canvas_size = RopePlotter.canvas_geometry(float(settings['ll']),
+                                                                           float(settings['lr']),
+                                                                           float(settings['aw']))
+        self.canvas = (x + h_margin, y + v_margin, x + h_margin + self.canvas_size, y + v_margin + self.canvas_size)
+        self.deg_per_cm = abs(float(settings['cm_to_deg']))
+        self.cells = []         # Cells of the mural this plotter will plot
+        self.load = 0.0         # Estimated seconds of plotting for those cells
+        self.job_name = None
+        self.status = None      # Status of the job in the plotter's queue
+        self.progress = 0.0     # 0..1
+
+    def __repr__(self):
+        return "<MuralPlotter {0} at {1}>".format(self.name, self.url)
+
+    def contains(self, rect):
+        left, top, right, bottom = self.canvas
+        return (rect[0] >= left - EPSILON and rect[1] >= top - EPSILON and
+                rect[2] <= right + EPSILON and rect[3] <= bottom + EPSILON)
+
+    def to_norm(self, x, y):
+        """
+        Wall coordinates to the normalized canvas coordinates of this plotter.
+        """
+        return (x - self.canvas[0]) / self.canvas_size, (y - self.canvas[1]) / self.canvas_size
+
+    def estimate(self, work):
+        """
+        Seconds this plotter needs for a piece of work.
+
+        :param work: dict from path_work() or raster_work()
+        :return: float
+        """
+        seconds = work.get('draw', 0) * self.deg_per_cm / DRAW_SPEED
+        seconds += work.get('points', 0) * POINT_TIME
+        seconds += work.get('strokes', 0) * (2 * PEN_TIME + POINT_TIME)
+        # Raster modes scan the cell in lines r_step apart.
+        seconds += work.get('scan_area', 0) / float(self.settings.get('rs', 2.0)) * self.deg_per_cm / DRAW_SPEED
+        return seconds
+
+
+def make_cells(left, top, width, height, cell_size):
+    """
+    Cut a rectangle in square cells. The cells on the right and bottom edge can be smaller.
+
+    :return: list of (left, top, right, bottom)
+    """
+    cells = []
+    columns = int(math.ceil(width / float(cell_size) - EPSILON))
+    rows = int(math.ceil(height / float(cell_size) - EPSILON))
+    for row in range(rows):
+        for column in range(columns):
+            cells.append((left + column * cell_size,
+                          top + row * cell_size,
+                          min(left + (column + 1) * cell_size, left + width),
+                          min(top + (row + 1) * cell_size, top + height)))
+    return cells
+
+
+### Paths ###
+
+def read_path(filename):
+    """
+    Read a coords.csv file, like plot_from_file does.
+
+    :return: list of (x_norm, y_norm, pen)
+    """
+    points = []
+    with open(filename) as coords:
+        num_coords = int(coords.readline())
+        for i in range(num_coords):
+            points.append(RopePlotter.read_coord(coords))
+    return points
+
+
+def write_path(filename, points):
+    """
+    Write points to a file that plot_from_file can plot.
+
+    :param points: list of (x_norm, y_norm, pen)
+    """
+    with open(filename, 'w') as coords:
+        coords.write("{0}\n".format(len(points)))
+        for x, y, pen in points:
+            coords.write("{0:.5f},{1:.5f},{2}\n".format(x, y, pen))
+
+
+def clip_segment(start, end, rect):
+    """
+    Liang-Barsky line clipping.
+
+    :param start: (x, y)
+    :param end: (x, y)
+    :param rect: (left, top, right, bottom)
+    :return: (t0, t1), the part of the segment inside rect as fractions of its length. None if it misses.
+    """
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, start[0] - rect[0]), (dx, rect[2] - start[0]),
+                 (-dy, start[1] - rect[1]), (dy, rect[3] - start[1])):
+        if p == 0:
+            if q < 0:
+                return None     # Parallel to this edge and outside
+        else:
+            t = q / float(p)
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+    if t0 > t1:
+        return None
+    return t0, t1
+
+
+def clip_path(points, cells):
+    """
+    The drawn parts of a path that lie inside a set of cells.
+
+    :param points: list of (x, y, pen) in wall coordinates. The pen says whether to draw to a point.
+    :param cells: list of (left, top, right, bottom)
+    :return: list of (x, y, pen). Every piece starts with a travel (UP) to its first point.
+    """
+    result = []
+    for (x0, y0, _), (x1, y1, pen) in zip(points, points[1:]):
+        if pen != DOWN:
+            continue
+        intervals = sorted([t for t in [clip_segment((x0, y0), (x1, y1), cell) for cell in cells] if t])
+        # Neighbouring cells give touching intervals. Join them, so the line isn't cut at cell edges.
+        merged = []
+        for t0, t1 in intervals:
+            if merged and t0 <= merged[-1][1] + EPSILON:
+                merged[-1][1] = max(merged[-1][1], t1)
+            else:
+                merged.append([t0, t1])
+        for t0, t1 in merged:
+            if t1 - t0 < EPSILON and not (x0 == x1 and y0 == y1):
+                continue
+            start = (x0 + (x1 - x0) * t0, y0 + (y1 - y0) * t0)
+            end = (x0 + (x1 - x0) * t1, y0 + (y1 - y0) * t1)
+            if not result or math.hypot(result[-1][0] - start[0], result[-1][1] - start[1]) > EPSILON:
+                result.append((start[0], start[1], UP))
+            result.append((end[0], end[1], DOWN))
+    return result
+
+
+def path_work(points, cell):
+    """
+    How much drawing a path has inside a cell.
+
+    :param points: list of (x, y, pen) in wall coordinates
+    :return: dict with cm to draw, points and strokes
+    """
+    piece = clip_path(points, [cell])
+    draw = sum([math.hypot(x1 - x0, y1 - y0) for (x0, y0, _), (x1, y1, pen) in zip(piece, piece[1:]) if pen == DOWN])
+    return {'draw': draw,
+            'points': len(piece),
+            'strokes': len([point for point in piece if point[2] == UP])}
+
+
+### Images ###
+
+def raster_work(image, mural_rect, cell, levels):
+    """
+    How much scanning a raster plot of an image needs inside a cell. Every gray level pass
+    scans the cell if it has pixels darker than that level.
+
+    :param image: grayscale PIL image of the whole mural
+    :param mural_rect: (left, top, right, bottom) of the mural
+    :param cell: (left, top, right, bottom)
+    :param levels: gray levels, like RASTER_LEVELS[mode]
+    :return: dict with the scan area in square cm
+    """
+    darkest = image.crop(image_box(image, mural_rect, cell)).getextrema()[0]
+    area = (cell[2] - cell[0]) * (cell[3] - cell[1])
+    return {'scan_area': area * len([level for level in levels if darkest < level])}
+
+
+def image_box(image, rect, cell):
+    """
+    The pixels of an image covering a rect that cover a cell.
+
+    :return: (left, upper, right, lower) for PIL
+    """
+    x_scale = image.size[0] / float(rect[2] - rect[0])
+    y_scale = image.size[1] / float(rect[3] - rect[1])
+    return (int(round((cell[0] - rect[0]) * x_scale)), int(round((cell[1] - rect[1]) * y_scale)),
+            int(round((cell[2] - rect[0]) * x_scale)), int(round((cell[3] - rect[1]) * y_scale)))
+
+
+def tile_image(image, mural_rect, plotter, size=500):
+    """
+    The image a plotter should plot: its own cells of the mural, and white everywhere else.
+
+    :param image: grayscale PIL image of the whole mural
+    :param mural_rect: (left, top, right, bottom) of the mural
+    :param plotter: MuralPlotter
+    :param size: width and height of the result in pixels, for the whole canvas
+    :return: PIL image
+    """
+    from PIL import Image
+    tile = Image.new("L", (size, size), color=255)
+    for cell in plotter.cells:
+        source = image.crop(image_box(image, mural_rect, cell))
+        box = image_box(tile, plotter.canvas, cell)
+        if box[2] > box[0] and box[3] > box[1]:
+            tile.paste(source.resize((box[2] - box[0], box[3] - box[1])), box[:2])
+    return tile
+
+
+### Dividing the work ###
+
+def assign_cells(cells, works, plotters):
+    """
+    Give every cell with work to the plotter that can reach it and would be done soonest.
+    Biggest cells go first, so the small ones even out the differences at the end.
+
+    :param cells: list of (left, top, right, bottom)
+    :param works: list of work dicts, one for every cell
+    :param plotters: list of MuralPlotter
+    :return: list of cells with work that no plotter can reach
+    """
+    unreachable = []
+    for plotter in plotters:
+        plotter.cells = []
+        plotter.load = 0.0
+    jobs = [(cell, work) for cell, work in zip(cells, works) if any(work.values())]
+    jobs.sort(key=lambda job: max([plotter.estimate(job[1]) for plotter in plotters]), reverse=True)
+    for cell, work in jobs:
+        candidates = [plotter for plotter in plotters if plotter.contains(cell)]
+        if not candidates:
+            unreachable.append(cell)
+            continue
+        plotter = min(candidates, key=lambda candidate: candidate.load + candidate.estimate(work))
+        plotter.cells.append(cell)
+        plotter.load += plotter.estimate(work)
+    return unreachable
+
+
+def overall_progress(plotters):
+    """
+    :return: 0..1, weighted by the estimated time of each plotter
+    """
+    total = sum([plotter.load for plotter in plotters])
+    if not total:
+        return 1.0
+    return sum([plotter.load * plotter.progress for plotter in plotters]) / total
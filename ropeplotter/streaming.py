@@ -0,0 +1,176 @@
+__author__ = 'anton'
+
+import json
+import logging
+import queue
+import socket
+import struct
+import threading
+
+# Plotting with the planning done on another computer. The host reads the files, does the kinematics
+# and sends motor targets. The brick only drives to them.
+#
+# Protocol, over one TCP connection:
+# 1. The brick sends one json line with its geometry and the size of its frame buffer.
+# 2. The host sends one json line with the number of frames it's going to send.
+# 3. The host sends frames, binary, and never more than the buffer size ahead of the acks.
+# 4. The brick sends an ack with its encoder positions after it has driven to each frame.
+# The host closes the connection when it's done, or the brick closes it when the plot is aborted.
+
+FRAME = struct.Struct('<Iiibb')     # sequence number, left target, right target, pen, flags
+ACK = struct.Struct('<Iii')         # sequence number, left position, right position
+
+# Frame flags
+BRAKE = 1           # Settle at the target before the next frame
+PEN_DOWN_AFTER = 2  # Put the pen down when arriving, because the next frame draws.
+PEN_UP_AFTER = 4    # Lift the pen when arriving
+
+plotter_log = logging.getLogger("Plotter")
+
+
+class FrameServer(threading.Thread):
+    """
+    Runs on the brick. Accepts one host at a time and buffers the frames it sends.
+    The plotter gets them from frames(), which sends the acks.
+
+    Usage:
+
+    server = FrameServer(plotter, port=9095, on_connect=start_streaming)
+    server.start()
+    ...
+    plot_action = plotter.plot_from_frames(server.frames(), server.total)
+    """
+
+    def __init__(self, plotter, port=9095, buffer_size=64, on_connect=None):
+        threading.Thread.__init__(self, name="frames")
+        self.daemon = True
+        self.plotter = plotter
+        self.port = port
+        self.buffer_size = buffer_size
+        self.on_connect = on_connect
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.connection = None
+        self.host = None
+        self.total = 0      # Number of frames the host announced
+
+    def run(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', self.port))
+        listener.listen(1)
+        while True:
+            connection, address = listener.accept()
+            try:
+                self.receive(connection, address[0])
+            except (IOError, ValueError) as e:
+                plotter_log.warning("Frame stream from {0} failed: {1}".format(address[0], e))
+            finally:
+                connection.close()
+                self.connection = None
+                self.clear()
+                self.buffer.put(None)   # End of stream
+
+    def clear(self):
+        while not self.buffer.empty():
+            self.buffer.get_nowait()
+
+    def receive(self, connection, host):
+        # Start clean. Whatever was left belongs to an old stream.
+        self.clear()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = connection.makefile('rb')
+        plotter = self.plotter
+        handshake = {'ll': plotter.l_rope_0, 'lr': plotter.r_rope_0, 'aw': plotter.att_dist,
+                     'cm_to_deg': plotter.cm_to_deg, 'rs': plotter.r_step, 'buffer': self.buffer_size}
+        connection.sendall((json.dumps(handshake) + '\n').encode())
+        header = json.loads(stream.readline().decode())
+        self.total = header['frames']
+        self.connection = connection
+        self.host = host
+        plotter_log.info("{0} is going to stream {1} frames".format(host, self.total))
+        if self.on_connect:
+            self.on_connect()
+
+        while True:
+            data = stream.read(FRAME.size)
+            if len(data) < FRAME.size:
+                break   # Host closed the connection
+            # Blocks when the buffer is full. The host shouldn't let that happen, but TCP will hold it back.
+            self.buffer.put(FRAME.unpack(data))
+
+    def frames(self):
+        """
+        Generator of the buffered frames, until the host is done. Send an ack for every frame
+        as soon as the next one is asked for, so only after it's been plotted.
+
+        :yield: (seq, left, right, pen, flags)
+        """
+        try:
+            while True:
+                frame = self.buffer.get()
+                if frame is None:
+                    break
+                yield frame
+                positions = [motor.last_position for motor in self.plotter.drive_motors]
+                connection = self.connection
+                if connection:
+                    connection.sendall(ACK.pack(frame[0], *positions))
+        finally:
+            self.close()
+
+    def close(self):
+        # Stop streaming, e.g. after an abort. The host sees the connection close.
+        connection = self.connection
+        if connection:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except IOError:
+                pass
+
+
+class FrameClient(object):
+    """
+    Runs on the host. Connects to a FrameServer and streams frames, keeping no more frames in flight
+    than the brick can buffer.
+
+    Usage:
+
+    client = FrameClient('192.168.1.10')
+    plotter = RopePlotter(client.geometry['ll'], ...)
+    client.stream([(left, right, pen, flags), ...], on_ack=print)
+    """
+
+    def __init__(self, host, port=9095):
+        self.connection = socket.create_connection((host, port))
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream_in = self.connection.makefile('rb')
+        self.geometry = json.loads(self.stream_in.readline().decode())
+
+    def stream(self, frames, on_ack=None):
+        """
+        Send frames and wait until the brick has plotted them all.
+
+        :param frames: list of (left, right, pen, flags)
+        :param on_ack: function(seq, left_position, right_position)
+        :return: True if all frames were plotted, False if the brick stopped early.
+        """
+        window = self.geometry['buffer']
+        self.connection.sendall((json.dumps({'frames': len(frames)}) + '\n').encode())
+        sent = acked = 0
+        try:
+            while acked < len(frames):
+                if sent < len(frames) and sent - acked < window:
+                    # Batch as many frames as fit in the window in one send.
+                    batch = frames[sent:min(len(frames), acked + window)]
+                    self.connection.sendall(b''.join([FRAME.pack(sent + i, *frame) for i, frame in enumerate(batch)]))
+                    sent += len(batch)
+                data = self.stream_in.read(ACK.size)
+                if len(data) < ACK.size:
+                    return False    # The brick closed the connection, e.g. after an abort.
+                ack = ACK.unpack(data)
+                acked = ack[0] + 1
+                if on_ack:
+                    on_ack(*ack)
+            return True
+        finally:
+            self.connection.close()
@@ -0,0 +1,159 @@
+__author__ = 'anton'
+
+import threading
+import time
+
+# Simulated stand-in for the parts of ev3dev.auto the plotter uses. Motors integrate their speed over time,
+# so encoder positions move like the real thing and the PID loops work. Nothing is physically driven.
+# Select it with ROPEPLOTTER_STUB=1, see ropeplotter.hardware.
+
+current_platform = 'stub'
+
+OUTPUT_A = 'outA'
+OUTPUT_B = 'outB'
+OUTPUT_C = 'outC'
+OUTPUT_D = 'outD'
+INPUT_1 = 'in1'
+INPUT_2 = 'in2'
+INPUT_3 = 'in3'
+INPUT_4 = 'in4'
+
+
+class Motor(object):
+    """
+    A motor with a speed of max_speed degrees per second at 100% duty cycle. The speed follows the
+    command with a short lag, a bit like a motor with some load on it.
+    """
+    max_speed = 1050.0      # degrees per second at full power, like an EV3 large motor
+    time_constant = 0.05    # seconds for the speed to get 63% of the way to a new command
+
+    def __init__(self, address=None, name_pattern='*', **kwargs):
+        self.address = address
+        self.stop_action = 'coast'
+        self.polarity = 'normal'
+        self.speed_sp = 0
+        self._duty_cycle_sp = 0
+        self._mode = None       # None (stopped), 'direct', 'forever' or 'position'
+        self._target = 0
+        self._position = 0.0
+        self._speed = 0.0
+        self._timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def _commanded_speed(self):
+        if self._mode == 'direct':
+            return self._duty_cycle_sp * self.max_speed / 100.0
+        elif self._mode == 'forever':
+            return float(self.speed_sp)
+        elif self._mode == 'position':
+            error = self._target - self._position
+            speed = min(abs(self.speed_sp), abs(error) * 10)
+            return speed if error > 0 else -speed
+        return 0.0
+
+    def _update(self):
+        # Move the simulation forward to now.
+        with self._lock:
+            now = time.time()
+            dt = now - self._timestamp
+            self._timestamp = now
+            self._speed += (self._commanded_speed() - self._speed) * min(1.0, dt / self.time_constant)
+            self._position += self._speed * dt
+            if self._mode == 'position' and abs(self._target - self._position) < 1:
+                self._mode = None
+
+    @property
+    def position(self):
+        self._update()
+        return int(round(self._position))
+
+    @position.setter
+    def position(self, value):
+        self._update()
+        self._position = float(value)
+
+    @property
+    def speed(self):
+        self._update()
+        return int(self._speed)
+
+    @property
+    def duty_cycle_sp(self):
+        return self._duty_cycle_sp
+
+    @duty_cycle_sp.setter
+    def duty_cycle_sp(self, value):
+        self._update()
+        self._duty_cycle_sp = max(-100, min(100, int(value)))
+
+    @property
+    def state(self):
+        self._update()
+        if self._mode is None:
+            return []
+        return ['running']
+
+    def run_direct(self, **kwargs):
+        self._update()
+        if 'duty_cycle_sp' in kwargs:
+            self._duty_cycle_sp = max(-100, min(100, int(kwargs['duty_cycle_sp'])))
+        self._mode = 'direct'
+
+    def run_forever(self, **kwargs):
+        self._update()
+        self.speed_sp = kwargs.get('speed_sp', self.speed_sp)
+        self._mode = 'forever'
+
+    def run_to_abs_pos(self, **kwargs):
+        self._update()
+        self._target = kwargs.get('position_sp', self._target)
+        self.speed_sp = kwargs.get('speed_sp', self.speed_sp)
+        self._mode = 'position'
+
+    def stop(self, **kwargs):
+        self._update()
+        self._mode = None
+        if self.stop_action != 'coast':
+            self._speed = 0.0
+
+    def wait_until(self, state, timeout=None):
+        # A stub motor never stalls, so there's nothing to wait for.
+        return True
+
+    def wait_while(self, state, timeout=None):
+        end_time = time.time() + timeout / 1000.0 if timeout else None
+        while state in self.state:
+            if end_time and time.time() > end_time:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+class TouchSensor(object):
+    def __init__(self, address=None, **kwargs):
+        self.address = address
+        self.is_pressed = False
+
+
+class PowerSupply(object):
+    def __init__(self, voltage=7.5):
+        self.measured_voltage = int(voltage * 1000000)     # microvolts, like ev3dev
+
+    @property
+    def measured_volts(self):
+        return self.measured_voltage / 1000000.0
+
+
+class Screen(object):
+    # Only keeps the image. There's nothing to show it on.
+    def __init__(self):
+        from PIL import Image
+        self.image = Image.new("1", (178, 128), color=255)
+
+    def update(self):
+        pass
+
+
+class Button(object):
+    # No buttons to read. The web page does everything.
+    evdev_device = None
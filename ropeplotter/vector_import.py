@@ -0,0 +1,562 @@
+__author__ = 'anton'
+
+import math
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ElementTree
+
+from ropeplotter.core import UP, DOWN
+
+# Turns SVG and G-code files into a coords.csv for plot_from_file, without the L3onardo script.
+#
+# Files are read as a stream: SVG element by element and G-code line by line, so big files don't
+# need much memory. Curves and arcs are cut in straight lines just short enough that they don't
+# stray more than the tolerance from the real curve. With a tolerance of what the plotter can
+# resolve, no points are made that it couldn't plot anyway.
+#
+# Usage:
+#
+# tolerance = flattening_tolerance(plotter.canvas_size, plotter.cm_to_deg)
+# num_points = import_vectors('uploads/drawing.svg', 'uploads/coords.csv', tolerance)
+
+MIN_ARC_SEGMENTS = 8    # Per full circle, even with a huge tolerance. Keeps the bounds of round things right.
+MAX_DEPTH = 16          # Max number of times a bezier is cut in half
+
+GCODE_EXTENSIONS = ('.gcode', '.gc', '.nc', '.ngc')
+SVG_SKIP = ('defs', 'clipPath', 'mask', 'symbol', 'marker', 'pattern', 'metadata', 'title', 'desc', 'style')
+
+
+def flattening_tolerance(canvas_size, cm_to_deg, degrees=15):
+    """
+    How far a line may be from the curve it replaces, in normalized coordinates.
+
+    :param canvas_size: cm
+    :param cm_to_deg: motor degrees per cm of rope
+    :param degrees: motor degrees that the plotter can't resolve anyway, e.g. the PID precision.
+    :return: float
+    """
+    return degrees / abs(float(cm_to_deg)) / canvas_size
+
+
+def import_vectors(source, destination, tolerance):
+    """
+    Convert an SVG or G-code file to a coords.csv with a pen column.
+
+    :param source: path of the .svg or G-code file
+    :param destination: path of the coords.csv to write
+    :param tolerance: max distance between a curve and its lines, normalized to the size of the drawing
+    :return: number of points written
+    """
+    read = read_gcode if os.path.splitext(source)[1].lower() in GCODE_EXTENSIONS else read_svg
+
+    # We need to know how big the drawing is to scale it to the canvas. Look at the SVG viewBox,
+    # or if there's none, go through the file once to find out.
+    bounds = svg_bounds(source) if read == read_svg else None
+    if bounds is None:
+        bounds_finder = Bounds()
+        read(source, Flattener(bounds_finder, float('inf')))
+        bounds = bounds_finder.bounds()
+    left, top, right, bottom = bounds
+    size = max(right - left, bottom - top) or 1.0
+
+    writer = CoordsWriter(destination, left, top, size, tolerance)
+    read(source, Flattener(writer, tolerance * size))
+    return writer.close()
+
+
+### Where the points go ###
+
+class Bounds(object):
+    def __init__(self):
+        self.left = self.top = float('inf')
+        self.right = self.bottom = float('-inf')
+
+    def add(self, x, y, pen):
+        self.left = min(self.left, x)
+        self.right = max(self.right, x)
+        self.top = min(self.top, y)
+        self.bottom = max(self.bottom, y)
+
+    def bounds(self):
+        if self.left > self.right:
+            raise ValueError("Nothing to plot in this file")
+        return self.left, self.top, self.right, self.bottom
+
+
+class CoordsWriter(object):
+    """
+    Normalizes points and writes them to a coords.csv. Points closer than the tolerance to the previous
+    one are dropped. The number of points goes on the first line, so they go to a temp file first.
+    """
+
+    def __init__(self, filename, left, top, size, tolerance):
+        self.filename = filename
+        self.left = left
+        self.top = top
+        self.size = float(size)
+        self.tolerance = tolerance
+        self.count = 0
+        self.last = None
+        self.tmp_file = open(filename + '.tmp', 'w')
+
+    def add(self, x, y, pen):
+        x_norm = (x - self.left) / self.size
+        y_norm = (y - self.top) / self.size
+        if self.last is not None and pen == DOWN and self.last[2] == DOWN:
+            if math.hypot(x_norm - self.last[0], y_norm - self.last[1]) < self.tolerance:
+                return
+        self.tmp_file.write("{0:.5f},{1:.5f},{2}\n".format(x_norm, y_norm, pen))
+        self.last = (x_norm, y_norm, pen)
+        self.count += 1
+
+    def close(self):
+        self.tmp_file.close()
+        with open(self.filename, 'w') as coords:
+            coords.write("{0}\n".format(self.count))
+            with open(self.filename + '.tmp') as points:
+                shutil.copyfileobj(points, coords)
+        os.remove(self.filename + '.tmp')
+        return self.count
+
+
+### Curves to lines ###
+
+class Flattener(object):
+    """
+    Pen movements with lines, curves and arcs, turned into points for a sink. The sink has an
+    add(x, y, pen) method. Points are transformed by an affine matrix (a, b, c, d, e, f) like in SVG.
+
+    :param sink: Bounds or CoordsWriter
+    :param tolerance: max distance between curve and lines, in units after the transform
+    """
+
+    def __init__(self, sink, tolerance):
+        self.sink = sink
+        self.tolerance = tolerance
+        self.matrix = (1, 0, 0, 1, 0, 0)
+        self.x = self.y = 0.0
+        self.start = (0.0, 0.0)     # Of the sub path, for close()
+        self.pending = True         # Moved with the pen up, but no point written yet
+
+    def set_matrix(self, matrix):
+        self.matrix = matrix
+
+    def user_tolerance(self):
+        # The tolerance in coordinates before the transform
+        a, b, c, d, e, f = self.matrix
+        scale = math.sqrt(abs(a * d - b * c)) or 1.0
+        return self.tolerance / scale
+
+    def emit(self, x, y, pen):
+        a, b, c, d, e, f = self.matrix
+        self.sink.add(a * x + c * y + e, b * x + d * y + f, pen)
+
+    def move_to(self, x, y):
+        # Travel moves are only written when there's something to draw after them.
+        self.x, self.y = x, y
+        self.start = (x, y)
+        self.pending = True
+
+    def line_to(self, x, y):
+        if self.pending:
+            self.emit(self.x, self.y, UP)
+            self.pending = False
+        self.emit(x, y, DOWN)
+        self.x, self.y = x, y
+
+    def close(self):
+        if (self.x, self.y) != self.start:
+            self.line_to(*self.start)
+        self.x, self.y = self.start
+
+    def cubic_to(self, x1, y1, x2, y2, x, y):
+        self.bezier(((self.x, self.y), (x1, y1), (x2, y2), (x, y)), self.user_tolerance(), 0)
+
+    def quadratic_to(self, x1, y1, x, y):
+        self.bezier(((self.x, self.y), (x1, y1), (x, y)), self.user_tolerance(), 0)
+
+    def bezier(self, points, tolerance, depth):
+        # Flat enough when the control points are close to the line between the end points.
+        # Otherwise cut it in half with de Casteljau and try again.
+        (x0, y0), (xn, yn) = points[0], points[-1]
+        length = math.hypot(xn - x0, yn - y0)
+        if length:
+            distance = max([abs((xn - x0) * (y0 - py) - (x0 - px) * (yn - y0)) / length for px, py in points[1:-1]])
+        else:
+            distance = max([math.hypot(px - x0, py - y0) for px, py in points[1:-1]])
+        if distance <= tolerance or depth >= MAX_DEPTH:
+            self.line_to(xn, yn)
+            return
+        left, right = [points[0]], [points[-1]]
+        while len(points) > 1:
+            points = [((xa + xb) / 2.0, (ya + yb) / 2.0) for (xa, ya), (xb, yb) in zip(points, points[1:])]
+            left.append(points[0])
+            right.insert(0, points[-1])
+        self.bezier(left, tolerance, depth + 1)
+        self.bezier(right, tolerance, depth + 1)
+
+    def arc(self, cx, cy, rx, ry, phi, start_angle, sweep_angle):
+        """
+        Lines along an elliptical arc, from the current point. Enough lines that the
+        sagitta of each is within the tolerance.
+
+        :param phi: rotation of the ellipse in radians
+        :param sweep_angle: radians, positive is clockwise in SVG
+        """
+        radius = max(rx, ry)
+        tolerance = self.user_tolerance()
+        if radius > tolerance:
+            max_step = 2 * math.acos(1 - tolerance / radius)
+        else:
+            max_step = math.pi
+        max_step = min(max_step, 2 * math.pi / MIN_ARC_SEGMENTS)
+        steps = max(1, int(math.ceil(abs(sweep_angle) / max_step)))
+        cos_phi, sin_phi = math.cos(phi), math.sin(phi)
+        for i in range(1, steps + 1):
+            angle = start_angle + sweep_angle * i / steps
+            x = rx * math.cos(angle)
+            y = ry * math.sin(angle)
+            self.line_to(cx + x * cos_phi - y * sin_phi, cy + x * sin_phi + y * cos_phi)
+
+    def arc_center_to(self, cx, cy, x, y, clockwise):
+        # Circular arc around a center, like G2 and G3. Ends exactly at x, y.
+        radius = math.hypot(self.x - cx, self.y - cy)
+        start = math.atan2(self.y - cy, self.x - cx)
+        sweep = math.atan2(y - cy, x - cx) - start
+        if clockwise and sweep >= 0:
+            sweep -= 2 * math.pi
+        elif not clockwise and sweep <= 0:
+            sweep += 2 * math.pi
+        self.arc(cx, cy, radius, radius, 0, start, sweep)
+        self.x, self.y = x, y
+
+    def svg_arc_to(self, rx, ry, rotation, large_arc, sweep, x, y):
+        # The endpoint to center conversion from the SVG spec, appendix F.6.5
+        x1, y1 = self.x, self.y
+        if (x1, y1) == (x, y):
+            return
+        rx, ry = abs(rx), abs(ry)
+        if not rx or not ry:
+            self.line_to(x, y)
+            return
+        phi = math.radians(rotation)
+        cos_phi, sin_phi = math.cos(phi), math.sin(phi)
+        dx, dy = (x1 - x) / 2.0, (y1 - y) / 2.0
+        x1p = cos_phi * dx + sin_phi * dy
+        y1p = -sin_phi * dx + cos_phi * dy
+        # Scale up radii that are too small
+        scale = (x1p / rx) ** 2 + (y1p / ry) ** 2
+        if scale > 1:
+            rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+        numerator = rx ** 2 * ry ** 2 - rx ** 2 * y1p ** 2 - ry ** 2 * x1p ** 2
+        denominator = rx ** 2 * y1p ** 2 + ry ** 2 * x1p ** 2
+        factor = math.sqrt(max(0, numerator / denominator))
+        if large_arc == sweep:
+            factor = -factor
+        cxp, cyp = factor * rx * y1p / ry, -factor * ry * x1p / rx
+        cx = cos_phi * cxp - sin_phi * cyp + (x1 + x) / 2.0
+        cy = sin_phi * cxp + cos_phi * cyp + (y1 + y) / 2.0
+        start = math.atan2((y1p - cyp) / ry, (x1p - cxp) / rx)
+        end = math.atan2((-y1p - cyp) / ry, (-x1p - cxp) / rx)
+        sweep_angle = end - start
+        if sweep and sweep_angle < 0:
+            sweep_angle += 2 * math.pi
+        elif not sweep and sweep_angle > 0:
+            sweep_angle -= 2 * math.pi
+        self.arc(cx, cy, rx, ry, phi, start, sweep_angle)
+        self.x, self.y = x, y
+
+
+### SVG ###
+
+NUMBER = r'[-+]?(?:\d*\.\d+|\d+\.?)(?:[eE][-+]?\d+)?'
+PATH_TOKEN = re.compile(r'([MmZzLlHhVvCcSsQqTtAa])|(' + NUMBER + ')')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def svg_number(value, default=0.0):
+    # Lengths like "10", "10px" or "10mm". Units are ignored, the drawing is scaled to the canvas anyway.
+    match = re.match(NUMBER, (value or '').strip())
+    return float(match.group(0)) if match else default
+
+
+def svg_bounds(filename):
+    """
+    The viewBox, or else the width and height, from the root element. Reads no further than that.
+
+    :return: (left, top, right, bottom) or None
+    """
+    for event, element in ElementTree.iterparse(filename, events=('start',)):
+        view_box = element.get('viewBox')
+        if view_box:
+            x, y, w, h = [float(v) for v in re.findall(NUMBER, view_box)]
+            return x, y, x + w, y + h
+        width, height = svg_number(element.get('width')), svg_number(element.get('height'))
+        if width and height and '%' not in element.get('width') + element.get('height'):
+            return 0.0, 0.0, width, height
+        return None
+
+
+def multiply(m1, m2):
+    # Affine matrices as (a, b, c, d, e, f). The result does m2 first, then m1.
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+            a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+
+def parse_transform(text):
+    matrix = (1, 0, 0, 1, 0, 0)
+    for name, args in re.findall(r'(\w+)\s*\(([^)]*)\)', text or ''):
+        values = [float(v) for v in re.findall(NUMBER, args)]
+        if name == 'matrix' and len(values) == 6:
+            step = tuple(values)
+        elif name == 'translate':
+            step = (1, 0, 0, 1, values[0], values[1] if len(values) > 1 else 0)
+        elif name == 'scale':
+            step = (values[0], 0, 0, values[1] if len(values) > 1 else values[0], 0, 0)
+        elif name == 'rotate':
+            angle = math.radians(values[0])
+            step = (math.cos(angle), math.sin(angle), -math.sin(angle), math.cos(angle), 0, 0)
+            if len(values) == 3:
+                step = multiply(multiply((1, 0, 0, 1, values[1], values[2]), step),
+                                (1, 0, 0, 1, -values[1], -values[2]))
+        elif name == 'skewX':
+            step = (1, 0, math.tan(math.radians(values[0])), 1, 0, 0)
+        elif name == 'skewY':
+            step = (1, math.tan(math.radians(values[0])), 0, 1, 0, 0)
+        else:
+            continue
+        matrix = multiply(matrix, step)
+    return matrix
+
+
+def read_svg(filename, pen):
+    """
+    Draw all shapes of an SVG file with a Flattener. Elements are thrown away as soon as they're drawn.
+    """
+    matrices = [(1, 0, 0, 1, 0, 0)]
+    parents = []
+    skipping = 0
+    for event, element in ElementTree.iterparse(filename, events=('start', 'end')):
+        name = local_name(element.tag)
+        if event == 'start':
+            matrices.append(multiply(matrices[-1], parse_transform(element.get('transform'))))
+            parents.append(element)
+            if name in SVG_SKIP or skipping:
+                skipping += 1
+            elif element.get('display') != 'none':
+                pen.set_matrix(matrices[-1])
+                draw_svg_element(name, element, pen)
+        else:
+            matrices.pop()
+            parents.pop()
+            if skipping:
+                skipping -= 1
+            element.clear()
+            if parents:
+                # Done with all children of the parent so far. Don't keep them.
+                del parents[-1][:]
+
+
+def draw_svg_element(name, element, pen):
+    get = lambda key: svg_number(element.get(key))
+    if name == 'path':
+        draw_svg_path(element.get('d', ''), pen)
+    elif name == 'line':
+        pen.move_to(get('x1'), get('y1'))
+        pen.line_to(get('x2'), get('y2'))
+    elif name in ('polyline', 'polygon'):
+        values = [float(v) for v in re.findall(NUMBER, element.get('points', ''))]
+        points = list(zip(values[0::2], values[1::2]))
+        if points:
+            pen.move_to(*points[0])
+            for point in points[1:]:
+                pen.line_to(*point)
+            if name == 'polygon':
+                pen.close()
+    elif name == 'rect':
+        x, y, w, h = get('x'), get('y'), get('width'), get('height')
+        pen.move_to(x, y)
+        for point in ((x + w, y), (x + w, y + h), (x, y + h)):
+            pen.line_to(*point)
+        pen.close()
+    elif name in ('circle', 'ellipse'):
+        cx, cy = get('cx'), get('cy')
+        rx = get('r') if name == 'circle' else get('rx')
+        ry = get('r') if name == 'circle' else get('ry')
+        if rx and ry:
+            pen.move_to(cx + rx, cy)
+            pen.arc(cx, cy, rx, ry, 0, 0, 2 * math.pi)
+            pen.x, pen.y = cx + rx, cy
+
+
+def draw_svg_path(d, pen):
+    tokens = [(command, number) for command, number in PATH_TOKEN.findall(d)]
+    i = 0
+    command = None
+    last_control = None     # For the smooth curves S and T
+
+    def numbers(count):
+        values = [float(number) for command, number in tokens[i:i + count]]
+        if len(values) < count or any([command for command, number in tokens[i:i + count]]):
+            raise ValueError("Bad path data: " + d[:40])
+        return values
+
+    while i < len(tokens):
+        if tokens[i][0]:
+            command = tokens[i][0]
+            i += 1
+            if command in 'Zz':
+                pen.close()
+                last_control = None
+                continue
+        elif command is None:
+            raise ValueError("Path data doesn't start with a command: " + d[:40])
+
+        relative = command.islower()
+        ox, oy = (pen.x, pen.y) if relative else (0.0, 0.0)
+        upper = command.upper()
+        control = None
+        if upper == 'M':
+            x, y = numbers(2)
+            i += 2
+            pen.move_to(ox + x, oy + y)
+            command = 'l' if relative else 'L'     # More pairs after a move are lines.
+        elif upper == 'L':
+            x, y = numbers(2)
+            i += 2
+            pen.line_to(ox + x, oy + y)
+        elif upper == 'H':
+            x, = numbers(1)
+            i += 1
+            pen.line_to(ox + x, pen.y)
+        elif upper == 'V':
+            y, = numbers(1)
+            i += 1
+            pen.line_to(pen.x, oy + y)
+        elif upper == 'C':
+            x1, y1, x2, y2, x, y = numbers(6)
+            i += 6
+            control = (ox + x2, oy + y2)
+            pen.cubic_to(ox + x1, oy + y1, ox + x2, oy + y2, ox + x, oy + y)
+        elif upper == 'S':
+            x2, y2, x, y = numbers(4)
+            i += 4
+            x1, y1 = reflect(last_control, pen, 'CS')
+            control = (ox + x2, oy + y2)
+            pen.cubic_to(x1, y1, ox + x2, oy + y2, ox + x, oy + y)
+        elif upper == 'Q':
+            x1, y1, x, y = numbers(4)
+            i += 4
+            control = (ox + x1, oy + y1)
+            pen.quadratic_to(ox + x1, oy + y1, ox + x, oy + y)
+        elif upper == 'T':
+            x, y = numbers(2)
+            i += 2
+            control = reflect(last_control, pen, 'QT')
+            pen.quadratic_to(control[0], control[1], ox + x, oy + y)
+        elif upper == 'A':
+            rx, ry, rotation = numbers(3)
+            i += 3
+            # Flags can be written without separators, like "a5 5 0 01 10 10"
+            flags = ''
+            while len(flags) < 2:
+                flags += tokens[i][1]
+                i += 1
+            if len(flags) > 2:
+                tokens.insert(i, ('', flags[2:]))
+            x, y = numbers(2)
+            i += 2
+            pen.svg_arc_to(rx, ry, rotation, flags[0] == '1', flags[1] == '1', ox + x, oy + y)
+        last_control = (upper, control) if control else None
+
+
+def reflect(last_control, pen, commands):
+    # The first control point of a smooth curve is the last one of the previous curve, mirrored.
+    if last_control and last_control[0] in commands:
+        x, y = last_control[1]
+        return 2 * pen.x - x, 2 * pen.y - y
+    return pen.x, pen.y
+
+
+### G-code ###
+
+GCODE_WORD = re.compile(r'([A-Za-z])\s*(' + NUMBER + ')')
+
+
+def read_gcode(filename, pen):
+    """
+    Draw a G-code file with a Flattener, line by line. Understands G0 (travel), G1 (line), G2 and G3 (arcs
+    with I J or R), G20 and G21 (inches, mm), G90 and G91 (absolute, relative).
+    The pen goes up with M5 or a positive Z and down with M3 or Z of zero or less.
+    """
+    pen.set_matrix((1, 0, 0, -1, 0, 0))     # G-code has y going up, the plotter has it going down.
+    absolute = True
+    motion = 0
+    pen_down = True     # Until a Z or M code says otherwise
+    unit = 1.0
+    x = y = 0.0
+    with open(filename) as lines:
+        for line in lines:
+            line = re.sub(r'\(.*?\)', '', line.split(';')[0])
+            words = {}
+            for letter, value in GCODE_WORD.findall(line):
+                letter = letter.upper()
+                if letter in 'GM':
+                    code = int(float(value))
+                    if letter == 'G' and code in (0, 1, 2, 3):
+                        motion = code
+                    elif letter == 'G' and code == 20:
+                        unit = 25.4
+                    elif letter == 'G' and code == 21:
+                        unit = 1.0
+                    elif letter == 'G' and code == 90:
+                        absolute = True
+                    elif letter == 'G' and code == 91:
+                        absolute = False
+                    elif letter == 'M' and code in (3, 4):
+                        pen_down = True
+                    elif letter == 'M' and code == 5:
+                        pen_down = False
+                else:
+                    words[letter] = float(value) * unit
+
+            if 'Z' in words:
+                pen_down = words['Z'] <= 0
+            if 'X' not in words and 'Y' not in words:
+                continue
+            new_x = words.get('X', 0.0 if not absolute else x) + (0.0 if absolute else x)
+            new_y = words.get('Y', 0.0 if not absolute else y) + (0.0 if absolute else y)
+            if motion == 0 or not pen_down:
+                pen.move_to(new_x, new_y)
+            elif motion == 1:
+                pen.line_to(new_x, new_y)
+            else:
+                if pen.pending:
+                    pen.emit(pen.x, pen.y, UP)
+                    pen.pending = False
+                if 'R' in words:
+                    cx, cy = arc_center(x, y, new_x, new_y, words['R'], motion == 2)
+                else:
+                    cx, cy = x + words.get('I', 0.0), y + words.get('J', 0.0)
+                pen.arc_center_to(cx, cy, new_x, new_y, clockwise=motion == 2)
+            x, y = new_x, new_y
+
+
+def arc_center(x1, y1, x2, y2, radius, clockwise):
+    # Center of an arc given with R. A negative radius means the long way around.
+    dx, dy = x2 - x1, y2 - y1
+    chord = math.hypot(dx, dy)
+    if not chord:
+        raise ValueError("G-code arc with R can't be a full circle")
+    # The center is left of the chord for a short counterclockwise arc, right of it for a short clockwise one.
+    h = math.sqrt(max(0.0, radius ** 2 - (chord / 2.0) ** 2))
+    if clockwise != (radius < 0):
+        h = -h
+    return x1 + dx / 2.0 - h * dy / chord, y1 + dy / 2.0 + h * dx / chord
@@ -10,3 +10,26 @@ MAX_SPEED = 100
 SCAN_LINES = 40
 PREVIEW_SIZE = 160
 CHALK = True
+CHALK_RATE = 10.0               # Extruder degrees per cm drawn, to start with. Learned from the touch sensor while drawing.
+CHALK_RESERVE = 150.0           # cm of drawing. With less chalk left, it asks for a reload before the next stroke.
+CHECKPOINT_INTERVAL = 5.0       # Seconds between saves of plot progress, for resuming after a crash
+NOMINAL_VOLTAGE = 7.5           # Battery voltage in V at which the PID was tuned. Motor power is scaled by this/actual.
+PID_GAINS_FILE = 'pid_gains.json'  # Per motor PID gains found by autotune. They override KP, TI and TD.
+SETTLE_PRECISION = 5            # Degrees. A drive motor closer than this to its target...
+SETTLE_SPEED = 30               # ...and slower than this in degrees per second has settled. No need to brake longer.
+BRAKE_TIME = 0.7                # Max seconds to hold position after a move that needs to stop
+LOAD_INTERVAL = 1.0             # Seconds between measurements of CPU use and web server responsiveness
+RAPID_SPEED = None              # Degrees per second for travel moves with the pen up. None is the motors' max_speed
+RAPID_ACCEL = 3000              # Degrees per second per second to slow down at the end of a travel move
+RAPID_PRECISION = 45            # Degrees. Travel moves only need to be this close before the final approach.
+STREAM_PORT = 9095              # TCP port for motor frames planned on another computer (host_planner.py)
+STREAM_BUFFER = 64              # Frames the brick buffers. The host never sends more ahead than this.
+PLAN_AHEAD = 64                 # Points of a coords.csv planned ahead of the motors, in a thread of their own
+FIXED_POINT = False             # Integer kinematics for the EV3, if benchmark_kinematics.py says that is faster there
+TRACE_DIR = 'traces'            # Where --record saves a trace of every plot job, to replay with replay_trace.py
+VECTORIZE_BUDGET = 60           # Max seconds to turn a picture into lines (stipple, contours, spiral) on the brick
+LOG_FILE = 'logs/plotter.log'   # Json records, one per line. Rotated when it gets big.
+LOG_MAX_BYTES = 1000000         # Size at which the log file is rotated
+LOG_BACKUPS = 3                 # Number of rotated log files to keep
+LOG_LEVELS = {'Plotter': 'INFO', 'tornado.access': 'CRITICAL', 'tornado.application': 'CRITICAL',
+              'tornado.general': 'CRITICAL'}  # Per subsystem. Override with --log-level or -v.